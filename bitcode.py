@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+
+import struct
+from cfg import CFG
+from llvmcode import *
+from operand import OType, Operand
+
+##
+## LLVM ビットコードの出力（--emit=bc）
+##   テキストの LLVM IR を介さずに，モジュール（大域変数・関数定義・printf/scanf の宣言）を
+##   LLVM 14 のビットコード形式で直接書き出す．
+##   - ビットストリームの略記（abbreviation）は文字列表の BLOB にだけ使い，他はすべて略記なしの記録にする．
+##   - 定数はすべてモジュールの定数ブロックに置く．関数内で使う定数の番号を先に決めるため，
+##     関数本体は2回符号化する（1回目で型と定数を集め，2回目で記録を作る）．
+##   - 関数内の値はモジュール形式 2 の相対番号で参照する．
+##   - 関数属性は出力するが，メタデータ（!tbaa・!prof・!range）は出力しない．
+##   実行時ライブラリをテキストの IR で持つ命令（並列化・計測・--fast-io）には対応しない．
+##
+
+# ブロック番号
+MODULE_BLOCK = 8
+PARAMATTR_BLOCK = 9
+PARAMATTR_GROUP_BLOCK = 10
+CONSTANTS_BLOCK = 11
+FUNCTION_BLOCK = 12
+IDENTIFICATION_BLOCK = 13
+VALUE_SYMTAB_BLOCK = 14
+TYPE_BLOCK = 17
+STRTAB_BLOCK = 23
+
+# 関数属性の種類番号
+ATTR_KIND = {'nounwind': 18, 'readnone': 20, 'readonly': 21, 'norecurse': 48, 'willreturn': 61}
+
+# 命令の記録番号と演算子の番号
+INST_BINOP = 2
+INST_CAST = 3
+INST_INSERTELT = 7
+INST_SHUFFLEVEC = 8
+INST_RET = 10
+INST_BR = 11
+INST_PHI = 16
+INST_ALLOCA = 19
+INST_LOAD = 20
+INST_CMP2 = 28
+INST_CALL = 34
+INST_GEP = 43
+INST_STORE = 44
+BINOP = {'add': 0, 'sub': 1, 'mul': 2, 'sdiv': 4, 'shl': 7, 'ashr': 9, 'and': 10}
+CAST_ZEXT = 1
+CAST_SEXT = 2
+CAST_BITCAST = 11
+ICMP = {CmpType.EQ: 32, CmpType.NE: 33, CmpType.SGT: 38,
+        CmpType.SGE: 39, CmpType.SLT: 40, CmpType.SLE: 41}
+ALIGN4 = 3                  # 4バイト境界（log2(4)+1）
+
+# 型（タプルで表す）
+I1 = ('int', 1)
+I8 = ('int', 8)
+I32 = ('int', 32)
+I64 = ('int', 64)
+VOID = ('void',)
+LABEL = ('label',)
+
+
+def ptr(t:tuple) -> tuple:
+    return ('ptr', t)
+
+
+def array(n:int, t:tuple) -> tuple:
+    return ('array', n, t)
+
+
+def vector(n:int) -> tuple:
+    return ('vector', n, I32)
+
+
+def function(ret:tuple, params:list, vararg:bool=False) -> tuple:
+    return ('function', ret, tuple(params), vararg)
+
+
+PRINTF_TYPE = function(I32, [ptr(I8)], vararg=True)
+
+
+class BitWriter(object):
+    '''
+    ビットストリームの書き出し
+        ビットは下位から詰めて32ビットの語ごとにリトルエンディアンで並べる
+    '''
+
+    def __init__(self):
+        self.words = []
+        self.cur = 0            # 書きかけの語
+        self.nbits = 0          # 書きかけの語に詰めたビット数
+        self.width = 2          # 現在のブロックの略記番号の幅
+        self.blocks = []        # (外側の略記番号の幅, ブロック長を書く語の位置)
+
+    def emit(self, val:int, width:int):
+        ''' val を width ビットで書く '''
+        while width > 0:
+            n = min(width, 32 - self.nbits)
+            self.cur |= (val & ((1 << n) - 1)) << self.nbits
+            self.nbits += n
+            val >>= n
+            width -= n
+            if self.nbits == 32:
+                self.words.append(self.cur)
+                self.cur = 0
+                self.nbits = 0
+
+    def emitVBR(self, val:int, width:int):
+        ''' val を width ビットずつの可変長で書く '''
+        hi = 1 << (width - 1)
+        while val >= hi:
+            self.emit((val & (hi - 1)) | hi, width)
+            val >>= width - 1
+        self.emit(val, width)
+
+    def align32(self):
+        if self.nbits:
+            self.emit(0, 32 - self.nbits)
+
+    def enterBlock(self, id:int, width:int=4):
+        self.emit(1, self.width)                # ENTER_SUBBLOCK
+        self.emitVBR(id, 8)
+        self.emitVBR(width, 4)
+        self.align32()
+        self.blocks.append((self.width, len(self.words)))
+        self.words.append(0)                    # ブロック長（語数）は終わりで書き込む
+        self.width = width
+
+    def endBlock(self):
+        self.emit(0, self.width)                # END_BLOCK
+        self.align32()
+        self.width, pos = self.blocks.pop()
+        self.words[pos] = len(self.words) - pos - 1
+
+    def record(self, code:int, ops:list):
+        ''' 略記なしの記録 '''
+        self.emit(3, self.width)                # UNABBREV_RECORD
+        self.emitVBR(code, 6)
+        self.emitVBR(len(ops), 6)
+        for x in ops:
+            self.emitVBR(x, 6)
+
+    def blob(self, code:int, data:bytes):
+        ''' [code, blob] の略記を定義し，それを使って data を書く '''
+        self.emit(2, self.width)                # DEFINE_ABBREV
+        self.emitVBR(2, 5)
+        self.emit(1, 1)                         # 定数 code
+        self.emitVBR(code, 8)
+        self.emit(0, 1)                         # blob
+        self.emit(5, 3)
+        self.emit(4, self.width)                # 定義した略記（番号 4）
+        self.emitVBR(len(data), 6)
+        self.align32()
+        for b in data:
+            self.emit(b, 8)
+        self.align32()
+
+    def getvalue(self) -> bytes:
+        return struct.pack(f"<{len(self.words)}I", *self.words)
+
+
+def chars(s:str) -> list:
+    return list(s.encode())
+
+
+def signed(v:int) -> int:
+    ''' 符号付き整数の記録での表現（符号を最下位ビットに置く） '''
+    return v << 1 if v >= 0 else ((-v) << 1) | 1
+
+
+class FunctionEncoder(object):
+    '''
+    1つの関数定義の命令の記録への符号化
+        module : 出力するモジュール（型・定数・大域の値の番号を管理する）
+        fundef : 関数定義
+    '''
+
+    def __init__(self, module, fundef):
+        self.module = module
+        self.fundef = fundef
+        self.blocks = [b for b in CFG(fundef).blocks if b.label is not None or b.codes]
+        self.bbid = {b.label: i for i, b in enumerate(self.blocks)}
+
+    def number(self):
+        ''' 関数内の値に番号を付ける（大域の値に続けて，引数，値を定義する命令の順） '''
+        base = self.module.nvalues()
+        self.ids = {}
+        self.types = {}
+        for x in self.fundef.params:
+            self.define(x, I32, base)
+        for b in self.blocks:
+            for l in b.codes:
+                if isinstance(l, LLVMCodeAlloca):
+                    self.define(Operand(OType.NAMED_REG, name=l.name), ptr(I32), base)
+                elif l.getDef() is not None:
+                    self.define(l.getDef(), self.typeOf(l), base)
+
+    def define(self, x:Operand, t:tuple, base:int):
+        self.ids[x] = base + len(self.ids)
+        self.types[x] = t
+
+    def typeOf(self, l:LLVMCode) -> tuple:
+        ''' 命令 l が定義する値の型 '''
+        if isinstance(l, LLVMCodeIcmp):
+            return I1
+        if isinstance(l, LLVMCodeSext):
+            return I64
+        if isinstance(l, (LLVMCodeGetelementptr, LLVMCodePtrAdd)):
+            return ptr(I32)
+        if isinstance(l, LLVMCodePhi):
+            return ptr(I32) if l.type == 'i32*' else I32
+        if isinstance(l, LLVMCodeBitcast):
+            return ptr(vector(l.width))
+        if isinstance(l, (LLVMCodeVecLoad, LLVMCodeVecBinOp, LLVMCodeInsertElement, LLVMCodeSplat)):
+            return vector(l.width)
+        if isinstance(l, (LLVMCodeLoad, LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul, LLVMCodeDiv,
+                          LLVMCodeShl, LLVMCodeAshr, LLVMCodeAnd, LLVMCodeCall,
+                          LLVMCodeCallPrintf, LLVMCodeCallScanf)):
+            return I32
+        raise NotImplementedError(f"bitcode: unsupported instruction: {l}")
+
+    def valueId(self, x, t:tuple) -> int:
+        ''' 型 t の位置で使うオペランド x の値の番号 '''
+        m = self.module
+        if isinstance(x, tuple):
+            return m.constant(('data', t, x))
+        if x.type == OType.CONSTANT:
+            if t[0] == 'vector':
+                return m.constant(('data', t, (x.val,) * t[1]))
+            return m.constant(('int', t, x.val))
+        if x.type == OType.GLOBAL_VAR:
+            return m.globalId(x.name)
+        return self.ids[x]
+
+    def typeOfValue(self, x, t:tuple) -> tuple:
+        if isinstance(x, Operand) and x in self.types:
+            return self.types[x]
+        if isinstance(x, Operand) and x.type == OType.GLOBAL_VAR:
+            return ptr(I32)
+        return t
+
+    def push(self, ops:list, x, t:tuple):
+        ''' 型が分かっている位置のオペランド（相対番号） '''
+        ops.append((self.inst - self.valueId(x, t)) & 0xFFFFFFFF)
+
+    def pushTyped(self, ops:list, x, t:tuple):
+        ''' 型を添えることがあるオペランド（前方参照なら型番号を続ける） '''
+        v = self.valueId(x, t)
+        ops.append((self.inst - v) & 0xFFFFFFFF)
+        if v >= self.inst:
+            ops.append(self.module.typeId(self.typeOfValue(x, t)))
+
+    def encode(self) -> list:
+        ''' 命令の記録 (記録番号, オペランドのリスト) のリストを作る '''
+        self.number()
+        self.inst = self.module.nvalues() + len(self.fundef.params)
+        records = []
+        for b in self.blocks:
+            for l in b.codes:
+                r = self.instruction(l)
+                if r is not None:
+                    records.append(r)
+                if isinstance(l, LLVMCodeAlloca) or l.getDef() is not None:
+                    self.inst += 1
+        return records
+
+    def instruction(self, l:LLVMCode):
+        ''' 命令 l の記録 '''
+        m = self.module
+        ops = []
+        if isinstance(l, LLVMCodeAlloca):
+            return INST_ALLOCA, [m.typeId(I32), m.typeId(I32), m.constant(('int', I32, 1)), ALIGN4 | 64]
+        if isinstance(l, (LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul, LLVMCodeDiv,
+                          LLVMCodeShl, LLVMCodeAshr, LLVMCodeAnd)):
+            op = {LLVMCodeAdd: 'add', LLVMCodeSub: 'sub', LLVMCodeMul: 'mul', LLVMCodeDiv: 'sdiv',
+                  LLVMCodeShl: 'shl', LLVMCodeAshr: 'ashr', LLVMCodeAnd: 'and'}[type(l)]
+            self.pushTyped(ops, l.arg1, I32)
+            self.push(ops, l.arg2, I32)
+            ops.append(BINOP[op])
+            flags = (1 if getattr(l, 'nuw', False) else 0) | (2 if getattr(l, 'nsw', False) else 0)
+            if flags:
+                ops.append(flags)
+            return INST_BINOP, ops
+        if isinstance(l, LLVMCodeVecBinOp):
+            t = vector(l.width)
+            words = l.op.split()
+            self.pushTyped(ops, l.arg1, t)
+            self.push(ops, l.arg2, t)
+            ops.append(BINOP[words[0]])
+            flags = (1 if 'nuw' in words else 0) | (2 if 'nsw' in words else 0)
+            if flags:
+                ops.append(flags)
+            return INST_BINOP, ops
+        if isinstance(l, LLVMCodeIcmp):
+            self.pushTyped(ops, l.arg1, I32)
+            self.push(ops, l.arg2, I32)
+            ops.append(ICMP[l.cond])
+            return INST_CMP2, ops
+        if isinstance(l, LLVMCodeSext):
+            self.pushTyped(ops, l.v, I32)
+            return INST_CAST, ops + [m.typeId(I64), CAST_ZEXT if l.zext else CAST_SEXT]
+        if isinstance(l, LLVMCodeBitcast):
+            self.pushTyped(ops, l.ptr, ptr(I32))
+            return INST_CAST, ops + [m.typeId(ptr(vector(l.width))), CAST_BITCAST]
+        if isinstance(l, LLVMCodeLoad):
+            self.pushTyped(ops, l.ptr, ptr(I32))
+            return INST_LOAD, ops + [m.typeId(I32), ALIGN4, 0]
+        if isinstance(l, LLVMCodeVecLoad):
+            t = vector(l.width)
+            self.pushTyped(ops, l.ptr, ptr(t))
+            return INST_LOAD, ops + [m.typeId(t), ALIGN4, 0]
+        if isinstance(l, LLVMCodeStore):
+            self.pushTyped(ops, l.ptr, ptr(I32))
+            self.pushTyped(ops, l.argval, I32)
+            return INST_STORE, ops + [ALIGN4, 0]
+        if isinstance(l, LLVMCodeVecStore):
+            t = vector(l.width)
+            self.pushTyped(ops, l.ptr, ptr(t))
+            self.pushTyped(ops, l.argval, t)
+            return INST_STORE, ops + [ALIGN4, 0]
+        if isinstance(l, LLVMCodeGetelementptr):
+            size = int(l.size)
+            idx = I64 if l.idxtype == 'i64' else I32
+            if l.offset == 0:
+                ops = [1, m.typeId(array(size, I32))]
+                self.pushTyped(ops, Operand(OType.GLOBAL_VAR, name=l.name), None)
+                self.pushConstant(ops, ('int', I64, 0))
+                self.pushTyped(ops, l.ptr, idx)
+                return INST_GEP, ops
+            inbounds = 1 if 0 <= l.offset <= size else 0
+            ops = [inbounds, m.typeId(I32)]
+            self.pushConstant(ops, m.offsetBase(l.name, size, l.offset))
+            self.pushTyped(ops, l.ptr, idx)
+            return INST_GEP, ops
+        if isinstance(l, LLVMCodePtrAdd):
+            ops = [1, m.typeId(I32)]
+            self.pushTyped(ops, l.base, ptr(I32))
+            self.pushTyped(ops, l.offset, I64)
+            return INST_GEP, ops
+        if isinstance(l, LLVMCodeInsertElement):
+            t = vector(l.width)
+            self.pushConstant(ops, ('undef', t))
+            self.push(ops, l.val, I32)
+            self.pushConstant(ops, ('int', I32, 0))
+            return INST_INSERTELT, ops
+        if isinstance(l, LLVMCodeSplat):
+            t = vector(l.width)
+            self.pushTyped(ops, l.vec, t)
+            ops.append((self.inst - m.constant(('undef', t))) & 0xFFFFFFFF)
+            ops.append((self.inst - m.constant(('null', t))) & 0xFFFFFFFF)
+            return INST_SHUFFLEVEC, ops
+        if isinstance(l, LLVMCodePhi):
+            t = self.typeOf(l)
+            ops = [m.typeId(t)]
+            for v, lab in l.incoming:
+                d = self.inst - self.valueId(v, t)
+                ops += [signed(d), self.bbid[lab]]
+            return INST_PHI, ops
+        if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+            f = m.functions[l.name]
+            ops = [0, 1 << 15, m.typeId(f)]
+            self.pushTyped(ops, Operand(OType.GLOBAL_VAR, name=l.name), None)
+            for x in l.arg:
+                self.push(ops, x, I32)
+            return INST_CALL, ops
+        if isinstance(l, LLVMCodeCallPrintf):
+            ops = [0, 1 << 15, m.typeId(PRINTF_TYPE)]
+            self.pushTyped(ops, Operand(OType.GLOBAL_VAR, name='printf'), None)
+            self.pushConstant(ops, m.format('.str.w'))
+            self.pushTyped(ops, l.arg, I32)
+            return INST_CALL, ops
+        if isinstance(l, LLVMCodeCallScanf):
+            ops = [0, 1 << 15, m.typeId(PRINTF_TYPE)]
+            self.pushTyped(ops, Operand(OType.GLOBAL_VAR, name='scanf'), None)
+            self.pushConstant(ops, m.format('.str.r'))
+            self.pushTyped(ops, l.arg, ptr(I32))
+            return INST_CALL, ops
+        if isinstance(l, LLVMCodeRet):
+            if l.val is not None:
+                self.pushTyped(ops, l.val, I32)
+            return INST_RET, ops
+        if isinstance(l, LLVMCodeJ):
+            return INST_BR, [self.bbid[l.arg1]]
+        if isinstance(l, LLVMCodeBr):
+            ops = [self.bbid[l.arg1], self.bbid[l.arg2]]
+            self.push(ops, l.cond, I1)
+            return INST_BR, ops
+        raise NotImplementedError(f"bitcode: unsupported instruction: {l}")
+
+    def pushConstant(self, ops:list, c:tuple):
+        ops.append((self.inst - self.module.constant(c)) & 0xFFFFFFFF)
+
+    def symbols(self) -> list:
+        ''' 関数内の値の名前の記録（名前付きレジスタとラベル） '''
+        records = []
+        for x, v in self.ids.items():
+            if x.type == OType.NAMED_REG:
+                records.append((1, [v] + chars(x.name)))          # VST_ENTRY
+        for b in self.blocks:
+            if b.label is not None:
+                records.append((2, [self.bbid[b.label]] + chars(str(b.label))))   # VST_BBENTRY
+        return records
+
+
+class Module(object):
+    '''
+    ビットコードで出力するモジュール
+        decls    : 大域変数の定義（LLVMCodeGlobal・LLVMCodeGlobalArray のリスト）
+        fundefs  : 関数定義のリスト
+        useWrite : printf を使うか
+        useRead  : scanf を使うか
+    '''
+
+    def __init__(self, decls:list, fundefs, useWrite:bool, useRead:bool):
+        self.types = {}
+        self.constants = {}
+        self.globals = []       # (名前, 値の型, 初期値の定数, linkage, 境界の log2+1, 定数か)
+        self.functions = {}     # 関数名 → 関数型
+        self.fundefs = fundefs
+        self.attrsets = []      # 関数属性の組のリスト
+        for g in decls:
+            if isinstance(g, LLVMCodeGlobalArray):
+                t = array(int(g.size), I32)
+                self.globals.append((g.name, t, ('null', t), 8, 5, False))
+            else:
+                self.globals.append((g.name, I32, ('null', I32), 8, 3, False))
+        for name, used, text in [('.str.w', useWrite, "%d\n"), ('.str.r', useRead, "%d")]:
+            if used:
+                t = array(len(text) + 1, I8)
+                self.globals.append((name, t, ('cstring', t, text), 9, 1, True))
+        for f in fundefs:
+            ret = I32 if f.rettype == 'i32' else VOID
+            self.functions[f.name] = function(ret, [I32] * len(f.params))
+        for name, used in [('printf', useWrite), ('scanf', useRead)]:
+            if used:
+                self.functions[name] = PRINTF_TYPE
+        self.names = [g[0] for g in self.globals] + list(self.functions)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        for g in self.globals:
+            self.typeId(g[1])
+            self.constant(g[2])
+        for t in self.functions.values():
+            self.typeId(t)
+        # 1回目の符号化で型と定数を集める
+        self.encoders = [FunctionEncoder(self, f) for f in fundefs]
+        for e in self.encoders:
+            e.encode()
+        for f in fundefs:
+            self.attributes(f)
+
+    def typeId(self, t:tuple) -> int:
+        ''' 型 t の番号（要素の型から順に登録する） '''
+        if t not in self.types:
+            if t[0] in ('ptr',):
+                self.typeId(t[1])
+            elif t[0] in ('array', 'vector'):
+                self.typeId(t[2])
+            elif t[0] == 'function':
+                self.typeId(t[1])
+                for p in t[2]:
+                    self.typeId(p)
+            self.types[t] = len(self.types)
+        return self.types[t]
+
+    def nvalues(self) -> int:
+        ''' 大域の値（大域変数・関数・定数）の数 '''
+        return len(self.names) + len(self.constants)
+
+    def globalId(self, name:str) -> int:
+        return self.ids[name]
+
+    def constant(self, c:tuple) -> int:
+        ''' 定数 c の値の番号（('int', 型, 値)，('null', 型)，('undef', 型)，('data', 型, 値の組)，
+            ('cstring', 型, 文字列)，('gep', 配列型, 大域変数名, 添字) のいずれか） '''
+        if c not in self.constants:
+            if c[0] == 'gep':
+                self.constant(('int', I64, 0))
+                self.constant(('int', I64, c[3]))
+                self.typeId(ptr(c[1]))
+                self.typeId(ptr(c[1][2]))
+            self.typeId(c[1])
+            self.constants[c] = len(self.names) + len(self.constants)
+        return self.constants[c]
+
+    def offsetBase(self, name:str, size:int, offset:int) -> tuple:
+        ''' 配列 name の先頭を offset 要素ずらした番地の定数式 '''
+        return ('gep', array(size, I32), name, offset)
+
+    def format(self, name:str) -> tuple:
+        ''' 書式文字列 name の先頭の番地の定数式 '''
+        t = next(g[1] for g in self.globals if g[0] == name)
+        return ('gep', t, name, 0)
+
+    def attributes(self, f) -> int:
+        ''' 関数 f の属性の組の番号（属性がなければ 0） '''
+        if not f.attrs:
+            return 0
+        key = tuple(f.attrs)
+        if key not in self.attrsets:
+            self.attrsets.append(key)
+        return self.attrsets.index(key) + 1
+
+    ##
+    ## 出力
+    ##
+
+    def write(self, fp):
+        ''' モジュールをビットコードとしてバイナリのファイル fp に書き出す '''
+        w = BitWriter()
+        for c in b'BC\xc0\xde':
+            w.emit(c, 8)
+        # 識別ブロック
+        w.enterBlock(IDENTIFICATION_BLOCK, 5)
+        w.record(1, chars("PL compiler"))       # STRING
+        w.record(2, [0])                        # EPOCH
+        w.endBlock()
+        # 2回目の符号化で記録を作る（型と定数は1回目で出そろっている）
+        n = len(self.constants)
+        bodies = [(e, e.encode()) for e in self.encoders]
+        assert len(self.constants) == n
+        w.enterBlock(MODULE_BLOCK, 3)
+        w.record(1, [2])                        # VERSION
+        self.writeTypes(w)
+        self.writeAttributes(w)
+        strtab = b""
+        for name, t, init, linkage, align, const in self.globals:
+            ops = [len(strtab), len(name.encode()), self.typeId(t), 2 | int(const),
+                   self.constants[init] + 1, linkage, align, 0, 0, 0, int(const)]
+            w.record(7, ops)                    # GLOBALVAR
+            strtab += name.encode()
+        for name, t in self.functions.items():
+            f = next((f for f in self.fundefs if f.name == name), None)
+            proto = int(f is None)
+            attrs = 0 if f is None else self.attributes(f)
+            ops = [len(strtab), len(name.encode()), self.typeId(t), 0, proto, 0, attrs,
+                   0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+            w.record(8, ops)                    # FUNCTION
+            strtab += name.encode()
+        self.writeConstants(w)
+        for e, records in bodies:
+            w.enterBlock(FUNCTION_BLOCK)
+            w.record(1, [len(e.blocks)])        # DECLAREBLOCKS
+            for code, ops in records:
+                w.record(code, ops)
+            symbols = e.symbols()
+            if symbols:
+                w.enterBlock(VALUE_SYMTAB_BLOCK)
+                for code, ops in symbols:
+                    w.record(code, ops)
+                w.endBlock()
+            w.endBlock()
+        w.endBlock()
+        w.enterBlock(STRTAB_BLOCK, 3)
+        w.blob(1, strtab)                       # STRTAB_BLOB
+        w.endBlock()
+        fp.write(w.getvalue())
+
+    def writeTypes(self, w:BitWriter):
+        w.enterBlock(TYPE_BLOCK)
+        w.record(1, [len(self.types)])          # NUMENTRY
+        for t in self.types:
+            if t[0] == 'int':
+                w.record(7, [t[1]])
+            elif t[0] == 'ptr':
+                w.record(8, [self.types[t[1]], 0])
+            elif t[0] == 'array':
+                w.record(11, [t[1], self.types[t[2]]])
+            elif t[0] == 'vector':
+                w.record(12, [t[1], self.types[t[2]]])
+            elif t[0] == 'function':
+                w.record(21, [int(t[3]), self.types[t[1]]] + [self.types[p] for p in t[2]])
+            elif t[0] == 'void':
+                w.record(2, [])
+            elif t[0] == 'label':
+                w.record(5, [])
+        w.endBlock()
+
+    def writeAttributes(self, w:BitWriter):
+        sets = self.attrsets
+        if not sets:
+            return
+        w.enterBlock(PARAMATTR_GROUP_BLOCK, 3)
+        for i, attrs in enumerate(sets):
+            ops = [i + 1, 0xFFFFFFFF]
+            for a in attrs:
+                ops += [0, ATTR_KIND[a]]
+            w.record(3, ops)                    # PARAMATTR_GRP_CODE_ENTRY
+        w.endBlock()
+        w.enterBlock(PARAMATTR_BLOCK, 3)
+        for i in range(len(sets)):
+            w.record(2, [i + 1])                # PARAMATTR_CODE_ENTRY
+        w.endBlock()
+
+    def writeConstants(self, w:BitWriter):
+        w.enterBlock(CONSTANTS_BLOCK)
+        cur = None
+        for c in self.constants:
+            t = c[1] if c[0] != 'gep' else ptr(c[1][2])
+            if t != cur:
+                w.record(1, [self.types[t]])    # SETTYPE
+                cur = t
+            if c[0] == 'int':
+                v = c[2]
+                if t == I1:
+                    v = -1 if v else 0
+                w.record(4, [signed(v)])        # INTEGER
+            elif c[0] == 'null':
+                w.record(2, [])                 # NULL
+            elif c[0] == 'undef':
+                w.record(3, [])                 # UNDEF
+            elif c[0] == 'data':
+                w.record(22, [v & 0xFFFFFFFF for v in c[2]])     # DATA
+            elif c[0] == 'cstring':
+                w.record(9, chars(c[2]))        # CSTRING
+            elif c[0] == 'gep':
+                at = c[1]
+                ops = [self.types[at], self.types[ptr(at)], self.ids[c[2]],
+                       self.types[I64], self.constants[('int', I64, 0)],
+                       self.types[I64], self.constants[('int', I64, c[3])]]
+                inbounds = 0 <= c[3] <= at[1]
+                w.record(20 if inbounds else 12, ops)   # CE_INBOUNDS_GEP / CE_GEP
+        w.endBlock()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from fundef import Fundef
+from llvmcode import *
+from operand import OType, Operand
+import stats
+
+##
+## プログラム全体の呼び出しグラフと，それを使った手続き間の最適化
+##   - main から到達できない手続き・関数の削除
+##   - すべての呼び出しで同じ定数が渡される仮引数の除去（定数で置き換える）
+##   - ループ内の呼び出しで定数が渡される小さな関数の複製（定数を埋め込んだ版を作る）
+##   - main からしか使われない大域変数の局所変数化（main の alloca にする）
+##
+
+
+class CallGraph(object):
+    '''
+    呼び出しグラフクラス
+        sites[name] : 関数 name を呼び出す (呼び出し元の Fundef, 呼び出し命令) のリスト
+        callees[name] : 関数 name が呼び出す関数名の集合
+        parallel : 並列化したループの本体として実行時ライブラリから呼ばれる関数名の集合
+    '''
+
+    def __init__(self, fundefs):
+        self.fundefs = fundefs
+        self.table = {f.name: f for f in fundefs}
+        self.sites = {f.name: [] for f in fundefs}
+        self.callees = {f.name: set() for f in fundefs}
+        self.parallel = set()
+        for f in fundefs:
+            for l in f.codes:
+                if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                    self.callees[f.name].add(l.name)
+                    self.sites.setdefault(l.name, []).append((f, l))
+                elif isinstance(l, LLVMCodeCallParallel):
+                    self.callees[f.name].add(l.name)
+                    self.parallel.add(l.name)
+
+    def reachable(self, root:str='main') -> set:
+        ''' root から呼び出されうる関数名の集合（root を含む） '''
+        seen = set()
+        work = [root]
+        while work:
+            name = work.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            work.extend(self.callees.get(name, ()))
+        return seen
+
+
+def removeDead(fundefs) -> int:
+    ''' main から到達できない関数定義を取り除き，取り除いた数を返す '''
+    live = CallGraph(fundefs).reachable()
+    dead = [f for f in fundefs if f.name not in live]
+    fundefs[:] = [f for f in fundefs if f.name in live]
+    stats.count('callgraph', 'removed subprograms', len(dead))
+    return len(dead)
+
+
+def globalUsers(fundefs) -> dict:
+    ''' 大域変数名 → それを使う関数名の集合 '''
+    users = {}
+    for f in fundefs:
+        for l in f.codes:
+            for x in l.getUses():
+                if isinstance(x, Operand) and x.type == OType.GLOBAL_VAR:
+                    users.setdefault(x.name, set()).add(f.name)
+    return users
+
+
+def demoteMainGlobals(fundefs) -> int:
+    '''
+    main からしか使われない大域変数を main の局所変数（alloca）に置き換え，置き換えた数を返す
+    大域変数は 0 で初期化されているので，main の先頭で 0 を書き込んでおく
+    '''
+    main = next((f for f in fundefs if f.name == 'main'), None)
+    if main is None:
+        return 0
+    names = [name for name, users in globalUsers(fundefs).items() if users == {'main'}]
+    if not names:
+        return 0
+    taken = {l.name for l in main.codes if isinstance(l, LLVMCodeAlloca)}
+    for l in main.codes:
+        taken |= {x.name for x in l.getUses() if isinstance(x, Operand) and x.type == OType.NAMED_REG}
+    valmap = {}
+    allocas = []
+    stores = []
+    for name in names:
+        local = name
+        k = 1
+        while local in taken:
+            local = f"{name}.{k}"
+            k += 1
+        taken.add(local)
+        ptr = Operand(OType.NAMED_REG, name=local)
+        valmap[Operand(OType.GLOBAL_VAR, name=name)] = ptr
+        allocas.append(LLVMCodeAlloca(local))
+        stores.append(LLVMCodeStore(Operand(OType.CONSTANT, val=0), ptr))
+    for l in main.codes:
+        l.mapUses(lambda x: valmap.get(x, x))
+    main.codes[0:0] = allocas + stores
+    stats.count('callgraph', 'globals demoted to locals', len(names))
+    return len(names)
+
+
+def substituteParams(fundef, consts:dict):
+    ''' 仮引数 → 定数 の表 consts に従って仮引数を定数に置き換え，仮引数の並びから除く '''
+    for l in fundef.codes:
+        l.mapUses(lambda x: consts.get(x, x))
+    fundef.params = [p for p in fundef.params if p not in consts]
+
+
+def propagateConstantArgs(fundefs) -> int:
+    ''' すべての呼び出しで同じ定数が渡される仮引数を定数に置き換え，置き換えた仮引数の数を返す '''
+    graph = CallGraph(fundefs)
+    n = 0
+    for f in fundefs:
+        sites = graph.sites.get(f.name, [])
+        if f.name == 'main' or f.name in graph.parallel or not sites:
+            continue
+        if any(len(call.arg) != len(f.params) for _, call in sites):
+            continue
+        consts = {}
+        drop = []
+        for i, p in enumerate(f.params):
+            args = {call.arg[i] for _, call in sites}
+            if len(args) == 1:
+                a = args.pop()
+                if a.isConst():
+                    consts[p] = a
+                    drop.append(i)
+        if not consts:
+            continue
+        substituteParams(f, consts)
+        for _, call in sites:
+            call.arg = [a for i, a in enumerate(call.arg) if i not in drop]
+        n += len(consts)
+    stats.count('callgraph', 'constant parameters propagated', n)
+    return n
+
+
+def cloneFundef(f, name:str) -> Fundef:
+    ''' 関数定義 f を名前 name で複製する '''
+    g = Fundef(name, f.rettype)
+    g.codes = [l.clone() for l in f.codes]
+    g.cntr = f.cntr
+    g.lcount = f.lcount
+    g.params = list(f.params)
+    return g
+
+
+def specializeHotCalls(fundefs, maxsize:int, maxclones:int) -> int:
+    '''
+    ループ内の呼び出しで定数を渡している，命令数 maxsize 以下の関数について
+    その定数を埋め込んだ複製を作り，呼び出し先を付け替える．作った複製の数を返す
+    '''
+    if maxsize <= 0:
+        return 0
+    graph = CallGraph(fundefs)
+    clones = {}
+    for f in list(fundefs):
+        cfg = CFG(f)
+        hot = set()
+        for loop in cfg.findLoops():
+            hot |= loop.blocks
+        # 複製の番号と作る順序が毎回同じになるよう，ブロックは CFG の順にたどる
+        for b in cfg.blocks:
+            if b not in hot:
+                continue
+            for call in b.codes:
+                if not isinstance(call, (LLVMCodeCall, LLVMCodeCallVoid)):
+                    continue
+                callee = graph.table.get(call.name)
+                if callee is None or callee is f or len(call.arg) != len(callee.params):
+                    continue
+                if not any(a.isConst() for a in call.arg):
+                    continue
+                size = sum(1 for l in callee.codes if not isinstance(l, LLVMCodeLabel))
+                if size > maxsize:
+                    continue
+                key = (callee.name, tuple(a.val if a.isConst() else None for a in call.arg))
+                if key not in clones:
+                    if len(clones) >= maxclones:
+                        continue
+                    g = cloneFundef(callee, f"{callee.name}.{len(clones) + 1}")
+                    substituteParams(g, {p: a for p, a in zip(g.params, call.arg) if a.isConst()})
+                    siblings = sum(1 for k in clones if k[0] == callee.name)
+                    fundefs.insert(fundefs.index(callee) + 1 + siblings, g)
+                    clones[key] = g
+                call.name = clones[key].name
+                call.arg = [a for a in call.arg if not a.isConst()]
+    stats.count('callgraph', 'specialized clones', len(clones))
+    return len(clones)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import Labels, LLVMCodeLabel, LLVMCodeJ, LLVMCodePhi
+from operand import OType, Operand
+
+
+class BasicBlock(object):
+    '''
+    基本ブロッククラス
+        label : ブロック先頭のラベル（入口ブロックは None）
+        codes : ラベル命令を除いた命令列（最後が終端命令）
+    '''
+
+    def __init__(self, label:Labels):
+        self.label = label
+        self.codes = []
+        self.preds = []
+        self.succs = []
+
+    def terminator(self):
+        ''' 終端命令 '''
+        return self.codes[-1]
+
+    def insertBeforeTerminator(self, l):
+        ''' 終端命令の直前に命令 l を挿入 '''
+        self.codes.insert(len(self.codes) - 1, l)
+
+    def phis(self) -> list:
+        ''' ブロック先頭の phi 命令のリスト '''
+        r = []
+        for l in self.codes:
+            if not isinstance(l, LLVMCodePhi):
+                break
+            r.append(l)
+        return r
+
+    def __repr__(self):
+        return f"<{self.label if self.label is not None else 'entry'}>"
+
+
+class Loop(object):
+    '''
+    自然ループクラス
+        header : ループヘッダ（BasicBlock）
+        blocks : ループを構成するブロックの集合
+        latches: ヘッダへの後退辺を持つブロックのリスト
+        parent : 外側のループ（なければ None）
+    '''
+
+    def __init__(self, header:BasicBlock):
+        self.header = header
+        self.blocks = {header}
+        self.latches = []
+        self.parent = None
+        self.children = []
+
+    def exits(self) -> list:
+        ''' ループの外にある後続ブロックのリスト '''
+        r = []
+        for b in self.blocks:
+            for s in b.succs:
+                if s not in self.blocks and s not in r:
+                    r.append(s)
+        return r
+
+    def outsidePreds(self) -> list:
+        ''' ヘッダのループ外の先行ブロックのリスト '''
+        return [p for p in self.header.preds if p not in self.blocks]
+
+    def depth(self) -> int:
+        d = 1
+        l = self.parent
+        while l is not None:
+            d += 1
+            l = l.parent
+        return d
+
+
+class CFG(object):
+    '''
+    制御フローグラフクラス
+        関数定義の命令列を基本ブロックに分割し，支配関係や自然ループを求める．
+        変形後は flatten() で関数定義の命令列に書き戻す．
+    '''
+
+    def __init__(self, fundef):
+        self.fundef = fundef
+        self.blocks = []
+        b = BasicBlock(None)
+        self.blocks.append(b)
+        for l in fundef.codes:
+            if isinstance(l, LLVMCodeLabel):
+                b = BasicBlock(l.arg1)
+                self.blocks.append(b)
+            else:
+                b.codes.append(l)
+        self.link()
+
+    def entry(self) -> BasicBlock:
+        return self.blocks[0]
+
+    def link(self):
+        ''' 終端命令から先行・後続関係を求め直す '''
+        self.bylabel = {}
+        for b in self.blocks:
+            if b.label is not None:
+                self.bylabel[b.label] = b
+            b.preds = []
+            b.succs = []
+        for b in self.blocks:
+            if not b.codes or not b.terminator().isTerminator():
+                continue
+            for t in b.terminator().getTargets():
+                s = self.bylabel[t]
+                if s not in b.succs:
+                    b.succs.append(s)
+                    s.preds.append(b)
+        self.idom = None
+
+    def blockOf(self, label:Labels) -> BasicBlock:
+        return self.bylabel[label]
+
+    def flatten(self):
+        ''' 基本ブロック列を関数定義の命令列に書き戻す '''
+        codes = []
+        for b in self.blocks:
+            if b.label is not None:
+                codes.append(LLVMCodeLabel(b.label))
+            codes.extend(b.codes)
+        self.fundef.codes = codes
+
+    def newBlock(self, before:BasicBlock=None) -> BasicBlock:
+        ''' 新しいラベルを持つ空のブロックを before の直前（省略時は末尾）に追加 '''
+        b = BasicBlock(Labels(self.fundef.getNewLab()))
+        if before is None:
+            self.blocks.append(b)
+        else:
+            self.blocks.insert(self.blocks.index(before), b)
+        return b
+
+    def rpo(self) -> list:
+        ''' 入口から到達可能なブロックの逆後順 '''
+        seen = set()
+        order = []
+        stack = [(self.entry(), iter(self.entry().succs))]
+        seen.add(self.entry())
+        while stack:
+            b, it = stack[-1]
+            for s in it:
+                if s not in seen:
+                    seen.add(s)
+                    stack.append((s, iter(s.succs)))
+                    break
+            else:
+                stack.pop()
+                order.append(b)
+        order.reverse()
+        return order
+
+    def dominators(self) -> dict:
+        ''' 直接支配ブロックの表（Cooper-Harvey-Kennedy の反復法） '''
+        if self.idom is not None:
+            return self.idom
+        order = self.rpo()
+        index = {b: i for i, b in enumerate(order)}
+        entry = self.entry()
+        idom = {entry: entry}
+
+        def intersect(a, b):
+            while a is not b:
+                while index[a] > index[b]:
+                    a = idom[a]
+                while index[b] > index[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in order[1:]:
+                new = None
+                for p in b.preds:
+                    if p in idom:
+                        new = p if new is None else intersect(p, new)
+                if idom.get(b) is not new:
+                    idom[b] = new
+                    changed = True
+        self.idom = idom
+        return idom
+
+    def dominates(self, a:BasicBlock, b:BasicBlock) -> bool:
+        ''' a が b を支配するか '''
+        idom = self.dominators()
+        if b not in idom:
+            return False
+        while True:
+            if a is b:
+                return True
+            if idom[b] is b:
+                return False
+            b = idom[b]
+
+    def findLoops(self) -> list:
+        ''' 自然ループを求め，内側のループが先に来る順に返す '''
+        loops = {}
+        for b in self.rpo():
+            for h in b.succs:
+                if not self.dominates(h, b):
+                    continue
+                loop = loops.setdefault(h, Loop(h))
+                loop.latches.append(b)
+                work = [b]
+                while work:
+                    x = work.pop()
+                    if x in loop.blocks or x not in self.idom:
+                        continue
+                    loop.blocks.add(x)
+                    work.extend(x.preds)
+        result = sorted(loops.values(), key=lambda l: len(l.blocks))
+        for i, l in enumerate(result):
+            for m in result[i + 1:]:
+                if l.header in m.blocks and m is not l:
+                    l.parent = m
+                    m.children.append(l)
+                    break
+        return result
+
+    def ensurePreheader(self, loop:Loop) -> BasicBlock:
+        ''' ループのプリヘッダ（ヘッダへ無条件分岐するだけのループ外の唯一の先行ブロック）を用意する '''
+        header = loop.header
+        outside = loop.outsidePreds()
+        if len(outside) == 1 and len(outside[0].succs) == 1 and outside[0].label is not None:
+            return outside[0]
+        pre = self.newBlock(before=header)
+        pre.codes.append(LLVMCodeJ(header.label))
+        for p in outside:
+            p.terminator().retarget(header.label, pre.label)
+        # ヘッダの phi のうちループ外からの入力をプリヘッダにまとめる
+        labels = [p.label for p in outside]
+        for phi in header.phis():
+            inner = [(v, l) for v, l in phi.incoming if l not in labels]
+            outer = [(v, l) for v, l in phi.incoming if l in labels]
+            if len(outer) == 1:
+                v = outer[0][0]
+            else:
+                v = Operand(OType.NUMBERED_REG, val=self.fundef.getNewRegNo())
+                pre.codes.insert(0, LLVMCodePhi(v, outer))
+            phi.incoming = [(v, pre.label)] + inner
+        self.link()
+        # 外側のループにもプリヘッダを含める
+        l = loop.parent
+        while l is not None:
+            l.blocks.add(pre)
+            l = l.parent
+        return pre
@@ -0,0 +1,31 @@
+program cl;
+var s, i, j, a[0..99];
+function add(x, y);
+begin
+    add := x + y
+end;
+function mul3(x, y, z);
+var t;
+begin
+    t := x * y;
+    mul3 := t + z
+end;
+procedure fill(n, v);
+var k;
+begin
+    for k := 0 to n do a[k] := a[k] + v
+end;
+begin
+    read(s);
+    for i := 0 to 50 do
+    begin
+        s := add(s, 3);
+        if i > 10 then s := add(s, 7) else s := add(i, 5);
+        while s > 1000 do s := add(s, 0 - 900);
+        s := mul3(s, 2, 1) - mul3(i, 3, 4);
+        fill(i, 2);
+        for j := 0 to 3 do s := s + add(j, 9) + mul3(j, 5, 6)
+    end;
+    write(s);
+    write(a[10])
+end.
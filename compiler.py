@@ -2,16 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import argparse
 
 import ply.lex as lex
 import ply.yacc as yacc
 
-import math
 
 from symtab import Scope, Symbol, SymbolTable
 from fundef import Fundef
 from llvmcode import *
 from operand import OType, Operand
+from optimizer import optimize, OptOptions
+import modref
+import bitcode
+import callgraph
+import driver
+import fastio
+import funcattrs
+import parallel
+import peephole
+import pgo
+import rtprof
+import split
+import stats
+import vrange
+import x86
 
 ## トークン名のリスト
 tokens = (
@@ -102,10 +117,24 @@ def t_error(t):
 symtable = SymbolTable()
 varscope = Scope.GLOBAL_VAR
 
-fundefs = []				# 生成した関数定義（Fundef）のリスト
+fundefs = []				# 生成した関数定義（Fundef）のリスト（逐次出力した関数は取り除く）
+summaries = {}				# 定義し終えた関数名 → 副作用情報（modref.ModRef）
 
 useWrite = False			# write関数が使用されているかのフラグ
 useRead  = False			# read関数が使用されているかのフラグ
+syntaxError = False			# 構文エラーがあったかのフラグ
+
+options = OptOptions()		# 最適化の設定（-O など）
+showStats = False			# 最適化の統計情報を表示するかのフラグ（--stats）
+fastIO = False				# バッファを使う入出力の実行時ライブラリを使うかのフラグ（--fast-io）
+instrumentFile = None		# 実行回数カウンタを書き出すファイル名（--instrument）
+profileFile = None			# 最適化に使うプロファイルのファイル名（--profile-use）
+profileRuntime = False		# 関数ごとの実行時間を計測して終了時に表示するかのフラグ（--profile-runtime）
+backend = 'llvm'			# コード生成の方法（--backend，'llvm' なら result.ll，'x86' なら result.s を出力）
+emit = 'll'					# 出力形式（--emit，'ll' ならテキスト，'bc' ならビットコード，'obj'・'exe' ならバックエンドで変換）
+build = None				# 出力先とバックエンドを扱うビルドドライバ
+splitModules = 1			# 出力を分けるモジュールの数（--split-modules）
+streaming = False			# 関数定義を還元したらすぐに出力するかのフラグ（プログラム全体を見る処理がないとき）
 
 def addCode(l:LLVMCode):
     ''' 現在の関数定義オブジェクトの codes に命令 l を追加 '''
@@ -121,6 +150,78 @@ def getLabel():
 def addParam(l):
     fundefs[-1].params.append(l)
 
+def finishFunction():
+    ''' 現在の関数定義を生成し終えたときの処理
+            副作用情報を求めておき，逐次出力するならすぐに書き出して関数定義を手放す
+    '''
+    f = fundefs[-1]
+    if options.level == 0:
+        # 最適化なしでも 2 のべきの乗除算はシフトにする（-O1 以上では最後ののぞき穴最適化で行う）
+        peephole.sweep(f, peephole.STRENGTH_RULES)
+    summaries[f.name] = modref.summarize(f, summaries)
+    if streaming:
+        f.renumber()
+        f.print(build.open())
+        fundefs.pop()
+        stats.count('stream', 'functions emitted early')
+
+def findDef(x:Operand) -> LLVMCode:
+    ''' 現在の関数でレジスタ x を定義する命令（直前から逆順に探す） '''
+    if x.type != OType.NUMBERED_REG:
+        return None
+    for l in reversed(fundefs[-1].codes):
+        if l.getDef() == x:
+            return l
+    return None
+
+def isNonNegative(x:Operand) -> bool:
+    ''' 値 x が負にならないことが生成したコードから分かるか '''
+    if x.type == OType.CONSTANT:
+        return x.val >= 0
+    l = findDef(x)
+    if isinstance(l, (LLVMCodeAdd, LLVMCodeMul)):
+        return isNonNegative(l.arg1) and isNonNegative(l.arg2)
+    if isinstance(l, LLVMCodeAshr):
+        return isNonNegative(l.arg1)
+    if isinstance(l, LLVMCodeDiv):
+        return isNonNegative(l.arg1) and l.arg2.type == OType.CONSTANT and l.arg2.val > 0
+    return False
+
+def arrayElementPtr(t:Symbol, index:Operand) -> Operand:
+    ''' 配列 t の要素 t[index] の番地を求めるコードを生成し，番地のレジスタを返す
+            添字の定数部分と下限は getelementptr の定数オフセットに畳み込む
+    '''
+    size = t.index[1] - t.index[0] + 1
+    offset = -t.index[0]
+
+    # 添字が「式 ± 定数」なら加減算を取り除いて定数をオフセットに加える
+    # （式の値は1度しか使われないので加減算の命令は不要になる）
+    l = findDef(index)
+    if isinstance(l, LLVMCodeAdd) and l.arg2.type == OType.CONSTANT:
+        index, offset = l.arg1, offset + l.arg2.val
+    elif isinstance(l, LLVMCodeAdd) and l.arg1.type == OType.CONSTANT:
+        index, offset = l.arg2, offset + l.arg1.val
+    elif isinstance(l, LLVMCodeSub) and l.arg2.type == OType.CONSTANT:
+        index, offset = l.arg1, offset - l.arg2.val
+    else:
+        l = None
+    if l is not None:
+        fundefs[-1].codes.remove(l)
+
+    retval = getRegister()
+    if index.type == OType.CONSTANT:
+        # 定数添字はオフセットまで含めて畳み込む
+        ptr = Operand(OType.CONSTANT, val=index.val + offset)
+        addCode(LLVMCodeGetelementptr(retval, size, t.name, ptr))
+    elif isNonNegative(index):
+        # 非負なら i32 のまま添字にする（sext は不要）
+        addCode(LLVMCodeGetelementptr(retval, size, t.name, index, offset, 'i32'))
+    else:
+        ptr = getRegister()
+        addCode(LLVMCodeSext(ptr, index))
+        addCode(LLVMCodeGetelementptr(retval, size, t.name, ptr, offset))
+    return retval
+
 #################################################################
 # ここから先に構文規則を書く
 #################################################################
@@ -129,27 +230,88 @@ def p_program(p):
     '''
     program : PROGRAM IDENT SEMICOLON outblock PERIOD
     '''
-    with open("result.ll", "w") as fout:
-        # 大域変数ごとに common global 命令を出力
-        for t in symtable.rows:
-            if t.scope == Scope.GLOBAL_VAR:
-                print(LLVMCodeGlobal(t.name), file=fout)
-            elif t.scope == Scope.ARRAY:
-                size = t.index[1] - t.index[0] + 1
-                print(LLVMCodeGlobalArray(t.name, size), file=fout)
-        print('', file=fout)
-
-        # 関数定義を出力
+    # カウンタの挿入とプロファイルの対応付けは最適化前の命令列に対して行う
+    instr = None
+    if instrumentFile is not None:
+        instr = pgo.instrument(fundefs, instrumentFile)
+    profiled = profileFile is not None and pgo.apply(fundefs, profileFile)
+    globals = optimize(fundefs, options)
+    if fastIO:
+        fastio.lower(fundefs)
+    if profiled:
         for f in fundefs:
-            f.print(fout)
-
-        # printfやscanf関数の宣言と書式を表す文字列定義を出力
-        if useWrite:
-            LLVMCodeCallPrintf.printDeclare(fout)
-            LLVMCodeCallPrintf.printFormat(fout)
-        if useRead:
-            LLVMCodeCallScanf.printDeclare(fout)
-            LLVMCodeCallScanf.printFormat(fout)
+            pgo.layout(f)
+    # 実行時プロファイラは最適化後の関数ごとに計測する
+    profiler = None
+    if profileRuntime:
+        profiler = rtprof.instrument(fundefs)
+    for f in fundefs:
+        f.renumber()
+    # 関数属性と別名解析メタデータ（最適化時のみ）
+    tbaa = None
+    if options.level > 0:
+        funcattrs.infer(fundefs)
+        tbaa = funcattrs.TBAA(fundefs)
+    weights = pgo.BranchWeights(fundefs, 0 if tbaa is None else len(tbaa.lines))
+    ranges = vrange.RangeMetadata(fundefs, weights.first + len(weights.lines))
+
+    # 大域変数の定義（最適化で局所変数にした大域変数は出力しない）
+    used = callgraph.globalUsers(fundefs) if options.level > 0 else None
+    decls = []
+    for t in symtable.rows:
+        if t.scope == Scope.GLOBAL_VAR:
+            if used is None or t.name in used:
+                decls.append(LLVMCodeGlobal(t.name))
+        elif t.scope == Scope.ARRAY:
+            size = t.index[1] - t.index[0] + 1
+            decls.append(LLVMCodeGlobalArray(t.name, size))
+    # 最適化で追加した大域変数
+    decls += globals
+
+    if backend == 'x86':
+        x86.printModule(decls, fundefs, useWrite, useRead, build.open())
+    elif emit == 'bc':
+        bitcode.Module(decls, fundefs, useWrite, useRead).write(build.open())
+    else:
+        parts = split.partition(fundefs, splitModules)
+        graph = callgraph.CallGraph(fundefs) if len(parts) > 1 else None
+        for k, part in enumerate(parts):
+            fout = build.open(k, len(parts))
+            # 大域変数ごとに common global 命令を出力（他のモジュールでは external で宣言）
+            for g in decls:
+                print(g if k == 0 else g.declaration(), file=fout)
+            print('', file=fout)
+            if graph is not None:
+                split.printExternals(graph, part, fout)
+
+            # 関数定義を出力
+            for f in part:
+                f.print(fout)
+
+            # printfやscanf関数の宣言と書式を表す文字列定義を出力
+            if fastIO:
+                if useWrite or useRead:
+                    fastio.printRuntime(fout)
+            else:
+                if useWrite:
+                    LLVMCodeCallPrintf.printDeclare(fout)
+                    LLVMCodeCallPrintf.printFormat(fout)
+                if useRead:
+                    LLVMCodeCallScanf.printDeclare(fout)
+                    LLVMCodeCallScanf.printFormat(fout)
+            parallel.printRuntime(fundefs, fout, options.parallelMinChunk)
+            if instr is not None:
+                instr.printRuntime(fout)
+            if profiler is not None:
+                profiler.printRuntime(fout)
+            if tbaa is not None:
+                tbaa.print(fout)
+            weights.print(fout)
+            ranges.print(fout)
+            build.finish(fout)
+    build.close()
+    if showStats:
+        stats.report()
 
 
 def p_outblock(p):
@@ -160,6 +322,7 @@ def p_outblock(p):
 
     # 還元時に「ret i32 0」命令を追加
     addCode(LLVMCodeRet('i32', Operand(OType.CONSTANT, val=0)))
+    finishFunction()
 
 
 def p_outblock_act(p):
@@ -215,6 +378,7 @@ def p_proc_decl(p):
     '''
     addCode(LLVMCodeRet('void'))
     symtable.delete()
+    finishFunction()
 
 def p_proc_decl_act1(p):
     '''
@@ -265,6 +429,7 @@ def p_func_decl(p):
 
     addCode(LLVMCodeRet('i32', val = arg))
     symtable.delete()
+    finishFunction()
 
 def p_func_decl_act1(p):
     '''
@@ -347,21 +512,7 @@ def p_assignment_statement(p):
     elif t.scope == Scope.FUNC:
         ptr = Operand(OType.NAMED_REG, name = t.name)
     elif t.scope == Scope.ARRAY:
-        arg1 = p[3]
-        retval = getRegister()
-        arg2 = t.index[0]
-        addCode(LLVMCodeSub(retval, arg1, arg2))
-        v = retval
-
-        retval = getRegister()
-        addCode(LLVMCodeSext(retval, v))
-        ptr = retval
-
-        retval = getRegister()
-        size = t.index[1] - t.index[0] + 1
-        name = t.name
-        addCode(LLVMCodeGetelementptr(retval, size, name, ptr))
-        ptr = retval
+        ptr = arrayElementPtr(t, p[3])
         sval = p[6]
     addCode(LLVMCodeStore(sval, ptr))
 
@@ -441,56 +592,111 @@ def p_for_statement(p):
     '''
     for_statement : FOR IDENT ASSIGN expression TO expression for_act1 DO statement
     '''
-    
-    arg1 = p[7][2]
-    retval1 = getRegister()
-    addCode(LLVMCodeLoad(retval1, arg1))
-    
-    arg2 = retval1
-    arg3 = Operand(OType.CONSTANT, val = 1)
-    retval2 = getRegister()
-    addCode(LLVMCodeAdd(retval2, arg2, arg3))
-
-    ptr = p[7][2]
-    addCode(LLVMCodeStore(retval2, ptr))
+    # for_act1 の情報: [初期値の store, ガードのラベル, 本体のラベル, 出口のラベル, 制御変数, phi]
+    init, guard, body, exit, ptr, phi = p[7]
+    lower = p[4]
+    upper = p[6]
+
+    latch = getLabel()
+    addCode(LLVMCodeJ(latch))
+    addCode(LLVMCodeLabel(latch))
+
+    start = fundefs[-1].codes.index(phi)
+    if counterIsRegister(ptr, start + 1):
+        # 制御変数をレジスタに置く: 本体中のロードを phi の値で置き換える
+        codes = fundefs[-1].codes
+        loads = {}
+        for l in codes[start + 1:]:
+            if isinstance(l, LLVMCodeLoad) and l.ptr == ptr:
+                loads[l.retval] = phi.retval
+        codes[start + 1:] = [l for l in codes[start + 1:] if l.getDef() not in loads]
+        for l in codes[start + 1:]:
+            l.mapUses(lambda x: loads.get(x, x))
+        codes.remove(init)
+
+        cond = getRegister()
+        addCode(LLVMCodeIcmp(cond, CmpType.SLT, phi.retval, upper))
+        next = getRegister()
+        addCode(LLVMCodeAdd(next, phi.retval, Operand(OType.CONSTANT, val=1)))
+        addCode(LLVMCodeBr(cond, body, exit))
+        phi.addIncoming(lower, guard)
+        phi.addIncoming(next, latch)
+
+        # ループ後の制御変数の値をメモリに書き戻す
+        addCode(LLVMCodeLabel(exit))
+        final = getRegister()
+        addCode(LLVMCodePhi(final, [(lower, guard), (next, latch)]))
+        addCode(LLVMCodeStore(final, ptr))
+    else:
+        fundefs[-1].codes.remove(phi)
 
-    arg4 = p[7][0]
-    arg5 = p[7][1]
-    addCode(LLVMCodeJ(arg4))
-    addCode(LLVMCodeLabel(arg5))
+        retval = getRegister()
+        addCode(LLVMCodeLoad(retval, ptr))
+        cond = getRegister()
+        addCode(LLVMCodeIcmp(cond, CmpType.SLT, retval, upper))
+        next = getRegister()
+        addCode(LLVMCodeAdd(next, retval, Operand(OType.CONSTANT, val=1)))
+        addCode(LLVMCodeStore(next, ptr))
+        addCode(LLVMCodeBr(cond, body, exit))
+        addCode(LLVMCodeLabel(exit))
+
+def counterIsRegister(ptr:Operand, start:int) -> bool:
+    ''' 現在の関数の start 以降（for文の本体）で制御変数 ptr の書き換えや
+        呼び出し先からの参照がなく，レジスタに置けるかどうか '''
+    f = fundefs[-1]
+    # 呼び出せるのは定義し終えた関数（と現在の関数自身）だけなので，その副作用情報で足りる
+    effects = summaries if ptr.type == OType.GLOBAL_VAR else {}
+    for l in f.codes[start:]:
+        if isinstance(l, LLVMCodeStore) and l.ptr == ptr:
+            return False
+        if isinstance(l, LLVMCodeCallScanf) and l.arg == ptr:
+            return False
+        if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)) and ptr.type == OType.GLOBAL_VAR:
+            m = effects.get(l.name)
+            if m is None or ptr.name in m.reads or ptr.name in m.writes:
+                return False
+    return True
 
 def p_for_act1(p):
     '''
     for_act1 : 
     '''
+    # 上限の式はここで1度だけ評価され，ループは末尾で判定する形で生成する
+    #       store lower, ptr
+    #       br G
+    #   G:  c0 = icmp sle lower, upper
+    #       br c0, B, E
+    #   B:  i = phi [lower, G], [next, L]
+    #       ... 本体 ...
+    #   L:  c = icmp slt i, upper ; next = add i, 1 ; br c, B, E
+    #   E:
     t = symtable.lookup(p[-5])
     if t.scope == Scope.GLOBAL_VAR:
         ptr = Operand(OType.GLOBAL_VAR, name=t.name)
     elif t.scope == Scope.LOCAL_VAR:
         ptr = Operand(OType.NAMED_REG, name = t.name)
 
-    arg1 = p[-3]
-    addCode(LLVMCodeStore(arg1, ptr))
+    lower = p[-3]
+    upper = p[-1]
+    init = LLVMCodeStore(lower, ptr)
+    addCode(init)
 
-    arg2 = getLabel()
-    addCode(LLVMCodeJ(arg2))
-    addCode(LLVMCodeLabel(arg2))
+    guard = getLabel()
+    addCode(LLVMCodeJ(guard))
+    addCode(LLVMCodeLabel(guard))
 
-    retval1 = getRegister()
-    addCode(LLVMCodeLoad(retval1, ptr))
-    arg3 = retval1
-    arg4 = p[-1]
-    cond = CmpType.SLE
-    retval2 = getRegister()
-    addCode(LLVMCodeIcmp(retval2, cond, arg3, arg4))
-    
-    arg5 = getLabel()
-    arg6 = getLabel()
-    addCode(LLVMCodeBr(retval2, arg5, arg6))
-    
-    addCode(LLVMCodeLabel(arg5))
-    
-    p[0] = [arg2, arg6, ptr]
+    cond = getRegister()
+    addCode(LLVMCodeIcmp(cond, CmpType.SLE, lower, upper))
+
+    body = getLabel()
+    exit = getLabel()
+    addCode(LLVMCodeBr(cond, body, exit))
+
+    addCode(LLVMCodeLabel(body))
+    phi = LLVMCodePhi(getRegister())
+    addCode(phi)
+
+    p[0] = [init, guard, body, exit, ptr, phi]
 
 def p_proc_call_statement(p):
     '''
@@ -584,23 +790,7 @@ def p_read_statement(p):
     elif t.scope == Scope.PARAM:
         ptr = Operand(OType.NAMED_REG, name = t.name)
     elif t.scope == Scope.ARRAY:
-        
-        arg1 = p[5]
-
-        retval = getRegister()
-        arg2 = t.index[0]
-        addCode(LLVMCodeSub(retval, arg1, arg2))
-        v = retval
-
-        retval = getRegister()
-        addCode(LLVMCodeSext(retval, v))
-        ptr = retval
-
-        retval = getRegister()
-        size = t.index[1] - t.index[0] + 1
-        name = t.name
-        addCode(LLVMCodeGetelementptr(retval, size, name, ptr))
-        ptr = retval
+        ptr = arrayElementPtr(t, p[5])
 
     addCode(LLVMCodeCallScanf(getRegister(), ptr))
 
@@ -678,32 +868,9 @@ def p_term(p):
         arg2 = p[3]
         retval = getRegister()
         if p[2] == "*":
-            if (arg1.type == OType.CONSTANT):
-                x = arg1.val
-                if (x & (x-1)) == 0:
-                    arg1 = Operand(OType.CONSTANT, val=int(math.log2(x)))
-                    addCode(LLVMCodeShl(retval, arg2, arg1))
-                else:
-                    addCode(LLVMCodeMul(retval, arg1, arg2))
-            elif (arg2.type == OType.CONSTANT):
-                x = arg2.val
-                if (x & (x-1)) == 0:
-                    arg2 = Operand(OType.CONSTANT, val=int(math.log2(x)))
-                    addCode(LLVMCodeShl(retval, arg1, arg2))
-                else:
-                    addCode(LLVMCodeMul(retval, arg1, arg2))
-            else:
-                addCode(LLVMCodeMul(retval, arg1, arg2))
+            addCode(LLVMCodeMul(retval, arg1, arg2))
         else:
-            if (arg2.type == OType.CONSTANT):
-                x = arg2.val
-                if (x & (x-1)) == 0:
-                    arg2 = Operand(OType.CONSTANT, val=int(math.log2(x)))
-                    addCode(LLVMCodeAshr(retval, arg1, arg2))
-                else:
-                    addCode(LLVMCodeDiv(retval, arg1, arg2))    
-            else:
-                addCode(LLVMCodeDiv(retval, arg1, arg2))
+            addCode(LLVMCodeDiv(retval, arg1, arg2))
         p[0] = retval
 
 def p_factor(p):
@@ -739,22 +906,7 @@ def p_var_name(p):
         retval = Operand(OType.NAMED_REG, name = t.name)
 
     elif t.scope == Scope.ARRAY:
-        arg1 = p[3]
-        retval = getRegister()
-        arg2 = t.index[0]
-        addCode(LLVMCodeSub(retval, arg1, arg2))
-        v = retval
-
-        retval = getRegister()
-        addCode(LLVMCodeSext(retval, v))
-        ptr = retval
-
-        retval = getRegister()
-        size = t.index[1] - t.index[0] + 1
-        name = t.name
-        addCode(LLVMCodeGetelementptr(retval, size, name, ptr))
-        ptr = retval
-
+        ptr = arrayElementPtr(t, p[3])
         retval = getRegister()
         addCode(LLVMCodeLoad(retval, ptr))
     p[0] = retval    
@@ -804,6 +956,8 @@ def p_id_list_act1(p):
 #################################################################
 
 def p_error(p):
+    global syntaxError
+    syntaxError = True
     if p:
         # p.type, p.value, p.linenoを使ってエラーの処理を書く
         print("ERROR")
@@ -818,10 +972,136 @@ def p_error(p):
 #################################################################
 
 if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='PL コンパイラ')
+    argparser.add_argument('file', help='ソースファイル')
+    argparser.add_argument('-O', dest='optlevel', type=int, default=0, choices=range(4),
+                           help='最適化レベル（0〜3）')
+    argparser.add_argument('--stats', action='store_true',
+                           help='最適化の統計情報を標準エラー出力に表示')
+    argparser.add_argument('--fast-io', action='store_true',
+                           help='printf・scanf の代わりにバッファを使う入出力の実行時ライブラリを使う')
+    argparser.add_argument('--instrument', nargs='?', const=pgo.DEFAULT_FILE, metavar='FILE',
+                           help=f'実行回数カウンタを入れ，終了時に FILE（省略時は {pgo.DEFAULT_FILE}）に書き出す')
+    argparser.add_argument('--profile-use', metavar='FILE',
+                           help='--instrument で得たプロファイルを最適化に使う')
+    argparser.add_argument('--profile-runtime', action='store_true',
+                           help='関数ごとの呼び出し回数と実行サイクル数を計測し，終了時に標準エラー出力に表示する')
+    argparser.add_argument('--unroll-threshold', type=int,
+                           help='完全展開するループの（本体の命令数×回数）の上限')
+    argparser.add_argument('--unroll-factor', type=int,
+                           help='部分展開でまとめる繰り返し回数')
+    argparser.add_argument('--unroll-budget', type=int,
+                           help='ループ展開で増やしてよいプログラム全体の命令数')
+    argparser.add_argument('--inline-threshold', type=int,
+                           help='インライン展開する関数の命令数の上限（0 で展開しない）')
+    argparser.add_argument('--vector-width', type=int, choices=[1, 2, 4, 8, 16],
+                           help='ベクトル化の要素数（1 でベクトル化しない）')
+    argparser.add_argument('--eval-budget', type=int,
+                           help='部分評価でコンパイル時に実行する命令数の上限（0 で部分評価しない）')
+    argparser.add_argument('--parallel', action='store_true',
+                           help='独立な for ループを pthread で並列化する（スレッド数は環境変数 PL_NUM_THREADS）')
+    argparser.add_argument('--parallel-min-chunk', type=int,
+                           help='並列化したループで1スレッドが受け持つ最小の繰り返し回数')
+    argparser.add_argument('--memoize', action='store_true',
+                           help='純粋な再帰関数をメモ化する（メモ化した関数は --stats に出る）')
+    argparser.add_argument('--memo-size', type=int,
+                           help='メモ化の表の大きさ（2のべき）')
+    argparser.add_argument('--clone-threshold', type=int,
+                           help='定数引数で複製する関数の命令数の上限（0 で複製しない）')
+    argparser.add_argument('--jobs', '-j', type=int, metavar='N',
+                           help='手続き内の最適化を N 個のワーカープロセスで関数ごとに並行して行う')
+    argparser.add_argument('--backend', choices=['llvm', 'x86'], default='llvm',
+                           help='llvm なら LLVM IR（result.ll），x86 なら x86-64 のアセンブリ（result.s）を出力する')
+    argparser.add_argument('--emit', choices=['ll', 'bc', 'obj', 'exe'], default='ll',
+                           help='ll ならテキストの LLVM IR（result.ll），bc ならビットコード（result.bc），'
+                                'obj ならオブジェクトファイル（result.o），exe なら実行ファイル（a.out）を出力する')
+    argparser.add_argument('-o', dest='output', metavar='FILE',
+                           help='出力先のファイル名（- なら標準出力）')
+    argparser.add_argument('--split-modules', type=int, default=1, metavar='N',
+                           help='関数定義を N 個の LLVM モジュールに分けて出力し，バックエンドで並行してコード生成する')
+    argparser.add_argument('--time', action='store_true',
+                           help='フロントエンドとバックエンドにかかった時間を標準エラー出力に表示')
+    args = argparser.parse_args()
+    options = OptOptions(args.optlevel)
+    if args.unroll_threshold is not None:
+        options.unrollThreshold = args.unroll_threshold
+    if args.unroll_factor is not None:
+        options.unrollFactor = args.unroll_factor
+    if args.unroll_budget is not None:
+        options.unrollBudget = args.unroll_budget
+    if args.inline_threshold is not None:
+        options.inlineThreshold = args.inline_threshold
+    if args.vector_width is not None:
+        options.vectorWidth = args.vector_width
+    if args.eval_budget is not None:
+        options.evalBudget = args.eval_budget
+    options.parallel = args.parallel
+    if args.parallel_min_chunk is not None:
+        options.parallelMinChunk = args.parallel_min_chunk
+    options.memoize = args.memoize
+    if args.memo_size is not None:
+        if args.memo_size < 2 or args.memo_size & (args.memo_size - 1):
+            argparser.error("--memo-size must be a power of two (at least 2)")
+        options.memoSize = args.memo_size
+    if args.clone_threshold is not None:
+        options.cloneThreshold = args.clone_threshold
+    if args.jobs is not None:
+        if args.jobs < 1:
+            argparser.error("--jobs must be positive")
+        options.jobs = args.jobs
+    showStats = args.stats
+    fastIO = args.fast_io
+    instrumentFile = args.instrument
+    profileFile = args.profile_use
+    profileRuntime = args.profile_runtime
+    backend = args.backend
+    emit = args.emit
+    splitModules = args.split_modules
+    if backend == 'x86' and emit == 'bc':
+        argparser.error(f"--emit={emit} cannot be used with --backend=x86")
+    if splitModules < 1:
+        argparser.error("--split-modules must be positive")
+    if splitModules > 1:
+        if backend == 'x86' or emit == 'bc':
+            argparser.error("--split-modules can only be used with --backend=llvm and --emit=ll|obj|exe")
+        if emit == 'll' and args.output == '-':
+            argparser.error("--split-modules cannot write LLVM IR to stdout")
+    if backend == 'x86' or emit == 'bc' or splitModules > 1:
+        # テキストの LLVM IR で書いた実行時ライブラリは x86-64 のアセンブリにもビットコードにもできず，
+        # モジュールごとに複製すると状態を共有できない
+        option = '--backend=x86' if backend == 'x86' else '--emit=bc' if emit == 'bc' else '--split-modules'
+        for flag, given in [('--fast-io', fastIO), ('--instrument', instrumentFile is not None),
+                           ('--profile-runtime', profileRuntime), ('--parallel', options.parallel)]:
+            if given:
+                argparser.error(f"{flag} cannot be used with {option}")
+    if backend == 'x86':
+        # x86-64 のアセンブリはスカラーの命令だけを扱う
+        options.vectorWidth = 1
+
+    # プログラム全体を見る処理（最適化・計測・実行時ライブラリ・分割）がなければ，
+    # 関数定義を還元するたびに出力して，生成中のプログラムの大きさによらずメモリを抑える
+    streaming = (options.level == 0 and backend == 'llvm' and emit != 'bc' and splitModules == 1
+                 and not (fastIO or instrumentFile or profileFile or profileRuntime
+                          or options.parallel or options.memoize))
+    build = driver.Driver(emit, args.output, backend)
+    if args.output == '-':
+        # 標準出力には生成したコードだけを書き，記号表の表示などは標準エラー出力に回す
+        sys.stdout = sys.stderr
+
     lexer = lex.lex(debug=0)  # 字句解析器
     yacc.yacc()  # 構文解析器
 
     # ファイルを開いて
-    data = open(sys.argv[1]).read()
+    data = open(args.file).read()
     # 解析を実行
-    yacc.parse(data, lexer=lexer)
+    try:
+        yacc.parse(data, lexer=lexer)
+    except BaseException:
+        build.abort()
+        raise
+    if syntaxError or build.frontTime is None:
+        # 途中まで出力した関数定義は捨てる
+        build.abort()
+        sys.exit(1)
+    if args.time and build.frontTime is not None:
+        build.report()
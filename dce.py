@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import *
+import stats
+
+##
+## 不要命令の削除（Dead Code Elimination）
+##   結果が使われない純粋な命令・ロード・phi を取り除く
+##
+
+
+def removable(l) -> bool:
+    return l.isPure() or isinstance(l, (LLVMCodeLoad, LLVMCodePhi))
+
+
+def run(fundef) -> int:
+    ''' 関数定義 fundef の不要命令を削除し，削除した命令数を返す '''
+    n = 0
+    while True:
+        used = set()
+        for l in fundef.codes:
+            used.update(l.getUses())
+        dead = [l for l in fundef.codes
+                if removable(l) and l.getDef() is not None and l.getDef() not in used]
+        if not dead:
+            break
+        dead = set(map(id, dead))
+        fundef.codes = [l for l in fundef.codes if id(l) not in dead]
+        n += len(dead)
+    stats.count('dce', 'removed instructions', n)
+    return n
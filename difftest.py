@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+##
+## x86-64 バックエンドの差分テストと出力の再現性のテスト
+##   サンプルの .p ファイル（pl*.p・test.p・cl.p）を最適化レベルごとに
+##       --backend=x86 : アセンブリを cc でアセンブル・リンクして実行する
+##       --backend=llvm : LLVM IR を lli で実行する
+##   の2通りでコンパイルし，同じ標準入力を与えたときの標準出力と終了ステータスが一致するかを調べる．
+##   また，同じ入力を RUNS 回コンパイルした LLVM IR がすべて同じになるか，
+##   -O1 以上では --jobs JOBS で RUNS 回最適化した結果が --jobs 1 の結果とすべて同じになるかを調べる．
+##   使い方: python difftest.py [-O 0 1 2 3] [ファイル名 ...]
+##   一致しない組があれば表示して終了ステータス 1 で終わる．
+##
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPILER = os.path.join(HERE, 'compiler.py')
+
+# サンプルごとに与える標準入力（書いていないものは空）
+INPUTS = {
+    'pl0b.p': '30\n',
+    'pl1a.p': '5\n',
+    'pl1b.p': '2 10\n',
+    'pl2a.p': '5\n',
+    'pl2b.p': '3 4\n',
+    'pl3a.p': '5 3 1 4 1 5\n',
+    'pl3b.p': '30\n',
+    'cl.p': '7\n',
+}
+
+RUNS = 3            # 再現性のテストでコンパイルする回数
+JOBS = 3            # 並行した最適化のテストで使うワーカープロセスの数
+
+TIMEOUT = 60        # 1回の実行の時間の上限（秒）
+
+
+def samples() -> list:
+    ''' 差分テストに使うサンプルのパス '''
+    names = sorted(f for f in os.listdir(HERE) if f.startswith('pl') and f.endswith('.p'))
+    for extra in ['test.p', 'cl.p']:
+        if os.path.exists(os.path.join(HERE, extra)):
+            names.append(extra)
+    return [os.path.join(HERE, f) for f in names]
+
+
+def compile(src:str, level:int, args:list, out:str):
+    ''' src を -O level でコンパイルして out に書く（失敗したら例外） '''
+    cmd = [sys.executable, COMPILER, f'-O{level}'] + args + ['-o', out, src]
+    r = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=TIMEOUT)
+    if r.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)}: exited with status {r.returncode}\n{r.stderr}")
+
+
+def execute(cmd:list, stdin:str) -> tuple:
+    ''' cmd を実行して (標準出力, 終了ステータス) を返す '''
+    r = subprocess.run(cmd, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       text=True, timeout=TIMEOUT)
+    return r.stdout, r.returncode
+
+
+def check(src:str, level:int, tmpdir:str) -> str:
+    ''' 1つの組を調べ，一致しなければ理由を返す（一致すれば None） '''
+    name = os.path.basename(src)
+    stdin = INPUTS.get(name, '')
+    ll = os.path.join(tmpdir, f'{name}.{level}.ll')
+    exe = os.path.join(tmpdir, f'{name}.{level}.x86')
+    try:
+        compile(src, level, [], ll)
+        compile(src, level, ['--backend=x86', '--emit=exe'], exe)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        return f"compile failed: {e}"
+    expected = execute(['lli', ll], stdin)
+    got = execute([exe], stdin)
+    if got != expected:
+        return (f"llvm: status {expected[1]}, output {expected[0]!r}\n"
+                f"        x86:  status {got[1]}, output {got[0]!r}")
+    return None
+
+
+def compileRuns(src:str, level:int, tmpdir:str, args:list, runs:int) -> list:
+    ''' src を runs 回コンパイルした LLVM IR のリスト（失敗したら例外） '''
+    name = os.path.basename(src)
+    outputs = []
+    for k in range(runs):
+        ll = os.path.join(tmpdir, f'{name}.{level}.run{k}.ll')
+        compile(src, level, args, ll)
+        with open(ll) as fp:
+            outputs.append(fp.read())
+    return outputs
+
+
+def reproducible(src:str, level:int, tmpdir:str) -> str:
+    ''' 同じ入力を RUNS 回コンパイルした LLVM IR がすべて同じかを調べ，違えば理由を返す（同じなら None） '''
+    try:
+        outputs = compileRuns(src, level, tmpdir, [], RUNS)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        return f"compile failed: {e}"
+    if len(set(outputs)) != 1:
+        return f"{len(set(outputs))} distinct outputs in {RUNS} runs"
+    return None
+
+
+def parallelMatches(src:str, level:int, tmpdir:str) -> str:
+    ''' --jobs JOBS で RUNS 回コンパイルした LLVM IR が --jobs 1 と同じかを調べ，違えば理由を返す '''
+    try:
+        expected = compileRuns(src, level, tmpdir, ['--jobs', '1'], 1)[0]
+        outputs = compileRuns(src, level, tmpdir, ['--jobs', str(JOBS)], RUNS)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        return f"compile failed: {e}"
+    differ = sum(1 for out in outputs if out != expected)
+    if differ:
+        return f"{differ} of {RUNS} runs with --jobs {JOBS} differ from --jobs 1"
+    return None
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='x86-64 バックエンドの差分テストと出力の再現性のテスト')
+    argparser.add_argument('files', nargs='*', help='調べるサンプル（省略時は pl*.p・test.p・cl.p）')
+    argparser.add_argument('-O', dest='levels', type=int, nargs='+', default=[0, 1, 2, 3],
+                           choices=range(4), help='調べる最適化レベル')
+    args = argparser.parse_args()
+    for tool in ['lli', 'cc']:
+        if shutil.which(tool) is None:
+            sys.exit(f"{tool} not found")
+
+    failed = 0
+    total = 0
+    with tempfile.TemporaryDirectory(prefix='plc-difftest-') as tmpdir:
+        for src in args.files or samples():
+            name = os.path.basename(src)
+            for level in args.levels:
+                tests = [('x86', check), ('repro', reproducible)]
+                if level > 0:
+                    tests.append(('jobs', parallelMatches))
+                for test, run in tests:
+                    reason = run(os.path.abspath(src), level, tmpdir)
+                    total += 1
+                    if reason is None:
+                        print(f"ok      {name} -O{level} {test}")
+                    else:
+                        failed += 1
+                        print(f"FAILED  {name} -O{level} {test}\n        {reason}")
+    print(f"{total - failed}/{total} passed")
+    sys.exit(1 if failed else 0)
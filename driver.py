@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+##
+## ビルドドライバ（-o・--emit=obj|exe・--time）
+##   生成したコードの書き込み先を用意し，必要ならバックエンドを起動する．
+##       ll  : テキストの LLVM IR（--backend=x86 ならアセンブリ）をそのまま書く
+##       bc  : LLVM ビットコードをそのまま書く
+##       obj : オブジェクトファイルを作る
+##       exe : 実行ファイルを作る
+##   obj・exe では中間ファイルを作らず，コードをパイプでバックエンドの標準入力に流し込む．
+##       LLVM IR      : clang -x ir -（clang がなければ llc でオブジェクトファイルにして cc でリンク）
+##       x86-64 の .s : cc -x assembler -
+##   出力先が「-」なら標準出力に書く．バックエンドの出力や llc と cc の間のオブジェクトファイルは
+##   呼び出しごとの一時ディレクトリに置くので，同じディレクトリで並行してビルドしても衝突しない．
+##   出力先を省略したときは従来どおりカレントディレクトリの result.* に書く．
+##
+##   出力を複数のモジュールに分けたとき（--split-modules）は，モジュールごとにバックエンドを起動して
+##   オブジェクトファイルを並行して作り，最後にまとめてリンクする（obj なら cc -r で1つにする）．
+##   ll・bc ではモジュールごとに出力先の拡張子の前に番号を入れたファイル（result.0.ll など）に書く．
+##
+##   -O0 では構文解析の途中から書き込み先を開いて関数を書き出すので，後で構文エラーなどが見つかったら
+##   abort でバックエンドを止め，途中まで書いた出力を消す．
+##
+
+BUFSIZE = 1 << 20      # 書き込み先のバッファの大きさ（小さな書き込みをまとめる）
+
+DEFAULT_OUTPUT = {'ll': 'result.ll', 'bc': 'result.bc', 'obj': 'result.o', 'exe': 'a.out'}
+
+
+def modulePath(path:str, k:int) -> str:
+    ''' k 番目のモジュールの出力先（拡張子の前に番号を入れる） '''
+    root, ext = os.path.splitext(path)
+    return f"{root}.{k}{ext}"
+
+
+class Driver(object):
+    '''
+    ビルドドライバ
+        emit    : 出力形式（'ll', 'bc', 'obj', 'exe'）
+        output  : 出力先のファイル名（'-' なら標準出力）
+        backend : コード生成の方法（'llvm' か 'x86'）
+    '''
+
+    def __init__(self, emit:str, output:str, backend:str):
+        self.emit = emit
+        self.backend = backend
+        if output is None:
+            output = 'result.s' if backend == 'x86' and emit == 'll' else DEFAULT_OUTPUT[emit]
+        self.output = output
+        self.stdout = sys.stdout
+        self.tmpdir = None
+        self.procs = []         # (コマンド, 起動したバックエンド) のリスト
+        self.fps = []           # 開いた書き込み先のリスト
+        self.objects = []       # 分割したモジュールのオブジェクトファイル
+        self.written = []       # 作った（作りかけの）出力ファイル
+        self.start = time.perf_counter()
+        self.frontTime = None
+        self.backTime = None
+
+    def binary(self) -> bool:
+        ''' 書き込み先がバイナリか '''
+        return self.emit == 'bc'
+
+    def tempPath(self, name:str) -> str:
+        ''' 呼び出しごとの一時ディレクトリの中のファイル名 '''
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='plc-')
+        return os.path.join(self.tmpdir, name)
+
+    def target(self) -> str:
+        ''' バックエンドが書き出すファイル名（標準出力なら一時ファイルに書いて後で写す） '''
+        return self.tempPath(DEFAULT_OUTPUT[self.emit]) if self.output == '-' else self.output
+
+    def compileCommand(self, emit:str, out:str) -> list:
+        ''' 標準入力からコードを読み，out にオブジェクトファイル（emit='obj'）か実行ファイルを書くコマンド '''
+        compile = ['-c'] if emit == 'obj' else []
+        if self.backend == 'x86':
+            return ['cc'] + compile + ['-x', 'assembler', '-', '-o', out]
+        if shutil.which('clang') is not None:
+            return ['clang'] + compile + ['-x', 'ir', '-', '-o', out]
+        # gcc は既定で PIE を作るので，位置独立なオブジェクトファイルにする
+        return ['llc', '-O2', '-filetype=obj', '-relocation-model=pic', '-o', out, '-']
+
+    def linkCommand(self, objects:list) -> list:
+        ''' オブジェクトファイルを出力形式に合わせてリンクするコマンド '''
+        if self.emit == 'obj':
+            return ['cc', '-r', '-nostdlib'] + objects + ['-o', self.target()]
+        return ['cc'] + objects + ['-o', self.target()]
+
+    def open(self, k:int=0, n:int=1):
+        ''' k 番目（全 n 個）のモジュールの書き込み先を開く（開いてあればそれを返す） '''
+        if k < len(self.fps):
+            return self.fps[k]
+        if self.emit in ('ll', 'bc'):
+            if self.output == '-':
+                fp = self.stdout.buffer if self.binary() else self.stdout
+            else:
+                path = self.output if n == 1 else modulePath(self.output, k)
+                fp = open(path, 'wb' if self.binary() else 'w', buffering=BUFSIZE)
+                self.written.append(path)
+            self.fps.append(fp)
+            return fp
+        if self.output != '-':
+            self.written.append(self.output)
+        if n == 1 and (self.backend == 'x86' or shutil.which('clang') is not None):
+            # 1回の起動で出力まで作る
+            cmd = self.compileCommand(self.emit, self.target())
+        else:
+            obj = self.tempPath(f"module{k}.o")
+            self.objects.append(obj)
+            cmd = self.compileCommand('obj', obj)
+        # 書き込んだ分からバックエンドが読み進める
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=BUFSIZE)
+        self.procs.append((cmd, proc))
+        fp = io.TextIOWrapper(proc.stdin, encoding='utf-8')
+        self.fps.append(fp)
+        return fp
+
+    def finish(self, fp):
+        ''' モジュールを書き終えた（バックエンドはすぐにコード生成を始める） '''
+        if fp is self.stdout or fp is getattr(self.stdout, 'buffer', None):
+            fp.flush()
+        else:
+            fp.close()
+
+    def close(self):
+        ''' 書き込み先を閉じ，バックエンドの終了を待つ（失敗したら終了する） '''
+        self.frontTime = time.perf_counter() - self.start
+        try:
+            for fp in self.fps:
+                if not fp.closed:
+                    self.finish(fp)
+            if not self.procs:
+                return
+            for cmd, proc in self.procs:
+                self.wait(cmd, proc.wait())
+            if len(self.objects) > 1 or self.objects and self.emit == 'exe':
+                cmd = self.linkCommand(self.objects)
+                self.wait(cmd, subprocess.call(cmd))
+            elif self.objects:
+                shutil.move(self.objects[0], self.target())
+            if self.output == '-':
+                with open(self.target(), 'rb') as fp:
+                    shutil.copyfileobj(fp, self.stdout.buffer)
+                self.stdout.buffer.flush()
+            self.backTime = time.perf_counter() - self.start - self.frontTime
+        finally:
+            if self.tmpdir is not None:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+                self.tmpdir = None
+
+    def abort(self):
+        ''' 書き込み先を捨て，バックエンドを止めて，作りかけの出力を消す '''
+        for cmd, proc in self.procs:
+            proc.kill()
+        for fp in self.fps:
+            if fp is self.stdout or fp is getattr(self.stdout, 'buffer', None) or fp.closed:
+                continue
+            try:
+                fp.close()
+            except OSError:
+                # 止めたバックエンドへのパイプには書き残しを送れない
+                pass
+        for cmd, proc in self.procs:
+            proc.wait()
+        for path in self.written:
+            if os.path.exists(path):
+                os.remove(path)
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def wait(self, cmd:list, status:int):
+        if status != 0:
+            sys.exit(f"{' '.join(cmd)}: exited with status {status}")
+
+    def report(self, fp=sys.stderr):
+        ''' フロントエンド（構文解析・最適化・コードの書き出し）とバックエンドの時間の出力
+                パイプではバックエンドが並行して動くので，バックエンドの時間は書き終えてから後の分である
+        '''
+        print("=== time ===", file=fp)
+        print(f"{self.frontTime:10.3f}s front end", file=fp)
+        if self.backTime is not None:
+            print(f"{self.backTime:10.3f}s backend", file=fp)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import *
+import stats
+
+##
+## バッファを使う入出力の実行時ライブラリ（--fast-io）
+##   write は可変長引数の printf の代わりに @pl.write_int を呼び，
+##   整数を自前で10進に変換して 64KB の出力バッファに貯める．
+##   バッファが一杯になったとき，入力を待つとき，main が終わるときに write(2) で書き出す．
+##   read は scanf の代わりに @pl.read_int を呼び，read(2) で 64KB ずつ読んだ
+##   バッファから空白を読み飛ばして整数を読む．
+##   返り値は printf・scanf と同じ（出力した文字数，読めた個数・EOF なら -1）で，
+##   読めなければ変数を書き換えないのも scanf と同じ．
+##
+
+BUFSIZE = 65536
+
+
+RUNTIME = r'''
+@pl.out = internal global [{SIZE} x i8] zeroinitializer, align 16
+@pl.outpos = internal global i32 0, align 4
+@pl.in = internal global [{SIZE} x i8] zeroinitializer, align 16
+@pl.inpos = internal global i32 0, align 4
+@pl.inlen = internal global i32 0, align 4
+
+declare i64 @write(i32, i8*, i64)
+declare i64 @read(i32, i8*, i64)
+declare void @llvm.memcpy.p0i8.p0i8.i64(i8*, i8*, i64, i1)
+
+define internal void @pl.flush() nounwind {
+entry:
+    %n = load i32, i32* @pl.outpos, align 4
+    br label %loop
+loop:
+    %done = phi i32 [ 0, %entry ], [ %done1, %written ]
+    %left = sub i32 %n, %done
+    %empty = icmp sle i32 %left, 0
+    br i1 %empty, label %exit, label %put
+put:
+    %p = getelementptr inbounds [{SIZE} x i8], [{SIZE} x i8]* @pl.out, i64 0, i32 %done
+    %left64 = sext i32 %left to i64
+    %w = call i64 @write(i32 1, i8* %p, i64 %left64)
+    %failed = icmp sle i64 %w, 0
+    br i1 %failed, label %exit, label %written
+written:
+    %w32 = trunc i64 %w to i32
+    %done1 = add i32 %done, %w32
+    br label %loop
+exit:
+    store i32 0, i32* @pl.outpos, align 4
+    ret void
+}
+
+define internal i32 @pl.write_int(i32 %v) nounwind {
+entry:
+    %tmp = alloca [12 x i8], align 1
+    %pos0 = load i32, i32* @pl.outpos, align 4
+    %full = icmp sgt i32 %pos0, {LIMIT}
+    br i1 %full, label %flush, label %format
+flush:
+    call void @pl.flush()
+    br label %format
+format:
+    %pos = phi i32 [ %pos0, %entry ], [ 0, %flush ]
+    %neg = icmp slt i32 %v, 0
+    %w = sext i32 %v to i64
+    %nw = sub i64 0, %w
+    %a = select i1 %neg, i64 %nw, i64 %w
+    br label %digit
+digit:
+    ; 下の桁から一時領域の末尾に向かって書く
+    %x = phi i64 [ %a, %format ], [ %q, %digit ]
+    %k = phi i32 [ 12, %format ], [ %k1, %digit ]
+    %q = udiv i64 %x, 10
+    %r = urem i64 %x, 10
+    %r8 = trunc i64 %r to i8
+    %c = add i8 %r8, 48
+    %k1 = sub i32 %k, 1
+    %tp = getelementptr inbounds [12 x i8], [12 x i8]* %tmp, i64 0, i32 %k1
+    store i8 %c, i8* %tp, align 1
+    %more = icmp ne i64 %q, 0
+    br i1 %more, label %digit, label %sign
+sign:
+    br i1 %neg, label %minus, label %copy
+minus:
+    %km = sub i32 %k1, 1
+    %mp = getelementptr inbounds [12 x i8], [12 x i8]* %tmp, i64 0, i32 %km
+    store i8 45, i8* %mp, align 1
+    br label %copy
+copy:
+    %s = phi i32 [ %k1, %sign ], [ %km, %minus ]
+    %len = sub i32 12, %s
+    %src = getelementptr inbounds [12 x i8], [12 x i8]* %tmp, i64 0, i32 %s
+    %dst = getelementptr inbounds [{SIZE} x i8], [{SIZE} x i8]* @pl.out, i64 0, i32 %pos
+    %len64 = zext i32 %len to i64
+    call void @llvm.memcpy.p0i8.p0i8.i64(i8* %dst, i8* %src, i64 %len64, i1 false)
+    %end = add i32 %pos, %len
+    %np = getelementptr inbounds [{SIZE} x i8], [{SIZE} x i8]* @pl.out, i64 0, i32 %end
+    store i8 10, i8* %np, align 1
+    %pos1 = add i32 %end, 1
+    store i32 %pos1, i32* @pl.outpos, align 4
+    %n = add i32 %len, 1
+    ret i32 %n
+}
+
+define internal i32 @pl.getc() nounwind {
+entry:
+    %pos = load i32, i32* @pl.inpos, align 4
+    %len = load i32, i32* @pl.inlen, align 4
+    %empty = icmp sge i32 %pos, %len
+    br i1 %empty, label %fill, label %get
+fill:
+    ; 入力を待つ前に，それまでの出力を書き出しておく
+    call void @pl.flush()
+    %n = call i64 @read(i32 0, i8* getelementptr inbounds ([{SIZE} x i8], [{SIZE} x i8]* @pl.in, i64 0, i64 0), i64 {SIZE})
+    %eof = icmp sle i64 %n, 0
+    br i1 %eof, label %end, label %filled
+end:
+    store i32 0, i32* @pl.inpos, align 4
+    store i32 0, i32* @pl.inlen, align 4
+    ret i32 -1
+filled:
+    %n32 = trunc i64 %n to i32
+    store i32 %n32, i32* @pl.inlen, align 4
+    br label %get
+get:
+    %p = phi i32 [ %pos, %entry ], [ 0, %filled ]
+    %cp = getelementptr inbounds [{SIZE} x i8], [{SIZE} x i8]* @pl.in, i64 0, i32 %p
+    %c = load i8, i8* %cp, align 1
+    %p1 = add i32 %p, 1
+    store i32 %p1, i32* @pl.inpos, align 4
+    %ci = zext i8 %c to i32
+    ret i32 %ci
+}
+
+define internal void @pl.ungetc() nounwind {
+entry:
+    %pos = load i32, i32* @pl.inpos, align 4
+    %pos1 = sub i32 %pos, 1
+    store i32 %pos1, i32* @pl.inpos, align 4
+    ret void
+}
+
+define internal i32 @pl.read_int(i32* %p) nounwind {
+entry:
+    br label %skip
+skip:
+    %c = call i32 @pl.getc()
+    %eof = icmp eq i32 %c, -1
+    br i1 %eof, label %none, label %space
+space:
+    ; 空白（' ', '\t', '\n', '\v', '\f', '\r'）を読み飛ばす
+    %sp = icmp eq i32 %c, 32
+    %t = sub i32 %c, 9
+    %ctl = icmp ult i32 %t, 5
+    %ws = or i1 %sp, %ctl
+    br i1 %ws, label %skip, label %sign
+sign:
+    %minus = icmp eq i32 %c, 45
+    %plus = icmp eq i32 %c, 43
+    %signed = or i1 %minus, %plus
+    br i1 %signed, label %next, label %first
+next:
+    %c2 = call i32 @pl.getc()
+    br label %first
+first:
+    %c0 = phi i32 [ %c, %sign ], [ %c2, %next ]
+    %d0 = sub i32 %c0, 48
+    %isdigit = icmp ult i32 %d0, 10
+    br i1 %isdigit, label %digits, label %fail
+digits:
+    %x = phi i32 [ %d0, %first ], [ %x1, %more ]
+    %c3 = call i32 @pl.getc()
+    %d = sub i32 %c3, 48
+    %dig = icmp ult i32 %d, 10
+    br i1 %dig, label %more, label %done
+more:
+    %x10 = mul i32 %x, 10
+    %x1 = add i32 %x10, %d
+    br label %digits
+done:
+    ; 数字でない文字は次の read のために戻しておく
+    %back = icmp ne i32 %c3, -1
+    br i1 %back, label %unget, label %store
+unget:
+    call void @pl.ungetc()
+    br label %store
+store:
+    %nx = sub i32 0, %x
+    %v = select i1 %minus, i32 %nx, i32 %x
+    store i32 %v, i32* %p, align 4
+    ret i32 1
+fail:
+    %bad = icmp ne i32 %c0, -1
+    br i1 %bad, label %ungetbad, label %zero
+ungetbad:
+    call void @pl.ungetc()
+    br label %zero
+zero:
+    ret i32 0
+none:
+    ret i32 -1
+}
+'''
+
+
+def lower(fundefs) -> int:
+    '''
+    printf・scanf の呼び出しを実行時ライブラリの呼び出しに置き換え，出力があれば
+    main の ret の前に出力バッファを書き出す呼び出しを入れる．置き換えた数を返す
+    '''
+    writes = any(type(l) is LLVMCodeCallPrintf for f in fundefs for l in f.codes)
+    n = 0
+    for f in fundefs:
+        codes = []
+        for l in f.codes:
+            if type(l) is LLVMCodeCallPrintf:
+                l = LLVMCodeCallWriteInt(l.res, l.arg)
+                n += 1
+            elif type(l) is LLVMCodeCallScanf:
+                l = LLVMCodeCallReadInt(l.res, l.arg)
+                n += 1
+            elif isinstance(l, LLVMCodeRet) and f.name == 'main' and writes:
+                codes.append(LLVMCodeCallVoid('pl.flush'))
+            codes.append(l)
+        f.codes = codes
+    stats.count('fastio', 'lowered I/O calls', n)
+    return n
+
+
+def printRuntime(fp):
+    ''' 実行時ライブラリを出力する '''
+    print(RUNTIME.replace('{SIZE}', str(BUFSIZE)).replace('{LIMIT}', str(BUFSIZE - 12)),
+          end='', file=fp)
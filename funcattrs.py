@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from inline import recursiveFunctions
+from llvmcode import *
+from modref import analyzeModRef, getDefs, baseOf
+import stats
+
+##
+## 関数属性の推論と別名解析メタデータ
+##   nounwind   : 例外を投げない（この言語では常に付けられる）
+##   readnone   : 大域変数を読み書きせず，入出力もしない
+##   readonly   : 大域変数に書き込まず，入出力もしない
+##   norecurse  : 自分自身へ（間接的にも）戻ってこない
+##   willreturn : ループも再帰も入出力もなく，呼び出し先もすべて willreturn
+##   大域変数・大域配列ごとに別の型の TBAA ノードを割り当て，
+##   異なる大域配列へのロード・ストアが重ならないことを LLVM に伝える
+##
+
+
+def infer(fundefs):
+    ''' 関数定義 fundefs の関数属性を求めて Fundef.attrs に設定する '''
+    modref = analyzeModRef(fundefs)
+    recursive = recursiveFunctions(fundefs)
+    loops = {f.name: bool(CFG(f).findLoops()) for f in fundefs}
+
+    # willreturn は呼び出し先に依存するので，成り立たなくなるものを取り除いていく
+    willreturn = {f.name for f in fundefs
+                  if not loops[f.name] and f.name not in recursive and not modref[f.name].io}
+    changed = True
+    while changed:
+        changed = False
+        for name in list(willreturn):
+            if any(c not in willreturn for c in modref[name].calls):
+                willreturn.discard(name)
+                changed = True
+
+    for f in fundefs:
+        m = modref[f.name]
+        attrs = ['nounwind']
+        if not m.io and not m.writes:
+            attrs.append('readonly' if m.reads else 'readnone')
+        if f.name not in recursive:
+            attrs.append('norecurse')
+        if f.name in willreturn:
+            attrs.append('willreturn')
+        f.attrs = attrs
+        for a in attrs:
+            stats.count('funcattrs', a)
+
+
+class TBAA(object):
+    '''
+    型別名解析（TBAA）のメタデータ
+        nodes : 大域変数名 → アクセスタグのメタデータ番号
+        lines : 出力するメタデータ定義の行
+    '''
+
+    def __init__(self, fundefs):
+        self.nodes = {}
+        self.lines = ['!0 = !{!"pl tbaa"}']
+        for f in fundefs:
+            defs = getDefs(f)
+            for l in f.codes:
+                if isinstance(l, (LLVMCodeLoad, LLVMCodeStore)):
+                    b = baseOf(l.ptr, defs)
+                    if b is not None and b[0] == 'global':
+                        l.tbaa = self.tag(b[1])
+                        stats.count('funcattrs', 'tbaa tagged accesses')
+
+    def tag(self, name:str) -> int:
+        ''' 大域変数 name へのアクセスタグの番号 '''
+        if name not in self.nodes:
+            n = len(self.lines)
+            self.lines.append(f'!{n} = !{{!"int @{name}", !0, i64 0}}')
+            self.lines.append(f'!{n + 1} = !{{!{n}, !{n}, i64 0}}')
+            self.nodes[name] = n + 1
+        return self.nodes[name]
+
+    def print(self, fp):
+        if not self.nodes:
+            return
+        print('', file=fp)
+        for line in self.lines:
+            print(line, file=fp)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from operand import OType, Operand
+
 class Fundef(object):
     '''
     関数定義クラス
@@ -12,6 +14,7 @@ class Fundef(object):
         self.cntr  = 1			# レジスタ番号カウンタ
         self.lcount = 1         # ラベル番号カウンタ
         self.params = []
+        self.attrs = []         # 関数属性（nounwind, readnone など）
 
     def getNewRegNo(self):
         ''' レジスタ番号の取得 '''
@@ -24,15 +27,39 @@ class Fundef(object):
         self.lcount += 1
         return t
 
-    def print(self, fp):
-        ''' 関数定義の出力 '''
-        print(f"define {self.rettype} @{self.name}(", end = "", file=fp)
-        new = ""
-        for l in self.params:
-            new = new + f"i32 {l}, "
-        new = new[:-2]
-        print(new, end = "", file = fp)
-        print(f") {{", file=fp)
+    def renumber(self):
+        ''' 番号付きレジスタを出現順に %1, %2, ... と振り直す
+                （LLVMでは番号付きレジスタは定義順に連番でなければならない）
+        '''
+        table = {}
+        for l in self.codes:
+            r = l.getDef()
+            if r is not None and r.type == OType.NUMBERED_REG:
+                table[r.val] = len(table) + 1
+
+        def rename(x):
+            if isinstance(x, Operand) and x.type == OType.NUMBERED_REG and x.val in table:
+                return Operand(OType.NUMBERED_REG, val=table[x.val])
+            return x
+
         for l in self.codes:
-            print(f"    {l}", file=fp)
-        print("}\n", file=fp)
+            l.mapUses(rename)
+            r = l.getDef()
+            if r is not None:
+                l.setDef(rename(r))
+        self.cntr = len(table) + 1
+
+    def print(self, fp):
+        ''' 関数定義の出力（命令ごとに書かず，関数全体を1度に書く） '''
+        params = ", ".join(f"i32 {l}" for l in self.params)
+        attrs = "".join(f" {a}" for a in self.attrs)
+        lines = [f"define {self.rettype} @{self.name}({params}){attrs} {{"]
+        lines += [f"    {l}" for l in self.codes]
+        lines.append("}\n\n")
+        fp.write("\n".join(lines))
+
+    def printDeclare(self, fp):
+        ''' 他のモジュールで定義した関数の宣言の出力 '''
+        params = ", ".join("i32" for _ in self.params)
+        attrs = "".join(f" {a}" for a in self.attrs)
+        print(f"declare {self.rettype} @{self.name}({params}){attrs}", file=fp)
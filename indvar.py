@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import *
+from operand import OType, Operand
+
+##
+## 帰納変数の検出と添字式のアフィン分解
+##
+
+
+class InductionVar(object):
+    '''
+    基本帰納変数クラス
+        phi   : ヘッダの phi 命令（値は phi.retval）
+        init  : ループに入るときの値
+        step  : 1回の繰り返しでの増分（定数）
+        next  : 次の繰り返しの値（step を加える命令の結果）
+        latch : 後退辺を持つブロック
+    '''
+
+    def __init__(self, phi, init, step, next, latch):
+        self.phi = phi
+        self.init = init
+        self.step = step
+        self.next = next
+        self.latch = latch
+
+    @property
+    def reg(self) -> Operand:
+        return self.phi.retval
+
+
+def findInductionVars(loop, defs:dict) -> list:
+    ''' ループ loop の基本帰納変数のリスト（後退辺が1本のループのみ） '''
+    if len(loop.latches) != 1:
+        return []
+    latch = loop.latches[0]
+    result = []
+    for phi in loop.header.phis():
+        if phi.type != 'i32' or len(phi.incoming) != 2:
+            continue
+        inside = [(v, l) for v, l in phi.incoming if l == latch.label]
+        outside = [(v, l) for v, l in phi.incoming if l != latch.label]
+        if len(inside) != 1 or len(outside) != 1:
+            continue
+        next = inside[0][0]
+        l = defs.get(next)
+        step = None
+        if isinstance(l, LLVMCodeAdd):
+            if l.arg1 == phi.retval and l.arg2.isConst():
+                step = l.arg2.val
+            elif l.arg2 == phi.retval and l.arg1.isConst():
+                step = l.arg1.val
+        elif isinstance(l, LLVMCodeSub):
+            if l.arg1 == phi.retval and l.arg2.isConst():
+                step = -l.arg2.val
+        if step is None or step == 0:
+            continue
+        result.append(InductionVar(phi, outside[0][0], step, next, latch))
+    return result
+
+
+def liveOutOnlyNext(cfg, loop, iv:InductionVar, exit) -> bool:
+    ''' ループ内の値がループ外で使われるのは，出口 exit の phi に渡る帰納変数の次の値だけか '''
+    inside = set()
+    for b in loop.blocks:
+        for l in b.codes:
+            if l.getDef() is not None:
+                inside.add(l.getDef())
+    for b in cfg.blocks:
+        if b in loop.blocks:
+            continue
+        for l in b.codes:
+            if isinstance(l, LLVMCodePhi) and b is exit:
+                if any(lab == iv.latch.label and v != iv.next for v, lab in l.incoming):
+                    return False
+            elif any(x in inside for x in l.getUses()):
+                return False
+    return True
+
+
+class Affine(object):
+    '''
+    アフィン式  coef * iv + Σ k * terms[x] + const
+        terms : ループ不変なオペランド → 係数
+    '''
+
+    def __init__(self, coef:int=0, terms:dict=None, const:int=0):
+        self.coef = coef
+        self.terms = {} if terms is None else terms
+        self.const = const
+
+    def scale(self, k:int):
+        return Affine(self.coef * k, {x: c * k for x, c in self.terms.items()}, self.const * k)
+
+    def plus(self, other, sign:int=1):
+        terms = dict(self.terms)
+        for x, c in other.terms.items():
+            terms[x] = terms.get(x, 0) + sign * c
+            if terms[x] == 0:
+                del terms[x]
+        return Affine(self.coef + sign * other.coef, terms, self.const + sign * other.const)
+
+    def key(self):
+        ''' 定数項を除いた部分（同じ key の式どうしは定数差しかない） '''
+        return (self.coef, frozenset(self.terms.items()))
+
+
+def affine(x, iv:Operand, inloop, defs:dict):
+    '''
+    値 x を帰納変数 iv のアフィン式に分解する（できなければ None）
+        inloop(x) : x がループ内で定義されるレジスタか
+    '''
+    if not isinstance(x, Operand):
+        return None
+    if x == iv:
+        return Affine(coef=1)
+    if x.type == OType.CONSTANT:
+        return Affine(const=x.val)
+    if not inloop(x):
+        return Affine(terms={x: 1})
+    l = defs.get(x)
+    if isinstance(l, (LLVMCodeAdd, LLVMCodeSub)):
+        a = affine(l.arg1, iv, inloop, defs)
+        b = affine(l.arg2, iv, inloop, defs)
+        if a is None or b is None:
+            return None
+        return a.plus(b, 1 if isinstance(l, LLVMCodeAdd) else -1)
+    if isinstance(l, LLVMCodeMul):
+        a = affine(l.arg1, iv, inloop, defs)
+        b = affine(l.arg2, iv, inloop, defs)
+        if a is None or b is None:
+            return None
+        if not a.terms and a.coef == 0:
+            return b.scale(a.const)
+        if not b.terms and b.coef == 0:
+            return a.scale(b.const)
+        return None
+    if isinstance(l, LLVMCodeShl) and l.arg2.isConst():
+        a = affine(l.arg1, iv, inloop, defs)
+        if a is None:
+            return None
+        return a.scale(1 << l.arg2.val)
+    return None
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from llvmcode import *
+from modref import analyzeModRef
+from operand import OType, Operand
+import pgo
+import stats
+
+##
+## 手続き・関数のインライン展開
+##   呼び出し先の命令数が，呼び出し箇所のループの深さに応じたしきい値以下なら展開する
+##     しきい値 = threshold × (1 + ループの深さ)
+##   呼び出し箇所が1つしかない関数はしきい値の4倍まで展開する
+##   プロファイルがあれば，よく実行される呼び出しはさらに4倍まで展開し，
+##   一度も実行されなかった呼び出しは展開しない
+##   再帰呼び出しの輪に含まれる関数は展開しない
+##
+
+MAX_CALLER_SIZE = 5000      # 展開後の呼び出し元の命令数の上限
+
+
+def size(fundef) -> int:
+    ''' 関数本体の命令数（ラベルと alloca を除く） '''
+    return sum(1 for l in fundef.codes if not isinstance(l, (LLVMCodeLabel, LLVMCodeAlloca)))
+
+
+def recursiveFunctions(fundefs) -> set:
+    ''' 自分自身へ（間接的に）戻ってくる関数名の集合 '''
+    modref = analyzeModRef(fundefs)
+    result = set()
+    for name in modref:
+        seen = set()
+        work = list(modref[name].calls)
+        while work:
+            c = work.pop()
+            if c == name:
+                result.add(name)
+                break
+            if c in seen or c not in modref:
+                continue
+            seen.add(c)
+            work.extend(modref[c].calls)
+    return result
+
+
+def callCounts(fundefs) -> dict:
+    ''' 関数名 → 呼び出し箇所の数 '''
+    counts = {}
+    for f in fundefs:
+        for l in f.codes:
+            if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                counts[l.name] = counts.get(l.name, 0) + 1
+    return counts
+
+
+class Inliner(object):
+    ''' 呼び出し元 caller への展開 '''
+
+    def __init__(self, caller):
+        self.caller = caller
+        self.cfg = CFG(caller)
+        self.depth = {}
+        for loop in self.cfg.findLoops():
+            for b in loop.blocks:
+                self.depth[b] = max(self.depth.get(b, 0), loop.depth())
+        self.count = 0
+
+    def callSites(self) -> list:
+        ''' (ブロック, 呼び出し命令, ループの深さ) のリスト '''
+        r = []
+        for b in self.cfg.blocks:
+            for l in b.codes:
+                if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                    r.append((b, l, self.depth.get(b, 0)))
+        return r
+
+    def inline(self, b:BasicBlock, call, callee):
+        ''' ブロック b の呼び出し call を callee の本体で置き換える '''
+        caller = self.caller
+        self.count += 1
+        suffix = f".{callee.name}{self.count}"
+
+        # 呼び出しの後ろを新しいブロックに分ける
+        k = b.codes.index(call)
+        cont = BasicBlock(Labels(caller.getNewLab()))
+        cont.codes = b.codes[k + 1:]
+        b.codes = b.codes[:k]
+        for s in b.succs:
+            for phi in s.phis():
+                phi.retargetIncoming(b.label, cont.label)
+
+        # 仮引数は実引数に，名前付きレジスタ・番号付きレジスタ・ラベルは新しいものに置き換える
+        valmap = {}
+        for param, arg in zip(callee.params, call.arg):
+            valmap[param] = arg
+        entry = self.cfg.entry()
+        allocas = []
+        for l in callee.codes:
+            if isinstance(l, LLVMCodeAlloca):
+                valmap[Operand(OType.NAMED_REG, name=l.name)] = Operand(OType.NAMED_REG, name=l.name + suffix)
+                allocas.append(LLVMCodeAlloca(l.name + suffix))
+            elif l.getDef() is not None:
+                valmap[l.getDef()] = Operand(OType.NUMBERED_REG, val=caller.getNewRegNo())
+        labmap = {}
+        for l in callee.codes:
+            if isinstance(l, LLVMCodeLabel):
+                labmap[l.arg1] = Labels(caller.getNewLab())
+
+        body = [BasicBlock(Labels(caller.getNewLab()))]
+        rets = []
+        for l in callee.codes:
+            if isinstance(l, LLVMCodeAlloca):
+                continue
+            if isinstance(l, LLVMCodeLabel):
+                body.append(BasicBlock(labmap[l.arg1]))
+                continue
+            c = l.clone()
+            c.mapUses(lambda x: valmap.get(x, x))
+            if c.getDef() is not None:
+                c.setDef(valmap[l.getDef()])
+            c.mapTargets(lambda t: labmap[t])
+            if isinstance(c, LLVMCodePhi):
+                c.mapIncoming(lambda t: labmap[t])
+            if isinstance(c, LLVMCodeRet):
+                rets.append((c.val, body[-1].label))
+                c = LLVMCodeJ(cont.label)
+            body[-1].codes.append(c)
+
+        b.codes.append(LLVMCodeJ(body[0].label))
+        entry.codes[0:0] = allocas
+
+        # 返り値
+        if isinstance(call, LLVMCodeCall):
+            if len(rets) == 1:
+                result = rets[0][0]
+            else:
+                result = Operand(OType.NUMBERED_REG, val=caller.getNewRegNo())
+                cont.codes.insert(0, LLVMCodePhi(result, rets))
+            for x in self.cfg.blocks + body + [cont]:
+                for l in x.codes:
+                    l.replaceUse(call.retval, result)
+
+        i = self.cfg.blocks.index(b)
+        self.cfg.blocks[i + 1:i + 1] = body + [cont]
+        d = self.depth.get(b, 0)
+        for x in body + [cont]:
+            self.depth[x] = d
+        self.cfg.link()
+
+    def finish(self):
+        self.cfg.flatten()
+
+
+def run(fundefs, threshold:int) -> int:
+    ''' 全関数定義で呼び出しのインライン展開を行い，展開した箇所の数を返す '''
+    if threshold <= 0:
+        return 0
+    recursive = recursiveFunctions(fundefs)
+    counts = callCounts(fundefs)
+    table = {f.name: f for f in fundefs}
+    n = 0
+    # 呼び出し先は呼び出し元より前に定義されているので，前から順に処理すれば展開済みの本体が使われる
+    for f in fundefs:
+        inl = Inliner(f)
+        changed = True
+        while changed:
+            changed = False
+            for b, call, depth in inl.callSites():
+                callee = table.get(call.name)
+                if callee is None or callee is f or callee.name in recursive:
+                    continue
+                if call.count == 0:
+                    # プロファイルで一度も実行されなかった呼び出しは展開しない
+                    continue
+                limit = threshold * (1 + depth)
+                if counts.get(callee.name, 0) == 1:
+                    limit *= 4
+                if call.count is not None and call.count >= pgo.HOT_COUNT:
+                    limit *= 4
+                if size(callee) > limit or size(f) + size(callee) > MAX_CALLER_SIZE:
+                    continue
+                inl.inline(b, call, callee)
+                inl.finish()
+                counts[callee.name] -= 1
+                for l in callee.codes:
+                    if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                        counts[l.name] = counts.get(l.name, 0) + 1
+                n += 1
+                changed = True
+                break
+        inl.finish()
+    stats.count('inline', 'inlined call sites', n)
+    return n
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from llvmcode import *
+from modref import baseOf, getDefs
+from operand import OType
+import stats
+
+##
+## ループ不変式の移動（Loop-Invariant Code Motion）
+##   内側のループから順に，ループ内で値の変わらない純粋な命令と
+##   安全なロードをプリヘッダへ移動する
+##
+
+
+def isSafeDivisor(x) -> bool:
+    ''' 投機実行しても未定義動作にならない除数か（0 と -1 以外の定数） '''
+    return x.type == OType.CONSTANT and x.val not in (0, -1)
+
+
+def writtenInLoop(cfg, loop, defs, modref) -> set:
+    ''' ループ内で書き込まれうる記憶域（baseOf の値）の集合．不明な書き込みがあれば None '''
+    written = set()
+    for b in loop.blocks:
+        for l in b.codes:
+            if isinstance(l, LLVMCodeStore):
+                ptr = l.ptr
+            elif isinstance(l, LLVMCodeCallScanf):
+                ptr = l.arg
+            elif isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                m = modref.get(l.name)
+                if m is None:
+                    return None
+                written |= {('global', n) for n in m.writes}
+                continue
+            else:
+                continue
+            base = baseOf(ptr, defs)
+            if base is None:
+                return None
+            written.add(base)
+    return written
+
+
+def hoistLoop(cfg, loop, pre, modref) -> int:
+    ''' ループ loop の不変命令をプリヘッダ pre へ移動し，移動した命令数を返す '''
+    defs = getDefs(cfg.fundef)
+    where = {}
+    for b in cfg.blocks:
+        for l in b.codes:
+            r = l.getDef()
+            if r is not None:
+                where[r] = b
+    written = writtenInLoop(cfg, loop, defs, modref)
+
+    def invariant(x) -> bool:
+        if not isinstance(x, Operand) or x.type != OType.NUMBERED_REG:
+            return True
+        return where.get(x) not in loop.blocks
+
+    def safeLoad(l) -> bool:
+        if written is None:
+            return False
+        base = baseOf(l.ptr, defs)
+        if base is None or base in written:
+            return False
+        if l.ptr.type != OType.NUMBERED_REG:
+            return True
+        # 配列要素は添字が定数で範囲内のときだけ投機的に読み出してよい
+        gep = defs[l.ptr]
+        if not isinstance(gep, LLVMCodeGetelementptr):
+            return False
+        return gep.ptr.type == OType.CONSTANT and 0 <= gep.ptr.val < int(gep.size)
+
+    def hoistable(l) -> bool:
+        r = l.getDef()
+        if r is None or r.type != OType.NUMBERED_REG:
+            return False
+        if not all(invariant(x) for x in l.getUses()):
+            return False
+        if isinstance(l, LLVMCodeDiv):
+            return isSafeDivisor(l.arg2)
+        if isinstance(l, LLVMCodeLoad):
+            return safeLoad(l)
+        return l.isPure()
+
+    n = 0
+    changed = True
+    while changed:
+        changed = False
+        for b in cfg.blocks:
+            if b not in loop.blocks:
+                continue
+            for l in list(b.codes):
+                if hoistable(l):
+                    b.codes.remove(l)
+                    pre.insertBeforeTerminator(l)
+                    where[l.getDef()] = pre
+                    n += 1
+                    changed = True
+    return n
+
+
+def run(fundef, modref) -> int:
+    ''' 関数定義 fundef の全ループに対して不変式の移動を行う '''
+    cfg = CFG(fundef)
+    loops = cfg.findLoops()
+    if not loops:
+        return 0
+    n = 0
+    for loop in loops:
+        pre = cfg.ensurePreheader(loop)
+        n += hoistLoop(cfg, loop, pre, modref)
+    cfg.flatten()
+    stats.count('licm', 'hoisted instructions', n)
+    stats.count('licm', 'loops', len(loops))
+    return n
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import copy
 from enum import Enum
 from operand import Operand
 
@@ -23,6 +24,18 @@ class CmpType(Enum):
         elif op == '<':		return CmpType.SLT
         elif op == '<=':	return CmpType.SLE
 
+    def inverse(self):
+        ''' 否定した比較（a op b の否定が a inverse(op) b） '''
+        return {CmpType.EQ: CmpType.NE, CmpType.NE: CmpType.EQ,
+                CmpType.SGT: CmpType.SLE, CmpType.SLE: CmpType.SGT,
+                CmpType.SLT: CmpType.SGE, CmpType.SGE: CmpType.SLT}[self]
+
+    def swapped(self):
+        ''' 左右を入れ替えた比較（a op b と b swapped(op) a が同じ） '''
+        return {CmpType.EQ: CmpType.EQ, CmpType.NE: CmpType.NE,
+                CmpType.SGT: CmpType.SLT, CmpType.SLT: CmpType.SGT,
+                CmpType.SGE: CmpType.SLE, CmpType.SLE: CmpType.SGE}[self]
+
     def __str__(self):
         if   self == CmpType.EQ:	return "eq"
         elif self == CmpType.NE:	return "ne"
@@ -31,6 +44,10 @@ class CmpType(Enum):
         elif self == CmpType.SLT:	return "slt"
         elif self == CmpType.SLE:	return "sle"
 
+def wrap32(x:int) -> int:
+    ''' 32ビット符号付き整数に丸める '''
+    return (x + 0x80000000) % 0x100000000 - 0x80000000
+
 ##
 ## ラベル
 ##
@@ -42,14 +59,86 @@ class Labels(object):
     def __str__(self):
         return f"L{self.lab}"
 
+    def __eq__(self, other):
+        if not isinstance(other, Labels):
+            return NotImplemented
+        return self.lab == other.lab
+
+    def __hash__(self):
+        return hash(self.lab)
+
 
 ##
 ## LLVMコード
 ##
 class LLVMCode(object):
+    ''' LLVMコードの基底クラス
+            _result   : 定義するレジスタを保持する属性名（定義しなければ None）
+            _operands : 使用するオペランドを保持する属性名
+    '''
+    _result = None
+    _operands = ()
+
     def __init__(self):
         pass
 
+    def getDef(self) -> Operand:
+        ''' 命令が定義するレジスタ（定義しなければ None） '''
+        if self._result is None:
+            return None
+        return getattr(self, self._result)
+
+    def setDef(self, reg:Operand):
+        setattr(self, self._result, reg)
+
+    def getUses(self) -> list:
+        ''' 命令が使用するオペランドのリスト '''
+        return [getattr(self, a) for a in self._operands]
+
+    def mapUses(self, f):
+        ''' 使用オペランド x をすべて f(x) に置き換える '''
+        for a in self._operands:
+            setattr(self, a, f(getattr(self, a)))
+
+    def replaceUse(self, old:Operand, new:Operand):
+        ''' 使用オペランド old を new に置き換える '''
+        self.mapUses(lambda x: new if x == old else x)
+
+    def getTargets(self) -> list:
+        ''' 分岐先ラベルのリスト '''
+        return []
+
+    def mapTargets(self, f):
+        ''' 分岐先ラベル t をすべて f(t) に付け替える '''
+        pass
+
+    def retarget(self, old:Labels, new:Labels):
+        ''' 分岐先ラベル old を new に付け替える '''
+        self.mapTargets(lambda t: new if t == old else t)
+
+    def isTerminator(self) -> bool:
+        ''' 基本ブロックの終端命令かどうか '''
+        return False
+
+    def isPure(self) -> bool:
+        ''' メモリや入出力に触れず，結果が引数だけで決まる命令かどうか '''
+        return False
+
+    def clone(self):
+        ''' 命令の複製（オペランドは共有してよい不変値として扱う） '''
+        return copy.copy(self)
+
+    def evaluate(self, args:list):
+        ''' 使用オペランドの値 args から結果の値を計算する（計算できなければ None） '''
+        return None
+
+    def constValue(self):
+        ''' 使用オペランドがすべて定数のときの結果の値（求まらなければ None） '''
+        uses = self.getUses()
+        if not all(isinstance(x, Operand) and x.isConst() for x in uses):
+            return None
+        return self.evaluate([x.val for x in uses])
+
 
 class LLVMCodeGlobal(LLVMCode):
     ''' global 命令
@@ -63,6 +152,10 @@ class LLVMCodeGlobal(LLVMCode):
     def __str__(self):
         return f"@{self.name} = common global i32 0, align 4"
 
+    def declaration(self) -> str:
+        ''' 他のモジュールで定義した大域変数の宣言 '''
+        return f"@{self.name} = external global i32, align 4"
+
 class LLVMCodeGlobalArray(LLVMCode):
     '''
     global命令(配列)
@@ -76,6 +169,10 @@ class LLVMCodeGlobalArray(LLVMCode):
     def __str__(self):
         return f"@{self.name} = common global [{self.size} x i32] zeroinitializer, align 16"
 
+    def declaration(self) -> str:
+        ''' 他のモジュールで定義した大域変数の宣言 '''
+        return f"@{self.name} = external global [{self.size} x i32], align 16"
+
 class LLVMCodeAlloca(LLVMCode):
     ''' alloca命令
             %{name} = alloca i32, align 4    
@@ -94,13 +191,17 @@ class LLVMCodeStore(LLVMCode):
     ''' store 命令
             store i32 {argval}, i32* {ptr}, align 4
     '''
+    _operands = ('argval', 'ptr')
+
     def __init__(self, val:Operand, ptr:Operand):
         super().__init__()
         self.argval = val
         self.ptr = ptr
+        self.tbaa = None    # 型別名解析のメタデータ番号（付けなければ None）
 
     def __str__(self):
-        return f"store i32 {self.argval}, i32* {self.ptr}, align 4"
+        tag = "" if self.tbaa is None else f", !tbaa !{self.tbaa}"
+        return f"store i32 {self.argval}, i32* {self.ptr}, align 4{tag}"
 
 
 class LLVMCodeLoad(LLVMCode):
@@ -108,13 +209,22 @@ class LLVMCodeLoad(LLVMCode):
             {retval} = load i32, i32* {ptr}, align 4
     '''
 
+    _result = 'retval'
+    _operands = ('ptr',)
+
     def __init__(self, retval:Operand, ptr:Operand):
         super().__init__()
         self.retval = retval
         self.ptr = ptr
+        self.tbaa = None    # 型別名解析のメタデータ番号（付けなければ None）
+        self.range = None   # 値の範囲解析で求めた読み出す値の範囲 (lo, hi)
+        self.rangeMd = None # 値の範囲のメタデータ番号（付けなければ None）
 
     def __str__(self):
-        return f"{self.retval} = load i32, i32* {self.ptr}, align 4"
+        tag = "" if self.tbaa is None else f", !tbaa !{self.tbaa}"
+        if self.rangeMd is not None:
+            tag += f", !range !{self.rangeMd}"
+        return f"{self.retval} = load i32, i32* {self.ptr}, align 4{tag}"
 
 
 class LLVMCodeAdd(LLVMCode):
@@ -122,14 +232,26 @@ class LLVMCodeAdd(LLVMCode):
             {retval} = add nsw i32 {arg1}, {arg2}
     '''
 
-    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return wrap32(args[0] + args[1])
+
+    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand, nsw:bool=True):
         super().__init__()
         self.retval = retval
         self.arg1 = arg1
         self.arg2 = arg2
+        self.nsw = nsw      # 符号付きオーバーフローしないことを表す nsw を付けるか
+        self.nuw = False    # 符号なしオーバーフローしないことを表す nuw を付けるか
 
     def __str__(self):
-        return f"{self.retval} = add nsw i32 {self.arg1}, {self.arg2}"
+        flag = (" nuw" if self.nuw else "") + (" nsw" if self.nsw else "")
+        return f"{self.retval} = add{flag} i32 {self.arg1}, {self.arg2}"
 
 
 class LLVMCodeSub(LLVMCode):
@@ -137,14 +259,26 @@ class LLVMCodeSub(LLVMCode):
             {retval} = sub nsw i32 {self.arg1}, {self.arg2}
     '''
 
-    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return wrap32(args[0] - args[1])
+
+    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand, nsw:bool=True):
         super().__init__()
         self.retval = retval
         self.arg1 = arg1
         self.arg2 = arg2
+        self.nsw = nsw      # 符号付きオーバーフローしないことを表す nsw を付けるか
+        self.nuw = False    # 符号なしオーバーフローしないことを表す nuw を付けるか
 
     def __str__(self):
-        return f"{self.retval} = sub nsw i32 {self.arg1}, {self.arg2}"
+        flag = (" nuw" if self.nuw else "") + (" nsw" if self.nsw else "")
+        return f"{self.retval} = sub{flag} i32 {self.arg1}, {self.arg2}"
 
 
 class LLVMCodeMul(LLVMCode):
@@ -152,14 +286,26 @@ class LLVMCodeMul(LLVMCode):
             {retval} = mul nsw i32 {arg1}, {arg2}"
     '''
 
-    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return wrap32(args[0] * args[1])
+
+    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand, nsw:bool=True):
         super().__init__()
         self.retval = retval
         self.arg1 = arg1
         self.arg2 = arg2
+        self.nsw = nsw      # 符号付きオーバーフローしないことを表す nsw を付けるか
+        self.nuw = False    # 符号なしオーバーフローしないことを表す nuw を付けるか
 
     def __str__(self):
-        return f"{self.retval} = mul nsw i32 {self.arg1}, {self.arg2}"
+        flag = (" nuw" if self.nuw else "") + (" nsw" if self.nsw else "")
+        return f"{self.retval} = mul{flag} i32 {self.arg1}, {self.arg2}"
 
 
 class LLVMCodeDiv(LLVMCode):
@@ -167,6 +313,19 @@ class LLVMCodeDiv(LLVMCode):
             {retval} = sdiv i32 {arg1}, {arg2}
     '''
 
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        # 0 による除算と桁あふれは未定義なので畳み込まない（商は0方向へ切り捨て）
+        if args[1] == 0 or (args[0] == -0x80000000 and args[1] == -1):
+            return None
+        q = abs(args[0]) // abs(args[1])
+        return q if (args[0] < 0) == (args[1] < 0) else -q
+
     def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
         super().__init__()
         self.retval = retval
@@ -183,6 +342,16 @@ class LLVMCodeRet(LLVMCode):
             ret i32 {val}
     '''
 
+    def getUses(self) -> list:
+        return [] if self.val is None else [self.val]
+
+    def mapUses(self, f):
+        if self.val is not None:
+            self.val = f(self.val)
+
+    def isTerminator(self) -> bool:
+        return True
+
     def __init__(self, type:str, val:Operand=None):
         super().__init__()
         self.type = type
@@ -210,6 +379,9 @@ class LLVMCodeCallPrintf(LLVMCode):
         # printf関数の宣言
         print('declare i32 @printf(i8*, ...)', file=fp)
 
+    _result = 'res'
+    _operands = ('arg',)
+
     def __init__(self, res:Operand, arg:Operand):
         super().__init__()
         self.res = res
@@ -234,6 +406,9 @@ class LLVMCodeCallScanf(LLVMCode):
         # scanf関数の宣言
         print('declare i32 @scanf(i8*, ...)', file=fp)
 
+    _result = 'res'
+    _operands = ('arg',)
+
     def __init__(self, res:Operand, arg:Operand):
         super().__init__()
         self.res = res
@@ -243,11 +418,38 @@ class LLVMCodeCallScanf(LLVMCode):
         return f"{self.res} = call i32 (i8*, ...) @scanf(i8* getelementptr inbounds ([3 x i8], [3 x i8]* @.str.r, i64 0, i64 0), i32* {self.arg})"
 
 
+class LLVMCodeCallWriteInt(LLVMCodeCallPrintf):
+    ''' 出力をバッファに貯める実行時ライブラリによる write（--fast-io）
+            {res} = call i32 @pl.write_int(i32 {arg})
+    '''
+
+    def __str__(self):
+        return f"{self.res} = call i32 @pl.write_int(i32 {self.arg})"
+
+
+class LLVMCodeCallReadInt(LLVMCodeCallScanf):
+    ''' 入力をバッファに貯める実行時ライブラリによる read（--fast-io）
+            {res} = call i32 @pl.read_int(i32* {arg})
+    '''
+
+    def __str__(self):
+        return f"{self.res} = call i32 @pl.read_int(i32* {self.arg})"
+
+
 
 class LLVMCodeJ(LLVMCode):
     ''' br命令 （無条件ジャンプ）
             br label {arg1}
     '''
+    def getTargets(self) -> list:
+        return [self.arg1]
+
+    def mapTargets(self, f):
+        self.arg1 = f(self.arg1)
+
+    def isTerminator(self) -> bool:
+        return True
+
     def __init__(self, arg1:Labels):
         super().__init__()
         self.arg1 = arg1
@@ -260,14 +462,29 @@ class LLVMCodeBr(LLVMCode):
     ''' br命令（分岐命令） 
             br i1 {cond}, label {arg1}, label {arg2}
     '''
+    _operands = ('cond',)
+
+    def getTargets(self) -> list:
+        return [self.arg1, self.arg2]
+
+    def mapTargets(self, f):
+        self.arg1 = f(self.arg1)
+        self.arg2 = f(self.arg2)
+
+    def isTerminator(self) -> bool:
+        return True
+
     def __init__(self, cond:Operand, arg1:Labels, arg2:Labels):
         super().__init__()
         self.cond = cond
         self.arg1 = arg1
         self.arg2 = arg2
+        self.weights = None     # プロファイルから求めた (arg1 へ, arg2 へ) の分岐回数
+        self.prof = None        # 分岐の重みのメタデータ番号（付けなければ None）
 
     def __str__(self):
-        return f"br i1 {self.cond}, label %{self.arg1}, label %{self.arg2}"
+        prof = "" if self.prof is None else f", !prof !{self.prof}"
+        return f"br i1 {self.cond}, label %{self.arg1}, label %{self.arg2}{prof}"
 
 
 class LLVMCodeLabel(LLVMCode):
@@ -288,6 +505,18 @@ class LLVMCodeIcmp(LLVMCode):
             {retval} = icmp {cond} i32 {arg1}, {arg2}
     '''
 
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        a, b = args
+        return int({CmpType.EQ: a == b, CmpType.NE: a != b,
+                    CmpType.SGT: a > b, CmpType.SGE: a >= b,
+                    CmpType.SLT: a < b, CmpType.SLE: a <= b}[self.cond])
+
     def __init__(self, retval:Operand, cond:CmpType, arg1:Operand, arg2:Operand):
         super().__init__()
         self.retval = retval
@@ -304,10 +533,22 @@ class LLVMCodeCallVoid(LLVMCode):
             call void f([i32 v]*)
     '''
 
+    def getUses(self) -> list:
+        return list(self.arg)
+
+    def mapUses(self, f):
+        self.arg = [f(x) for x in self.arg]
+
+    def clone(self):
+        c = copy.copy(self)
+        c.arg = list(self.arg)
+        return c
+
     def __init__(self, name:Operand):
         super().__init__()
         self.name = name
         self.arg = []
+        self.count = None       # プロファイルから求めた呼び出し回数
 
     def __str__(self):
         r = f"call void @{self.name}("
@@ -322,11 +563,25 @@ class LLVMCodeCall(LLVMCode):
         {retval} = call i32 f([i32 v]*)
     '''
 
+    _result = 'retval'
+
+    def getUses(self) -> list:
+        return list(self.arg)
+
+    def mapUses(self, f):
+        self.arg = [f(x) for x in self.arg]
+
+    def clone(self):
+        c = copy.copy(self)
+        c.arg = list(self.arg)
+        return c
+
     def __init__(self, name:Operand):
         super().__init__()
         self.retval = None
         self.name = name
         self.arg = []
+        self.count = None       # プロファイルから求めた呼び出し回数
 
     def __str__(self):
         r = f"{self.retval} = call i32 @{self.name}("
@@ -337,34 +592,122 @@ class LLVMCodeCall(LLVMCode):
         return r
 
 
+class LLVMCodeCallParallel(LLVMCode):
+    '''
+    並列化した for ループの実行（実行時ライブラリの呼び出し）
+    {retval} = call i32 @pl.parallel_for(void (i32, i32, i32)* @{name}, i32 {lo}, i32 {hi})
+        ループ本体を切り出した関数 name を lo から hi までの範囲を分けて複数のスレッドで実行し，
+        ループを抜けたときの制御変数の値を返す
+    '''
+    _result = 'retval'
+    _operands = ('lo', 'hi')
+
+    def __init__(self, retval:Operand, name:str, lo:Operand, hi:Operand):
+        super().__init__()
+        self.retval = retval
+        self.name = name
+        self.lo = lo
+        self.hi = hi
+
+    def __str__(self):
+        return f"{self.retval} = call i32 @pl.parallel_for(void (i32, i32, i32)* @{self.name}, i32 {self.lo}, i32 {self.hi})"
+
+
+class LLVMCodeProfCount(LLVMCode):
+    '''
+    実行回数カウンタの加算（--instrument）
+    {retval} = atomicrmw add i64* getelementptr inbounds ([{size} x i64], [{size} x i64]* @pl.prof.counts, i64 0, i64 {index}), i64 1 monotonic
+        並列化したループの中でも数え落とさないように不可分に加算する
+    '''
+    _result = 'retval'
+
+    def __init__(self, retval:Operand, index:int, size:int):
+        super().__init__()
+        self.retval = retval
+        self.index = index
+        self.size = size
+
+    def __str__(self):
+        counter = f"getelementptr inbounds ([{self.size} x i64], [{self.size} x i64]* @pl.prof.counts, i64 0, i64 {self.index})"
+        return f"{self.retval} = atomicrmw add i64* {counter}, i64 1 monotonic"
+
+
+class LLVMCodeRtHook(LLVMCode):
+    '''
+    実行時プロファイラの呼び出し（--profile-runtime）
+        hook = 'frame'  : %pl.rt.frame = alloca [2 x i64], align 8
+        hook = 'report' : call void @pl.rt.report()
+        hook = 'enter'  : call void @pl.rt.enter(i32 {index}, [2 x i64]* %pl.rt.frame)
+        hook = 'exit'   : call void @pl.rt.exit(i32 {index}, [2 x i64]* %pl.rt.frame)
+    '''
+
+    def __init__(self, hook:str, index:int=0):
+        super().__init__()
+        self.hook = hook
+        self.index = index
+
+    def __str__(self):
+        if self.hook == 'frame':
+            return "%pl.rt.frame = alloca [2 x i64], align 8"
+        if self.hook == 'report':
+            return "call void @pl.rt.report()"
+        return f"call void @pl.rt.{self.hook}(i32 {self.index}, [2 x i64]* %pl.rt.frame)"
+
+
 class LLVMCodeSext(LLVMCode):
     '''
-    sext命令
-    {retval} = sext to i32 {v} to i64
+    sext命令（非負と分かれば zext 命令）
+    {retval} = sext i32 {v} to i64
     '''
+    _result = 'retval'
+    _operands = ('v',)
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return args[0]
+
     def __init__(self, retval:Operand, v:Operand):
         super().__init__()
         self.retval  = retval
         self.v = v
+        self.zext = False   # 値の範囲解析で非負と分かったら zext にする
 
     def __str__(self):
-        return f"{self.retval} = sext i32 {self.v} to i64"
+        op = "zext" if self.zext else "sext"
+        return f"{self.retval} = {op} i32 {self.v} to i64"
 
 
 class LLVMCodeGetelementptr(LLVMCode):
     '''
     getelementptr命令
-    {retval} = getelementptr inbounds [{size} x i32], [{size} x i32]* @{name}, i32 0, i64 {ptr}
+    {retval} = getelementptr inbounds [{size} x i32], [{size} x i32]* @{name}, i64 0, i64 {ptr}
+        offset が 0 でなければ，配列の先頭を offset 要素ずらした定数番地を基準にする
+    {retval} = getelementptr i32, i32* getelementptr ([{size} x i32], [{size} x i32]* @{name}, i64 0, i64 {offset}), i64 {ptr}
     '''
-    def __init__(self, retval:Operand, size:str, name:str, ptr:Operand):
+    _result = 'retval'
+    _operands = ('ptr',)
+
+    def isPure(self) -> bool:
+        return True
+
+    def __init__(self, retval:Operand, size:str, name:str, ptr:Operand, offset:int=0, idxtype:str='i64'):
         super().__init__()
         self.retval  = retval
         self.size = size
         self.name = name
         self.ptr = ptr
+        self.offset = offset      # 添字に加える定数
+        self.idxtype = idxtype    # 添字の型（'i64' または非負の 'i32'）
 
     def __str__(self):
-        return f"{self.retval} = getelementptr inbounds [{self.size} x i32], [{self.size} x i32]* @{self.name}, i64 0, i64 {self.ptr}"
+        if self.offset == 0:
+            return f"{self.retval} = getelementptr inbounds [{self.size} x i32], [{self.size} x i32]* @{self.name}, i64 0, {self.idxtype} {self.ptr}"
+        # ずらした基準番地が配列内（末尾の次まで）なら inbounds を付けられる
+        inbounds = " inbounds" if 0 <= self.offset <= int(self.size) else ""
+        base = f"getelementptr ([{self.size} x i32], [{self.size} x i32]* @{self.name}, i64 0, i64 {self.offset})"
+        return f"{self.retval} = getelementptr{inbounds} i32, i32* {base}, {self.idxtype} {self.ptr}"
 
 
 class LLVMCodeShl(LLVMCode):
@@ -372,14 +715,26 @@ class LLVMCodeShl(LLVMCode):
     shl命令
     {retval} = shl i32 {arg1}, {arg2}
     '''
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return wrap32(args[0] << args[1]) if 0 <= args[1] < 32 else None
+
     def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
         super().__init__()
         self.retval  = retval
         self.arg1 = arg1
         self.arg2 = arg2
+        self.nsw = False    # 値の範囲解析で桁あふれしないと分かったときに付ける
+        self.nuw = False
 
     def __str__(self):
-        return f"{self.retval} = shl i32 {self.arg1}, {self.arg2}"
+        flag = (" nuw" if self.nuw else "") + (" nsw" if self.nsw else "")
+        return f"{self.retval} = shl{flag} i32 {self.arg1}, {self.arg2}"
 
 
 class LLVMCodeAshr(LLVMCode):
@@ -387,6 +742,38 @@ class LLVMCodeAshr(LLVMCode):
     ashr命令
     {retval} = ashr i32 {arg1}, {arg2}
     '''
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return args[0] >> args[1] if 0 <= args[1] < 32 else None
+
+    def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
+        super().__init__()
+        self.retval  = retval
+        self.arg1 = arg1
+        self.arg2 = arg2
+
+    def __str__(self):
+        return f"{self.retval} = ashr i32 {self.arg1}, {self.arg2}"
+
+class LLVMCodeAnd(LLVMCode):
+    '''
+    and命令
+    {retval} = and i32 {arg1}, {arg2}
+    '''
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def isPure(self) -> bool:
+        return True
+
+    def evaluate(self, args:list):
+        return wrap32(args[0] & args[1])
+
     def __init__(self, retval:Operand, arg1:Operand, arg2:Operand):
         super().__init__()
         self.retval  = retval
@@ -394,4 +781,206 @@ class LLVMCodeAshr(LLVMCode):
         self.arg2 = arg2
 
     def __str__(self):
-        return f"{self.retval} = ashr i32 {self.arg1}, {self.arg2}"
\ No newline at end of file
+        return f"{self.retval} = and i32 {self.arg1}, {self.arg2}"
+
+class LLVMCodePhi(LLVMCode):
+    '''
+    phi命令
+    {retval} = phi {type} [ {v1}, %{l1} ], [ {v2}, %{l2} ], ...
+    '''
+    _result = 'retval'
+
+    def __init__(self, retval:Operand, incoming:list=None, type:str='i32'):
+        super().__init__()
+        self.retval = retval
+        self.incoming = [] if incoming is None else incoming   # (Operand, Labels) のリスト
+        self.type = type                                       # 'i32' または 'i32*'
+
+    def addIncoming(self, v:Operand, lab:Labels):
+        self.incoming.append((v, lab))
+
+    def getUses(self) -> list:
+        return [v for v, _ in self.incoming]
+
+    def mapUses(self, f):
+        self.incoming = [(f(v), l) for v, l in self.incoming]
+
+    def mapIncoming(self, f):
+        ''' 先行ブロックのラベル l をすべて f(l) に付け替える '''
+        self.incoming = [(v, f(l)) for v, l in self.incoming]
+
+    def retargetIncoming(self, old:Labels, new:Labels):
+        ''' 先行ブロック old からの入力を new からの入力とする '''
+        self.mapIncoming(lambda l: new if l == old else l)
+
+    def clone(self):
+        c = copy.copy(self)
+        c.incoming = list(self.incoming)
+        return c
+
+    def __str__(self):
+        r = ", ".join(f"[ {v}, %{l} ]" for v, l in self.incoming)
+        return f"{self.retval} = phi {self.type} {r}"
+
+
+class LLVMCodePtrAdd(LLVMCode):
+    '''
+    getelementptr命令（要素ポインタの移動）
+    {retval} = getelementptr inbounds i32, i32* {base}, i64 {offset}
+    '''
+    _result = 'retval'
+    _operands = ('base', 'offset')
+
+    def __init__(self, retval:Operand, base:Operand, offset:Operand):
+        super().__init__()
+        self.retval = retval
+        self.base = base
+        self.offset = offset
+
+    def isPure(self) -> bool:
+        return True
+
+    def __str__(self):
+        return f"{self.retval} = getelementptr inbounds i32, i32* {self.base}, i64 {self.offset}"
+
+
+##
+## ベクトル命令（<{width} x i32>）
+##
+def vecOperand(x, width:int) -> str:
+    '''
+    ベクトル命令のオペランドの表記
+        定数は全要素が等しいベクトル，整数のタプルは要素ごとの定数ベクトルとする
+    '''
+    if isinstance(x, Operand) and x.isConst():
+        x = (x.val,) * width
+    if isinstance(x, tuple):
+        return "<" + ", ".join(f"i32 {v}" for v in x) + ">"
+    return str(x)
+
+
+class LLVMCodeBitcast(LLVMCode):
+    '''
+    bitcast命令（要素ポインタをベクトルへのポインタに変換）
+    {retval} = bitcast i32* {ptr} to <{width} x i32>*
+    '''
+    _result = 'retval'
+    _operands = ('ptr',)
+
+    def __init__(self, retval:Operand, ptr:Operand, width:int):
+        super().__init__()
+        self.retval = retval
+        self.ptr = ptr
+        self.width = width
+
+    def isPure(self) -> bool:
+        return True
+
+    def __str__(self):
+        return f"{self.retval} = bitcast i32* {self.ptr} to <{self.width} x i32>*"
+
+
+class LLVMCodeVecLoad(LLVMCode):
+    '''
+    ベクトルの load 命令
+    {retval} = load <{width} x i32>, <{width} x i32>* {ptr}, align 4
+    '''
+    _result = 'retval'
+    _operands = ('ptr',)
+
+    def __init__(self, retval:Operand, ptr:Operand, width:int):
+        super().__init__()
+        self.retval = retval
+        self.ptr = ptr
+        self.width = width
+
+    def __str__(self):
+        t = f"<{self.width} x i32>"
+        return f"{self.retval} = load {t}, {t}* {self.ptr}, align 4"
+
+
+class LLVMCodeVecStore(LLVMCode):
+    '''
+    ベクトルの store 命令
+    store <{width} x i32> {argval}, <{width} x i32>* {ptr}, align 4
+    '''
+    _operands = ('argval', 'ptr')
+
+    def __init__(self, val:Operand, ptr:Operand, width:int):
+        super().__init__()
+        self.argval = val
+        self.ptr = ptr
+        self.width = width
+
+    def __str__(self):
+        t = f"<{self.width} x i32>"
+        return f"store {t} {vecOperand(self.argval, self.width)}, {t}* {self.ptr}, align 4"
+
+
+class LLVMCodeVecBinOp(LLVMCode):
+    '''
+    ベクトルの二項演算命令
+    {retval} = {op} <{width} x i32> {arg1}, {arg2}
+        op : 'add nsw', 'sub', 'mul nsw', 'sdiv', 'shl', 'ashr' など
+    '''
+    _result = 'retval'
+    _operands = ('arg1', 'arg2')
+
+    def __init__(self, retval:Operand, op:str, arg1, arg2, width:int):
+        super().__init__()
+        self.retval = retval
+        self.op = op
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.width = width
+
+    def isPure(self) -> bool:
+        return True
+
+    def __str__(self):
+        a = vecOperand(self.arg1, self.width)
+        b = vecOperand(self.arg2, self.width)
+        return f"{self.retval} = {self.op} <{self.width} x i32> {a}, {b}"
+
+
+class LLVMCodeInsertElement(LLVMCode):
+    '''
+    insertelement命令（未定義ベクトルの先頭要素に値を入れる）
+    {retval} = insertelement <{width} x i32> undef, i32 {val}, i32 0
+    '''
+    _result = 'retval'
+    _operands = ('val',)
+
+    def __init__(self, retval:Operand, val:Operand, width:int):
+        super().__init__()
+        self.retval = retval
+        self.val = val
+        self.width = width
+
+    def isPure(self) -> bool:
+        return True
+
+    def __str__(self):
+        return f"{self.retval} = insertelement <{self.width} x i32> undef, i32 {self.val}, i32 0"
+
+
+class LLVMCodeSplat(LLVMCode):
+    '''
+    shufflevector命令（先頭要素を全要素に複製する）
+    {retval} = shufflevector <{width} x i32> {vec}, <{width} x i32> undef, <{width} x i32> zeroinitializer
+    '''
+    _result = 'retval'
+    _operands = ('vec',)
+
+    def __init__(self, retval:Operand, vec:Operand, width:int):
+        super().__init__()
+        self.retval = retval
+        self.vec = vec
+        self.width = width
+
+    def isPure(self) -> bool:
+        return True
+
+    def __str__(self):
+        t = f"<{self.width} x i32>"
+        return f"{self.retval} = shufflevector {t} {self.vec}, {t} undef, {t} zeroinitializer"
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from llvmcode import *
+from modref import getDefs
+from indvar import findInductionVars, affine
+from operand import OType, Operand
+import dce
+import stats
+
+##
+## ループ強度低減（Loop Strength Reduction）
+##   a[f(i)]（f は帰納変数 i のアフィン式）の番地計算
+##       sext → getelementptr
+##   を，繰り返しごとに一定量進めるポインタ帰納変数に置き換える
+##
+
+
+def reduceLoop(cfg, loop, pre) -> int:
+    ''' ループ loop の配列番地計算をポインタ帰納変数に置き換え，置き換えた数を返す '''
+    fundef = cfg.fundef
+    defs = getDefs(fundef)
+    where = {}
+    for b in cfg.blocks:
+        for l in b.codes:
+            r = l.getDef()
+            if r is not None:
+                where[r] = b
+
+    def inloop(x) -> bool:
+        return x.type == OType.NUMBERED_REG and where.get(x) in loop.blocks
+
+    n = 0
+    for iv in findInductionVars(loop, defs):
+        # 配列名と定数項以外のアフィン式が等しいアクセスをまとめる
+        groups = {}
+        for b in cfg.blocks:
+            if b not in loop.blocks:
+                continue
+            for l in b.codes:
+                if not isinstance(l, LLVMCodeGetelementptr):
+                    continue
+                s = defs.get(l.ptr)
+                if isinstance(s, LLVMCodeSext):
+                    a = affine(s.v, iv.reg, inloop, defs)
+                elif l.idxtype == 'i32':
+                    a = affine(l.ptr, iv.reg, inloop, defs)
+                else:
+                    continue
+                if a is None or a.coef == 0:
+                    continue
+                groups.setdefault((l.name, a.key()), []).append((l, a.const + l.offset))
+
+        for (name, (coef, _)), members in groups.items():
+            base, c0 = min(members, key=lambda m: m[1])
+            p = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+
+            # プリヘッダで初回の番地を計算（帰納変数を初期値に置き換えて複製）
+            copies = {iv.reg: iv.init}
+
+            def materialize(x):
+                if x in copies:
+                    return copies[x]
+                if not isinstance(x, Operand) or not inloop(x):
+                    return x
+                c = defs[x].clone()
+                c.mapUses(materialize)
+                if isinstance(c, (LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul, LLVMCodeShl, LLVMCodeSext)):
+                    v = c.constValue()
+                    if v is not None:
+                        copies[x] = Operand(OType.CONSTANT, val=v)
+                        return copies[x]
+                c.setDef(Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo()))
+                pre.insertBeforeTerminator(c)
+                copies[x] = c.getDef()
+                return c.getDef()
+
+            start = materialize(base.retval)
+
+            # ヘッダの phi とラッチでの増分
+            next = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+            stride = Operand(OType.CONSTANT, val=coef * iv.step)
+            iv.latch.insertBeforeTerminator(LLVMCodePtrAdd(next, p, stride))
+            phis = loop.header.phis()
+            loop.header.codes.insert(len(phis), LLVMCodePhi(p, [(start, pre.label), (next, iv.latch.label)], 'i32*'))
+
+            # 各アクセスの番地を p からの定数オフセットで表す
+            for l, c in members:
+                b = where[l.retval]
+                if c == c0:
+                    b.codes[b.codes.index(l)] = LLVMCodePtrAdd(l.retval, p, Operand(OType.CONSTANT, val=0))
+                else:
+                    b.codes[b.codes.index(l)] = LLVMCodePtrAdd(l.retval, p, Operand(OType.CONSTANT, val=c - c0))
+                n += 1
+            stats.count('lsr', 'pointer induction variables')
+    return n
+
+
+def run(fundef) -> int:
+    ''' 関数定義 fundef の全ループに強度低減を行う '''
+    cfg = CFG(fundef)
+    loops = cfg.findLoops()
+    n = 0
+    for loop in loops:
+        if len(loop.latches) != 1:
+            continue
+        pre = cfg.ensurePreheader(loop)
+        n += reduceLoop(cfg, loop, pre)
+    cfg.flatten()
+    if n:
+        propagatePtrCopies(fundef)
+        dce.run(fundef)
+    stats.count('lsr', 'reduced array accesses', n)
+    return n
+
+
+def propagatePtrCopies(fundef):
+    ''' オフセット 0 の getelementptr をその基底ポインタで置き換える '''
+    copies = {}
+    for l in fundef.codes:
+        if isinstance(l, LLVMCodePtrAdd) and l.offset.isConst(0):
+            copies[l.retval] = l.base
+    if not copies:
+        return
+
+    def resolve(x):
+        while x in copies:
+            x = copies[x]
+        return x
+
+    for l in fundef.codes:
+        l.mapUses(resolve)
+    fundef.codes = [l for l in fundef.codes if l.getDef() not in copies]
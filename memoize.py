@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from callgraph import CallGraph
+from cfg import BasicBlock
+from fundef import Fundef
+from inline import recursiveFunctions
+from llvmcode import *
+from modref import analyzeModRef
+from operand import OType, Operand
+import stats
+
+##
+## 純粋な再帰関数のメモ化
+##   大域変数を読み書きせず入出力もしない（結果が引数だけで決まる）再帰関数 f を
+##       f      : 表を引き，あればその値を返し，なければ f.body を呼んで表に入れるラッパー
+##       f.body : 元の関数本体（再帰呼び出しはラッパー f を呼ぶ）
+##   に分ける．表は大きさ size（2のべき）のダイレクトマップ方式で，
+##       @f.memo.ok  : 使用中なら 1
+##       @f.memo.k{i}: i 番目の引数
+##       @f.memo.v   : 返り値
+##   の大域配列に置く．並列化したループから呼ばれうる関数は表の更新が競合するのでメモ化しない．
+##
+
+HASH_MUL = -1640531535      # 0x9E3779B1（フィボナッチハッシュの乗数）
+
+
+def candidates(fundefs) -> list:
+    ''' メモ化できる関数定義のリスト '''
+    modref = analyzeModRef(fundefs)
+    recursive = recursiveFunctions(fundefs)
+    graph = CallGraph(fundefs)
+    shared = set()
+    for name in graph.parallel:
+        shared |= graph.reachable(name)
+    result = []
+    for f in fundefs:
+        m = modref[f.name]
+        if (f.name != 'main' and f.rettype == 'i32' and f.params and f.name in recursive
+                and f.name not in shared and not (m.reads or m.writes or m.io)):
+            result.append(f)
+    return result
+
+
+def wrap(f, size:int) -> Fundef:
+    ''' 関数 f の本体を f.body に移し，表を引くラッパーを f として返す '''
+    name = f.name
+    f.name = f"{name}.body"
+    w = Fundef(name, 'i32')
+    w.params = list(f.params)
+    bits = size.bit_length() - 1
+
+    def reg() -> Operand:
+        return Operand(OType.NUMBERED_REG, val=w.getNewRegNo())
+
+    def const(v:int) -> Operand:
+        return Operand(OType.CONSTANT, val=v)
+
+    def slot(table:str) -> Operand:
+        p = reg()
+        blocks[-1].codes.append(LLVMCodeGetelementptr(p, size, f"{name}.memo.{table}", index, 0, 'i32'))
+        return p
+
+    # 引数を混ぜたハッシュ値の上位 bits ビットを表の位置とする
+    entry = BasicBlock(None)
+    blocks = [entry]
+    h = w.params[0]
+    for p in w.params[1:]:
+        t = reg()
+        entry.codes.append(LLVMCodeMul(t, h, const(31), nsw=False))
+        h = reg()
+        entry.codes.append(LLVMCodeAdd(h, t, p, nsw=False))
+    t = reg()
+    entry.codes.append(LLVMCodeMul(t, h, const(HASH_MUL), nsw=False))
+    s = reg()
+    entry.codes.append(LLVMCodeAshr(s, t, const(32 - bits)))
+    index = reg()
+    entry.codes.append(LLVMCodeAnd(index, s, const(size - 1)))
+
+    hit = BasicBlock(Labels(w.getNewLab()))
+    miss = BasicBlock(Labels(w.getNewLab()))
+
+    # 使用中で引数がすべて一致すれば表の値を返す
+    for table, arg in [('ok', const(1))] + [(f"k{i}", p) for i, p in enumerate(w.params)]:
+        v = reg()
+        blocks[-1].codes.append(LLVMCodeLoad(v, slot(table)))
+        c = reg()
+        blocks[-1].codes.append(LLVMCodeIcmp(c, CmpType.EQ, v, arg))
+        nxt = BasicBlock(Labels(w.getNewLab()))
+        blocks[-1].codes.append(LLVMCodeBr(c, nxt.label, miss.label))
+        blocks.append(nxt)
+    blocks[-1].codes.append(LLVMCodeJ(hit.label))
+
+    blocks.append(hit)
+    v = reg()
+    hit.codes.append(LLVMCodeLoad(v, slot('v')))
+    hit.codes.append(LLVMCodeRet('i32', v))
+
+    # なければ本体を呼んで表に入れる
+    blocks.append(miss)
+    r = reg()
+    call = LLVMCodeCall(f.name)
+    call.retval = r
+    call.arg = list(w.params)
+    miss.codes.append(call)
+    for i, p in enumerate(w.params):
+        miss.codes.append(LLVMCodeStore(p, slot(f"k{i}")))
+    miss.codes.append(LLVMCodeStore(r, slot('v')))
+    miss.codes.append(LLVMCodeStore(const(1), slot('ok')))
+    miss.codes.append(LLVMCodeRet('i32', r))
+
+    for b in blocks:
+        if b.label is not None:
+            w.codes.append(LLVMCodeLabel(b.label))
+        w.codes.extend(b.codes)
+    return w
+
+
+def run(fundefs, size:int) -> list:
+    ''' 純粋な再帰関数をメモ化し，表の大域配列定義のリストを返す '''
+    if size < 2 or size & (size - 1):
+        return []
+    tables = []
+    for f in candidates(fundefs):
+        w = wrap(f, size)
+        fundefs.insert(fundefs.index(f) + 1, w)
+        for table in ['ok', 'v'] + [f"k{i}" for i in range(len(w.params))]:
+            tables.append(LLVMCodeGlobalArray(f"{w.name}.memo.{table}", size))
+        stats.count('memoize', 'memoized functions')
+        stats.count('memoize', f"memoized {w.name} ({len(w.params)} args, {size} entries)")
+    return tables
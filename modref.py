@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import *
+from operand import OType, Operand
+
+
+class ModRef(object):
+    '''
+    関数の副作用情報クラス
+        reads  : 読み出す大域変数・大域配列の名前の集合
+        writes : 書き込む大域変数・大域配列の名前の集合
+        io     : read/write（scanf/printf）を行うか
+        calls  : 直接呼び出す関数名の集合
+    呼び出し先の情報は推移的に含まれる．
+    '''
+
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.io = False
+        self.calls = set()
+
+
+def getDefs(fundef) -> dict:
+    ''' 番号付きレジスタ → それを定義する命令 の表 '''
+    defs = {}
+    for l in fundef.codes:
+        r = l.getDef()
+        if r is not None:
+            defs[r] = l
+    return defs
+
+
+def baseOf(ptr:Operand, defs:dict, visiting:set=None):
+    '''
+    ポインタ ptr が指す記憶域
+        ('global', 名前) : 大域変数・大域配列
+        ('local', 名前)  : alloca された局所変数
+        None             : 不明
+    '''
+    if ptr.type == OType.GLOBAL_VAR:
+        return ('global', ptr.name)
+    if ptr.type == OType.NAMED_REG:
+        return ('local', ptr.name)
+    l = defs.get(ptr)
+    if isinstance(l, LLVMCodeGetelementptr):
+        return ('global', l.name)
+    if isinstance(l, LLVMCodePtrAdd):
+        return baseOf(l.base, defs, visiting)
+    if isinstance(l, LLVMCodePhi) and l.type == 'i32*':
+        # ポインタの phi は全入力が同じ記憶域を指すときだけ分かる
+        if visiting is None:
+            visiting = set()
+        if ptr in visiting:
+            return 'cycle'
+        visiting.add(ptr)
+        bases = {baseOf(v, defs, visiting) for v, _ in l.incoming} - {'cycle'}
+        if len(bases) == 1:
+            return bases.pop()
+    return None
+
+
+def directModRef(f) -> ModRef:
+    ''' 関数定義 f 自身の命令による副作用（呼び出し先の情報は含まない） '''
+    m = ModRef()
+    defs = getDefs(f)
+    for l in f.codes:
+        if isinstance(l, LLVMCodeLoad):
+            b = baseOf(l.ptr, defs)
+            if b is not None and b[0] == 'global':
+                m.reads.add(b[1])
+        elif isinstance(l, LLVMCodeStore):
+            b = baseOf(l.ptr, defs)
+            if b is not None and b[0] == 'global':
+                m.writes.add(b[1])
+        elif isinstance(l, LLVMCodeCallScanf):
+            m.io = True
+            b = baseOf(l.arg, defs)
+            if b is not None and b[0] == 'global':
+                m.writes.add(b[1])
+        elif isinstance(l, LLVMCodeCallPrintf):
+            m.io = True
+        elif isinstance(l, LLVMCodeProfCount):
+            m.writes.add('pl.prof.counts')
+        elif isinstance(l, LLVMCodeRtHook):
+            m.writes.add('pl.rt')
+        elif isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid, LLVMCodeCallParallel)):
+            m.calls.add(l.name)
+    return m
+
+
+def summarize(f, table:dict) -> ModRef:
+    '''
+    関数定義 f の ModRef を，f が呼び出す関数（f 自身を除く）の ModRef がすべて表 table に
+    そろっているものとして求める（構文解析の途中で，定義し終えた関数から順に求めるのに使う）
+    '''
+    m = directModRef(f)
+    for c in m.calls:
+        n = table.get(c)
+        if n is not None:
+            m.reads |= n.reads
+            m.writes |= n.writes
+            m.io = m.io or n.io
+    return m
+
+
+def analyzeModRef(fundefs) -> dict:
+    ''' 関数名 → ModRef の表を求める '''
+    table = {}
+    for f in fundefs:
+        table[f.name] = directModRef(f)
+
+    # 呼び出し先の副作用を推移的に合成
+    changed = True
+    while changed:
+        changed = False
+        for m in table.values():
+            for c in list(m.calls):
+                n = table.get(c)
+                if n is None:
+                    continue
+                before = (len(m.reads), len(m.writes), m.io)
+                m.reads |= n.reads
+                m.writes |= n.writes
+                m.io = m.io or n.io
+                if (len(m.reads), len(m.writes), m.io) != before:
+                    changed = True
+    return table
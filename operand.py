@@ -28,3 +28,20 @@ class Operand(object):
             return f"%{self.val}"
         elif self.type == OType.CONSTANT:
             return str(self.val)
+
+    def __eq__(self, other):
+        if not isinstance(other, Operand):
+            return NotImplemented
+        return (self.type, self.name, self.val) == (other.type, other.name, other.val)
+
+    def __hash__(self):
+        return hash((self.type, self.name, self.val))
+
+    def __repr__(self):
+        return str(self)
+
+    def isConst(self, val:int=None) -> bool:
+        ''' 定数（val 指定時はその値の定数）かどうか '''
+        if self.type != OType.CONSTANT:
+            return False
+        return val is None or self.val == val
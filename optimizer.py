@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import callgraph
+import inline
+import licm
+import lsr
+import memoize
+import optpool
+import parallel
+import partialeval
+import peephole
+import tailrec
+import unroll
+import vectorize
+import vrange
+from modref import analyzeModRef
+
+##
+## 最適化パスの実行順序
+##   level 0 : 最適化なし
+##   level 1 : 末尾再帰の除去，使われない手続き・関数の削除，定数引数の伝播，
+##             main からしか使われない大域変数の局所変数化，
+##             ループ不変式の移動，ループ強度低減，最後にのぞき穴最適化
+##   level 2 : ＋コンパイル時の部分評価，定数引数による関数の複製，インライン展開，
+##             4要素のベクトル化，ループ展開
+##   level 3 : 部分評価の予算と複製・インライン展開・ループ展開のしきい値を大きくし，
+##             8要素でベクトル化する
+##   --parallel を指定すると，インライン展開の後で独立な for ループを並列化する
+##   --memoize を指定すると，最後に純粋な再帰関数をメモ化する（最適化レベルによらない）
+##   level 1 以上では最後に値の範囲解析を行い，sext の除去と nsw・nuw・!range の付加をする
+##   --jobs を指定すると，手続き内の最適化（localPasses・finalPasses）をプロセスプールで関数ごとに並行して行う
+##
+
+
+class OptOptions(object):
+    '''
+    最適化の設定
+        level            : 最適化レベル（-O）
+        unrollThreshold  : 完全展開する本体の命令数 × 回数 の上限
+        unrollFactor     : 部分展開でまとめる回数（1 なら部分展開しない）
+        unrollBudget     : プログラム全体でループ展開により増やしてよい命令数
+        inlineThreshold  : ループ外の呼び出しでインライン展開する関数の命令数の上限
+        cloneThreshold   : 定数引数で複製する関数の命令数の上限
+        maxClones        : 作る複製の数の上限
+        vectorWidth      : ベクトル化の要素数（1 ならベクトル化しない）
+        evalBudget       : 部分評価でコンパイル時に実行する命令数の上限（0 なら部分評価しない）
+        parallel         : 独立な for ループを pthread で並列化するか（--parallel）
+        parallelMinChunk : 並列化したループで1スレッドが受け持つ最小の繰り返し回数
+        memoize          : 純粋な再帰関数をメモ化するか（--memoize）
+        memoSize         : メモ化の表の大きさ（2のべき）
+        jobs             : 手続き内の最適化を並行して行うワーカープロセスの数（1 なら並行しない）
+    '''
+
+    def __init__(self, level:int=0):
+        self.level = level
+        self.unrollThreshold = {2: 64, 3: 256}.get(level, 0)
+        self.unrollFactor = {2: 2, 3: 4}.get(level, 1)
+        self.unrollBudget = {2: 2000, 3: 8000}.get(level, 0)
+        self.inlineThreshold = {2: 30, 3: 80}.get(level, 0)
+        self.cloneThreshold = {2: 40, 3: 120}.get(level, 0)
+        self.maxClones = {2: 8, 3: 32}.get(level, 0)
+        self.vectorWidth = {2: 4, 3: 8}.get(level, 1)
+        self.evalBudget = {2: 100000, 3: 1000000}.get(level, 0)
+        self.parallel = False
+        self.parallelMinChunk = 10000
+        self.memoize = False
+        self.memoSize = 4096
+        self.jobs = 1
+
+
+def optimize(fundefs, options:OptOptions) -> list:
+    '''
+    関数定義のリスト fundefs を設定 options に従って最適化する
+    最適化で必要になった大域変数の定義（LLVMCode のリスト）を返す
+    '''
+    if options.level > 0:
+        optimizeFunctions(fundefs, options)
+    globals = []
+    if options.memoize:
+        globals += memoize.run(fundefs, options.memoSize)
+    if options.level > 0:
+        vrange.run(fundefs)
+    return globals
+
+
+def optimizeFunctions(fundefs, options:OptOptions):
+    ''' 最適化レベルに応じたパスを実行する '''
+    callgraph.removeDead(fundefs)
+    if partialeval.run(fundefs, options.evalBudget):
+        callgraph.removeDead(fundefs)
+    for f in fundefs:
+        tailrec.run(f)
+    callgraph.propagateConstantArgs(fundefs)
+    callgraph.specializeHotCalls(fundefs, options.cloneThreshold, options.maxClones)
+    inline.run(fundefs, options.inlineThreshold)
+    callgraph.removeDead(fundefs)
+    if options.parallel:
+        parallel.run(fundefs, options.parallelMinChunk)
+    callgraph.demoteMainGlobals(fundefs)
+    modref = analyzeModRef(fundefs)
+    budget = unroll.UnrollBudget(options.unrollBudget)
+    unrolling = options.unrollThreshold > 0 or options.unrollFactor > 1
+    if options.jobs > 1 and len(fundefs) > 1:
+        # ループ展開は前の関数で使った残りの予算を使うので，親プロセスで元の順に行う
+        with optpool.Pool(options.jobs) as pool:
+            pool.map(fundefs, localPasses, modref, options.vectorWidth)
+            if unrolling:
+                for f in fundefs:
+                    unroll.run(f, options.unrollThreshold, options.unrollFactor, budget)
+            pool.map(fundefs, finalPasses)
+        return
+    for f in fundefs:
+        localPasses(f, modref, options.vectorWidth)
+        if unrolling:
+            unroll.run(f, options.unrollThreshold, options.unrollFactor, budget)
+    for f in fundefs:
+        finalPasses(f)
+
+
+def localPasses(f, modref:dict, width:int):
+    ''' 関数定義 f だけを見る最適化（手続き間の解析結果 modref は最適化の前に求めておく） '''
+    licm.run(f, modref)
+    vectorize.run(f, width)
+    lsr.run(f)
+
+
+def finalPasses(f):
+    ''' 最後に1度だけ行う関数定義 f の最適化 '''
+    peephole.run(f)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import stats
+
+##
+## 関数ごとの最適化のプロセスプールでの実行（--jobs N）
+##   手続き内の最適化パスは関数定義ごとに独立なので，関数定義を pickle で直列化して
+##   ワーカープロセスに送り，最適化した関数定義を受け取って元の位置に戻す．
+##   結果は元の順に並べるので，出力は1プロセスで最適化したときと同じになる．
+##   ワーカーで数えた統計情報は親プロセスの統計情報に足し込む．
+##   手続き間の最適化と，プログラム全体で予算を分け合うループ展開は親プロセスで行う．
+##
+
+
+def work(stage, data:bytes, args:tuple) -> bytes:
+    ''' ワーカーで関数定義 data に stage(f, *args) を適用し，結果と統計情報を直列化して返す '''
+    stats.counters.clear()
+    f = pickle.loads(data)
+    stage(f, *args)
+    return pickle.dumps((f, stats.counters), pickle.HIGHEST_PROTOCOL)
+
+
+class Pool(object):
+    '''
+    最適化のワーカープロセスのプール
+        jobs : ワーカープロセスの数
+    '''
+
+    def __init__(self, jobs:int):
+        self.jobs = jobs
+        self.executor = ProcessPoolExecutor(max_workers=jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown()
+
+    def map(self, fundefs, stage, *args):
+        '''
+        関数定義のリスト fundefs のそれぞれに stage(f, *args) をワーカーで適用し，
+        fundefs の要素を最適化した関数定義で置き換える
+            stage と args はワーカーに送れる（モジュールの最上位で定義した関数と pickle できる値）こと
+        '''
+        data = [pickle.dumps(f, pickle.HIGHEST_PROTOCOL) for f in fundefs]
+        stats.count('optpool', 'functions sent', len(data))
+        stats.count('optpool', 'bytes sent', sum(len(d) for d in data))
+        # ワーカーごとにまとめて送り，やり取りの回数を減らす
+        chunk = max(1, len(data) // (4 * self.jobs))
+        results = self.executor.map(work, repeat(stage), data, repeat(args), chunksize=chunk)
+        for i, r in enumerate(results):
+            fundefs[i], counters = pickle.loads(r)
+            for (group, name), n in counters.items():
+                stats.count(group, name, n)
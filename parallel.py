@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from fundef import Fundef
+from llvmcode import *
+from modref import analyzeModRef, getDefs
+from indvar import findInductionVars, affine, liveOutOnlyNext
+from operand import OType, Operand
+import stats
+
+##
+## for ループの自動並列化
+##   繰り返しどうしが独立な最外ループの本体を関数
+##       define void @{関数名}.par{n}(i32 %lo, i32 %hi, i32 %last)
+##   に切り出し，元のループを実行時ライブラリの pl.parallel_for の呼び出しに置き換える．
+##   pl.parallel_for は繰り返しの範囲をスレッド数（環境変数 PL_NUM_THREADS，
+##   未設定ならオンラインの CPU 数）に分け，pthread で並列に実行する．
+##
+##   繰り返しが独立といえるのは次の場合
+##     - 配列への書き込みは，配列ごとに1つの添字 c * i + (ループ不変) （c ≠ 0）だけ
+##     - 書き込む配列の読み出しは，書き込みと同じ添字だけ
+##     - 大域変数への書き込みは，同じ繰り返しで書き込んだ後にしか読まない（スレッドごとの複製を使い，
+##       最後の範囲を受け持つスレッドが最後の値を書き戻す）
+##     - 入出力をせず，呼び出す関数は大域変数に書き込まず入出力もしない
+##
+
+
+class ParallelLoop(object):
+    '''
+    並列化できるループの情報
+        iv      : 帰納変数（InductionVar）
+        cond    : ラッチの条件（icmp slt iv, upper）
+        exit    : 出口ブロック
+        private : スレッドごとに複製する大域変数名の集合
+        locals  : ループ内でだけ使う局所変数名の集合（切り出した関数の局所変数にする）
+        outside : ループ外で定義され，ループ内で使われる値（切り出した関数で計算し直す）
+    '''
+
+    def __init__(self, loop, iv, cond, exit, private, locals, outside):
+        self.loop = loop
+        self.iv = iv
+        self.cond = cond
+        self.exit = exit
+        self.private = private
+        self.locals = locals
+        self.outside = outside
+
+
+def indexOf(gep, iv, inloop, defs):
+    ''' getelementptr の添字の帰納変数についてのアフィン式（求まらなければ None） '''
+    s = defs.get(gep.ptr)
+    x = s.v if isinstance(s, LLVMCodeSext) else gep.ptr
+    a = affine(x, iv.reg, inloop, defs)
+    if a is None:
+        return None
+    return (a.key(), a.const + gep.offset)
+
+
+def analyze(cfg, loop, defs:dict, modref:dict, minTrip:int):
+    ''' ループ loop が並列化できるなら ParallelLoop を返す '''
+    if loop.parent is not None or len(loop.latches) != 1:
+        return None
+    header = loop.header
+    latch = loop.latches[0]
+    exits = loop.exits()
+    br = latch.terminator()
+    if len(exits) != 1 or not isinstance(br, LLVMCodeBr) or br.arg1 != header.label or br.arg2 != exits[0].label:
+        return None
+    exit = exits[0]
+    ivs = [iv for iv in findInductionVars(loop, defs) if iv.step == 1]
+    if len(ivs) != 1 or header.phis() != [ivs[0].phi]:
+        return None
+    iv = ivs[0]
+
+    inside = set()
+    where = {}
+    for b in loop.blocks:
+        for l in b.codes:
+            if l.getDef() is not None:
+                inside.add(l.getDef())
+                where[l.getDef()] = b
+
+    def inloop(x) -> bool:
+        return x in inside
+
+    cond = defs.get(br.cond)
+    if not (isinstance(cond, LLVMCodeIcmp) and cond.cond == CmpType.SLT and cond.arg1 == iv.reg
+            and cond in latch.codes and not inloop(cond.arg2)):
+        return None
+    if iv.init.isConst() and cond.arg2.isConst() and cond.arg2.val - iv.init.val + 1 < minTrip:
+        return None
+    if not liveOutOnlyNext(cfg, loop, iv, exit):
+        return None
+
+    # ループ内のメモリアクセスと呼び出し
+    writes = {}         # 配列名 → 書き込みの添字の集合
+    reads = []          # (配列名, 添字)
+    scalarStores = {}   # 大域変数名 → ストアした (ブロック, 位置) のリスト
+    scalarLoads = {}    # 大域変数名 → ロードした (ブロック, 位置) のリスト
+    localStores = {}    # 局所変数名 → ストアした (ブロック, 位置) のリスト
+    localLoads = {}     # 局所変数名 → ロードした (ブロック, 位置) のリスト
+    calleeReads = set()
+    for b in loop.blocks:
+        for k, l in enumerate(b.codes):
+            if isinstance(l, (LLVMCodeLoad, LLVMCodeStore)):
+                g = defs.get(l.ptr)
+                if l.ptr.type == OType.GLOBAL_VAR:
+                    table = scalarStores if isinstance(l, LLVMCodeStore) else scalarLoads
+                    table.setdefault(l.ptr.name, []).append((b, k))
+                elif l.ptr.type == OType.NAMED_REG:
+                    table = localStores if isinstance(l, LLVMCodeStore) else localLoads
+                    table.setdefault(l.ptr.name, []).append((b, k))
+                elif isinstance(g, LLVMCodeGetelementptr):
+                    index = indexOf(g, iv, inloop, defs)
+                    if isinstance(l, LLVMCodeStore):
+                        if index is None or index[0][0] == 0:
+                            return None
+                        writes.setdefault(g.name, set()).add(index)
+                    else:
+                        reads.append((g.name, index))
+                else:
+                    return None
+            elif isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                m = modref.get(l.name)
+                if m is None or m.writes or m.io:
+                    return None
+                calleeReads |= m.reads
+            elif isinstance(l, (LLVMCodeCallPrintf, LLVMCodeCallScanf, LLVMCodeCallParallel, LLVMCodeAlloca)):
+                return None
+    if not writes:
+        return None
+    for name, index in writes.items():
+        if len(index) != 1 or name in calleeReads:
+            return None
+    for name, index in reads:
+        if name in writes and index not in writes[name]:
+            return None
+
+    def storedBefore(loads, stores) -> bool:
+        ''' どのロードの前にも同じ繰り返しでストアが実行されているか '''
+        for lb, lk in loads:
+            if not any((b is lb and k < lk) or (b is not lb and cfg.dominates(b, lb)) for b, k in stores):
+                return False
+        return True
+
+    # 書き込む大域変数は，毎回の繰り返しで書き込み，読む前に同じ繰り返しで書き込んでいること
+    for name, stores in scalarStores.items():
+        if name in calleeReads:
+            return None
+        if not any(cfg.dominates(b, latch) for b, _ in stores):
+            return None
+        if not storedBefore(scalarLoads.get(name, []), stores):
+            return None
+
+    # 局所変数は，ループ外で読まず，読む前に同じ繰り返しで書き込んでいること
+    for name in set(localStores) | set(localLoads):
+        if not storedBefore(localLoads.get(name, []), localStores.get(name, [])):
+            return None
+        ptr = Operand(OType.NAMED_REG, name=name)
+        for b in cfg.blocks:
+            if b not in loop.blocks and any(isinstance(l, LLVMCodeLoad) and l.ptr == ptr for l in b.codes):
+                return None
+
+    # ループ外で定義された値は，切り出した関数で計算し直せるものに限る
+    #   （書き込む配列・大域変数のロードは他のスレッドの書き込みと競合するので不可）
+    written = set(writes) | set(scalarStores)
+    outside = []
+
+    def rematerializable(x) -> bool:
+        if not isinstance(x, Operand) or x.type in (OType.CONSTANT, OType.GLOBAL_VAR) or x in inside:
+            return True
+        if x in outside or (x.type == OType.NAMED_REG and x.name in localStores):
+            return True
+        l = defs.get(x)
+        if l is None:
+            return False
+        if isinstance(l, LLVMCodeLoad):
+            g = defs.get(l.ptr)
+            name = l.ptr.name if l.ptr.type == OType.GLOBAL_VAR else (g.name if isinstance(g, LLVMCodeGetelementptr) else None)
+            if name is None or name in written:
+                return False
+        elif not l.isPure():
+            return False
+        if not all(rematerializable(y) for y in l.getUses()):
+            return False
+        outside.append(x)
+        return True
+
+    for b in loop.blocks:
+        for l in b.codes:
+            if l is iv.phi:
+                continue
+            uses = [l.arg1] if l is cond else l.getUses()
+            if not all(rematerializable(x) for x in uses):
+                return None
+    return ParallelLoop(loop, iv, cond, exit, set(scalarStores), set(localStores), outside)
+
+
+def outline(cfg, p:ParallelLoop, pre:BasicBlock, name:str) -> Fundef:
+    ''' ループ p の本体を関数 name に切り出し，元のループを pl.parallel_for の呼び出しに置き換える '''
+    fundef = cfg.fundef
+    loop = p.loop
+    iv = p.iv
+    upper = p.cond.arg2
+    defs = getDefs(fundef)
+
+    worker = Fundef(name, 'void')
+    worker.cntr = fundef.cntr
+    worker.lcount = fundef.lcount
+    lo = Operand(OType.NAMED_REG, name='lo')
+    hi = Operand(OType.NAMED_REG, name='hi')
+    last = Operand(OType.NAMED_REG, name='last')
+    worker.params = [lo, hi, last]
+
+    # 入口: 局所変数と大域変数の複製，ループ外の値の再計算
+    entry = BasicBlock(None)
+    valmap = {}
+    for v in sorted(p.locals):
+        entry.codes.append(LLVMCodeAlloca(v))
+    for g in sorted(p.private):
+        entry.codes.append(LLVMCodeAlloca(f"{g}.priv"))
+        valmap[Operand(OType.GLOBAL_VAR, name=g)] = Operand(OType.NAMED_REG, name=f"{g}.priv")
+    for x in p.outside:
+        c = defs[x].clone()
+        c.mapUses(lambda y: valmap.get(y, y))
+        c.setDef(Operand(OType.NUMBERED_REG, val=worker.getNewRegNo()))
+        entry.codes.append(c)
+        valmap[x] = c.getDef()
+    start = BasicBlock(Labels(worker.getNewLab()))
+    entry.codes.append(LLVMCodeJ(start.label))
+    start.codes.append(LLVMCodeJ(loop.header.label))
+
+    # 出口: 最後の範囲を受け持つスレッドが複製した大域変数を書き戻す
+    done = BasicBlock(Labels(worker.getNewLab()))
+    tail = [done]
+    if p.private:
+        back = BasicBlock(Labels(worker.getNewLab()))
+        ret = BasicBlock(Labels(worker.getNewLab()))
+        t = Operand(OType.NUMBERED_REG, val=worker.getNewRegNo())
+        done.codes.append(LLVMCodeIcmp(t, CmpType.NE, last, Operand(OType.CONSTANT, val=0)))
+        done.codes.append(LLVMCodeBr(t, back.label, ret.label))
+        for g in sorted(p.private):
+            v = Operand(OType.NUMBERED_REG, val=worker.getNewRegNo())
+            back.codes.append(LLVMCodeLoad(v, Operand(OType.NAMED_REG, name=f"{g}.priv")))
+            back.codes.append(LLVMCodeStore(v, Operand(OType.GLOBAL_VAR, name=g)))
+        back.codes.append(LLVMCodeJ(ret.label))
+        ret.codes.append(LLVMCodeRet('void'))
+        tail += [back, ret]
+    else:
+        done.codes.append(LLVMCodeRet('void'))
+
+    # ループ本体を移す
+    body = [b for b in cfg.blocks if b in loop.blocks]
+    for b in body:
+        for l in b.codes:
+            if l is not iv.phi:
+                l.mapUses(lambda y: valmap.get(y, y))
+    p.cond.arg2 = hi
+    iv.phi.incoming = [(lo, start.label) if l == pre.label else (v, l) for v, l in iv.phi.incoming]
+    iv.latch.terminator().retarget(p.exit.label, done.label)
+    worker.codes = []
+    for b in [entry, start] + body + tail:
+        if b.label is not None:
+            worker.codes.append(LLVMCodeLabel(b.label))
+        worker.codes.extend(b.codes)
+
+    # 元のループを呼び出しに置き換える
+    r = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+    pre.codes[-1:] = [LLVMCodeCallParallel(r, name, iv.init, upper), LLVMCodeJ(p.exit.label)]
+    for phi in p.exit.phis():
+        phi.incoming = [(r, pre.label) if l == iv.latch.label else (v, l) for v, l in phi.incoming]
+    cfg.blocks = [b for b in cfg.blocks if b not in loop.blocks]
+    cfg.link()
+    return worker
+
+
+def run(fundefs, minChunk:int) -> int:
+    ''' 全関数定義の独立な for ループを並列化し，並列化したループの数を返す '''
+    modref = analyzeModRef(fundefs)
+    n = 0
+    for f in list(fundefs):
+        cfg = CFG(f)
+        count = 0
+        for loop in cfg.findLoops():
+            if loop.parent is not None:
+                continue
+            pre = cfg.ensurePreheader(loop)
+            cfg.flatten()
+            p = analyze(cfg, loop, getDefs(f), modref, 2 * minChunk)
+            if p is None:
+                continue
+            count += 1
+            worker = outline(cfg, p, pre, f"{f.name}.par{count}")
+            cfg.flatten()
+            fundefs.insert(fundefs.index(f), worker)
+            stats.count('parallel', 'parallelized loops')
+        n += count
+    return n
+
+
+##
+## 実行時ライブラリ
+##
+RUNTIME = r'''
+%pl.task = type { void (i32, i32, i32)*, i32, i32, i32 }
+
+declare i32 @pthread_create(i64*, i8*, i8* (i8*)*, i8*)
+declare i32 @pthread_join(i64, i8**)
+declare i8* @getenv(i8*)
+declare i32 @atoi(i8*)
+declare i64 @sysconf(i32)
+@.str.threads = private unnamed_addr constant [15 x i8] c"PL_NUM_THREADS\00", align 1
+
+define internal i8* @pl.thread(i8* %arg) nounwind {
+    %task = bitcast i8* %arg to %pl.task*
+    %fp = getelementptr %pl.task, %pl.task* %task, i32 0, i32 0
+    %f = load void (i32, i32, i32)*, void (i32, i32, i32)** %fp, align 8
+    %lop = getelementptr %pl.task, %pl.task* %task, i32 0, i32 1
+    %lo = load i32, i32* %lop, align 4
+    %hip = getelementptr %pl.task, %pl.task* %task, i32 0, i32 2
+    %hi = load i32, i32* %hip, align 4
+    %lastp = getelementptr %pl.task, %pl.task* %task, i32 0, i32 3
+    %last = load i32, i32* %lastp, align 4
+    call void %f(i32 %lo, i32 %hi, i32 %last)
+    ret i8* null
+}
+
+define internal i32 @pl.threads() nounwind {
+    %s = call i8* @getenv(i8* getelementptr inbounds ([15 x i8], [15 x i8]* @.str.threads, i64 0, i64 0))
+    %unset = icmp eq i8* %s, null
+    br i1 %unset, label %cpus, label %env
+env:
+    %n = call i32 @atoi(i8* %s)
+    br label %clamp
+cpus:
+    %c = call i64 @sysconf(i32 84)
+    %c32 = trunc i64 %c to i32
+    br label %clamp
+clamp:
+    %v = phi i32 [ %n, %env ], [ %c32, %cpus ]
+    %small = icmp slt i32 %v, 1
+    %v1 = select i1 %small, i32 1, i32 %v
+    %large = icmp sgt i32 %v1, 64
+    %v2 = select i1 %large, i32 64, i32 %v1
+    ret i32 %v2
+}
+
+define internal i32 @pl.parallel_for(void (i32, i32, i32)* %f, i32 %lo, i32 %hi) nounwind {
+entry:
+    %empty = icmp slt i32 %hi, %lo
+    %end = select i1 %empty, i32 %lo, i32 %hi
+    %d = sub i32 %end, %lo
+    %trip = add i32 %d, 1
+    %want = call i32 @pl.threads()
+    %most = sdiv i32 %trip, {MIN_CHUNK}
+    %few = icmp slt i32 %most, %want
+    %n = select i1 %few, i32 %most, i32 %want
+    %serial = icmp sle i32 %n, 1
+    br i1 %serial, label %one, label %many
+one:
+    call void %f(i32 %lo, i32 %end, i32 1)
+    br label %done
+many:
+    %tasks = alloca %pl.task, i32 %n, align 8
+    %tids = alloca i64, i32 %n, align 8
+    %chunk = sdiv i32 %trip, %n
+    %rem = srem i32 %trip, %n
+    br label %spawn
+spawn:
+    %k = phi i32 [ 0, %many ], [ %k1, %spawned ]
+    %first = phi i32 [ %lo, %many ], [ %next, %spawned ]
+    %extra = icmp slt i32 %k, %rem
+    %ext = zext i1 %extra to i32
+    %len = add i32 %chunk, %ext
+    %next = add i32 %first, %len
+    %stop = sub i32 %next, 1
+    %k1 = add i32 %k, 1
+    %islast = icmp eq i32 %k1, %n
+    %last = zext i1 %islast to i32
+    %t = getelementptr %pl.task, %pl.task* %tasks, i32 %k
+    %tf = getelementptr %pl.task, %pl.task* %t, i32 0, i32 0
+    store void (i32, i32, i32)* %f, void (i32, i32, i32)** %tf, align 8
+    %tlo = getelementptr %pl.task, %pl.task* %t, i32 0, i32 1
+    store i32 %first, i32* %tlo, align 4
+    %thi = getelementptr %pl.task, %pl.task* %t, i32 0, i32 2
+    store i32 %stop, i32* %thi, align 4
+    %tlast = getelementptr %pl.task, %pl.task* %t, i32 0, i32 3
+    store i32 %last, i32* %tlast, align 4
+    %tid = getelementptr i64, i64* %tids, i32 %k
+    %targ = bitcast %pl.task* %t to i8*
+    %rc = call i32 @pthread_create(i64* %tid, i8* null, i8* (i8*)* @pl.thread, i8* %targ)
+    %failed = icmp ne i32 %rc, 0
+    br i1 %failed, label %inline, label %spawned
+inline:
+    ; スレッドを作れなければこのスレッドで実行し，join の対象から外す
+    store i64 0, i64* %tid, align 8
+    %r = call i8* @pl.thread(i8* %targ)
+    br label %spawned
+spawned:
+    %more = icmp slt i32 %k1, %n
+    br i1 %more, label %spawn, label %join
+join:
+    %j = phi i32 [ 0, %spawned ], [ %j1, %joined ]
+    %jp = getelementptr i64, i64* %tids, i32 %j
+    %jt = load i64, i64* %jp, align 8
+    %skip = icmp eq i64 %jt, 0
+    br i1 %skip, label %joined, label %wait
+wait:
+    %rj = call i32 @pthread_join(i64 %jt, i8** null)
+    br label %joined
+joined:
+    %j1 = add i32 %j, 1
+    %jmore = icmp slt i32 %j1, %n
+    br i1 %jmore, label %join, label %done
+done:
+    %ret = add i32 %end, 1
+    ret i32 %ret
+}
+'''
+
+
+def printRuntime(fundefs, fp, minChunk:int):
+    ''' 並列化したループがあれば実行時ライブラリを出力する '''
+    if not any(isinstance(l, LLVMCodeCallParallel) for f in fundefs for l in f.codes):
+        return
+    print(RUNTIME.replace('{MIN_CHUNK}', str(max(minChunk, 1))), end='', file=fp)
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from llvmcode import *
+from modref import analyzeModRef
+from operand import OType, Operand
+import stats
+
+##
+## コンパイル時の部分評価
+##   関数定義の命令列を抽象機械で実際に実行し，入力に依存しない部分を結果で置き換える
+##   - main が入力なしに（命令数の予算内で）終われば，main を定数を出力する printf の列にする
+##   - 途中で read に出会えば，main のループに含まれない命令のうち最後に実行したものの直前までを
+##     「出力済みの定数」と「大域変数・局所変数の値のストア」に置き換え，その命令から続ける
+##   - 大域変数を読み書きせず入出力もしない関数の，定数引数での呼び出しを返り値で置き換える
+##   0 による除算・符号付きオーバーフロー・範囲外の添字・未初期化の局所変数の読み出しに
+##   出会った場合も評価を打ち切る（実行時と同じ結果になることを保証できないため）
+##
+
+MAX_OUTPUTS = 10000     # 定数にする出力の数の上限
+MAX_STORES = 1000       # 途中の状態を書き戻すストアの数の上限
+MAX_DEPTH = 150         # 呼び出しの深さの上限
+
+
+class Stop(Exception):
+    ''' 入力・予算切れ・未定義動作のためにコンパイル時の実行を打ち切る '''
+    pass
+
+
+class Frame(object):
+    '''
+    呼び出し1回分の実行状態
+        regs   : 番号付きレジスタの番号 → 値
+        params : 仮引数の名前 → 値
+        locals : alloca された局所変数の名前 → 値（未初期化なら None）
+    '''
+
+    def __init__(self, fundef, args:list):
+        self.fundef = fundef
+        self.regs = {}
+        self.params = {p.name: v for p, v in zip(fundef.params, args)}
+        self.locals = {}
+
+
+class Snapshot(object):
+    '''
+    main のループに含まれないブロックの途中の実行状態
+        block   : 実行中のブロック
+        index   : block の phi 命令以外の命令のうち実行済みのものの数
+        memory  : 大域変数の値
+        nout    : それまでの出力の数
+        regs, locals : main のレジスタと局所変数の値
+    '''
+
+    def __init__(self, block:BasicBlock, index:int, machine, frame:Frame):
+        self.block = block
+        self.index = index
+        self.memory = dict(machine.memory)
+        self.nout = len(machine.outputs)
+        self.regs = dict(frame.regs)
+        self.locals = dict(frame.locals)
+
+
+class Machine(object):
+    '''
+    関数定義の命令列を直接実行する抽象機械
+        値は i32 の整数，ポインタは ('global', 名前, 添字) か ('local', Frame, 名前) で表す
+        memory  : (大域変数名, 添字) → 値（書き込まれていなければ 0）
+        sizes   : 大域配列名 → 要素数
+        outputs : write で出力した値のリスト
+        steps   : 残りの実行命令数
+    '''
+
+    def __init__(self, fundefs, budget:int):
+        self.table = {f.name: f for f in fundefs}
+        self.cfgs = {}
+        self.memory = {}
+        self.sizes = {}
+        self.outputs = []
+        self.steps = budget
+        self.depth = 0
+        for f in fundefs:
+            for l in f.codes:
+                if isinstance(l, LLVMCodeGetelementptr):
+                    self.sizes[l.name] = int(l.size)
+
+    def cfgOf(self, fundef) -> CFG:
+        if fundef.name not in self.cfgs:
+            self.cfgs[fundef.name] = CFG(fundef)
+        return self.cfgs[fundef.name]
+
+    def value(self, frame:Frame, x:Operand):
+        t = x.type
+        if t is OType.CONSTANT:
+            return x.val
+        if t is OType.NUMBERED_REG:
+            if x.val not in frame.regs:
+                raise Stop()
+            return frame.regs[x.val]
+        if t is OType.GLOBAL_VAR:
+            return ('global', x.name, 0)
+        if x.name in frame.params:
+            return frame.params[x.name]
+        return ('local', frame, x.name)
+
+    def intValue(self, frame:Frame, x:Operand) -> int:
+        v = self.value(frame, x)
+        if not isinstance(v, int):
+            raise Stop()
+        return v
+
+    def address(self, ptr):
+        ''' 大域変数のポインタ ptr が指す memory のキー（範囲外なら打ち切る） '''
+        _, name, index = ptr
+        if not 0 <= index < self.sizes.get(name, 1):
+            raise Stop()
+        return (name, index)
+
+    def load(self, ptr) -> int:
+        if not isinstance(ptr, tuple):
+            raise Stop()
+        if ptr[0] == 'local':
+            v = ptr[1].locals.get(ptr[2])
+            if v is None:
+                raise Stop()
+            return v
+        return self.memory.get(self.address(ptr), 0)
+
+    def store(self, ptr, v:int):
+        if not isinstance(ptr, tuple):
+            raise Stop()
+        if ptr[0] == 'local':
+            ptr[1].locals[ptr[2]] = v
+        else:
+            self.memory[self.address(ptr)] = v
+
+    def call(self, fundef, args:list):
+        ''' 関数 fundef を引数 args で実行し，返り値を返す '''
+        if self.depth >= MAX_DEPTH:
+            raise Stop()
+        self.depth += 1
+        try:
+            frame = Frame(fundef, args)
+            cfg = self.cfgOf(fundef)
+            b, pred = cfg.entry(), None
+            while True:
+                nxt, ret = self.execBlock(frame, b, pred)
+                if nxt is None:
+                    return ret
+                pred, b = b.label, cfg.blockOf(nxt)
+        finally:
+            self.depth -= 1
+
+    def enterBlock(self, frame:Frame, b:BasicBlock, pred:Labels) -> list:
+        '''
+        先行ブロック pred からブロック b に入る（phi 命令の入力をまとめて選ぶ）
+        b の phi 命令以外の命令のリストを返す
+        '''
+        phis = b.phis()
+        values = []
+        for l in phis:
+            v = [v for v, lab in l.incoming if lab == pred]
+            if not v:
+                raise Stop()
+            values.append(self.value(frame, v[0]))
+        for l, v in zip(phis, values):
+            frame.regs[l.retval.val] = v
+        return b.codes[len(phis):]
+
+    def step(self, frame:Frame, l):
+        ''' 命令 l を実行し，終端命令なら (次のブロックのラベル, None) か (None, 返り値) を返す '''
+        self.steps -= 1
+        if self.steps < 0:
+            raise Stop()
+        t = type(l)
+        if t is LLVMCodeJ:
+            return l.arg1, None
+        if t is LLVMCodeBr:
+            return (l.arg1 if self.intValue(frame, l.cond) else l.arg2), None
+        if t is LLVMCodeRet:
+            return None, (None if l.val is None else self.intValue(frame, l.val))
+        handler = self.handlers.get(t)
+        if handler is None:
+            # 表にない命令は，結果が引数だけで決まるものだけ計算する
+            handler = Machine.execPure if l.isPure() and l.getDef() is not None else Machine.execOther
+            self.handlers[t] = handler
+        handler(self, frame, l)
+        return None
+
+    def execBlock(self, frame:Frame, b:BasicBlock, pred:Labels):
+        ''' ブロック b を実行し，(次のブロックのラベル, None) か (None, 返り値) を返す '''
+        for l in self.enterBlock(frame, b, pred):
+            r = self.step(frame, l)
+            if r is not None:
+                return r
+        raise Stop()
+
+    def execAlloca(self, frame:Frame, l):
+        frame.locals[l.name] = None
+
+    def execStore(self, frame:Frame, l):
+        self.store(self.value(frame, l.ptr), self.intValue(frame, l.argval))
+
+    def execLoad(self, frame:Frame, l):
+        frame.regs[l.retval.val] = self.load(self.value(frame, l.ptr))
+
+    def execGetelementptr(self, frame:Frame, l):
+        frame.regs[l.retval.val] = ('global', l.name, l.offset + self.intValue(frame, l.ptr))
+
+    def execPtrAdd(self, frame:Frame, l):
+        base = self.value(frame, l.base)
+        if not isinstance(base, tuple) or base[0] != 'global':
+            raise Stop()
+        frame.regs[l.retval.val] = ('global', base[1], base[2] + self.intValue(frame, l.offset))
+
+    def execCall(self, frame:Frame, l):
+        callee = self.table.get(l.name)
+        if callee is None:
+            raise Stop()
+        r = self.call(callee, [self.intValue(frame, x) for x in l.arg])
+        if isinstance(l, LLVMCodeCall):
+            frame.regs[l.retval.val] = r
+
+    def execPrintf(self, frame:Frame, l):
+        if len(self.outputs) >= MAX_OUTPUTS:
+            raise Stop()
+        v = self.intValue(frame, l.arg)
+        self.outputs.append(v)
+        frame.regs[l.res.val] = len(str(v)) + 1
+
+    def execPure(self, frame:Frame, l):
+        args = [self.intValue(frame, x) for x in l.getUses()]
+        v = l.evaluate(args)
+        if v is None or overflows(l, args):
+            raise Stop()
+        frame.regs[l.getDef().val] = v
+
+    def execOther(self, frame:Frame, l):
+        # 入力（scanf）やベクトル命令などは実行しない
+        raise Stop()
+
+    handlers = {
+        LLVMCodeAlloca: execAlloca,
+        LLVMCodeStore: execStore,
+        LLVMCodeLoad: execLoad,
+        LLVMCodeGetelementptr: execGetelementptr,
+        LLVMCodePtrAdd: execPtrAdd,
+        LLVMCodeCall: execCall,
+        LLVMCodeCallVoid: execCall,
+        LLVMCodeCallPrintf: execPrintf,
+    }
+
+
+def overflows(l, args:list) -> bool:
+    ''' nsw 付きの演算 l が引数 args で符号付きオーバーフローするか '''
+    if not getattr(l, 'nsw', False):
+        return False
+    a, b = args
+    if isinstance(l, LLVMCodeAdd):
+        r = a + b
+    elif isinstance(l, LLVMCodeSub):
+        r = a - b
+    elif isinstance(l, LLVMCodeMul):
+        r = a * b
+    else:
+        return False
+    return r != wrap32(r)
+
+
+def runMain(machine:Machine, main):
+    '''
+    main を実行し，(最後まで実行できたか, 返り値, 打ち切った時点のスナップショット) を返す
+    スナップショットはループに含まれないブロックの命令の直前の状態で，
+    途中で打ち切られうる呼び出しの前では記憶域ごと保存しておく
+    '''
+    cfg = machine.cfgOf(main)
+    inloop = set()
+    for loop in cfg.findLoops():
+        inloop |= loop.blocks
+    frame = Frame(main, [])
+    b, pred = cfg.entry(), None
+    snap = None
+    try:
+        while True:
+            if b in inloop and isinstance(snap, tuple):
+                # ループに入る前の状態を残しておく（直前の分岐命令は状態を変えない）
+                snap = Snapshot(snap[0], snap[1], machine, frame)
+            body = machine.enterBlock(frame, b, pred)
+            r = None
+            for k, l in enumerate(body):
+                if b not in inloop:
+                    snap = (b, k)
+                    if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                        snap = Snapshot(b, k, machine, frame)
+                r = machine.step(frame, l)
+                if r is not None:
+                    break
+            if r is None:
+                raise Stop()
+            nxt, ret = r
+            if nxt is None:
+                return True, ret, None
+            pred, b = b.label, cfg.blockOf(nxt)
+    except Stop:
+        if isinstance(snap, tuple):
+            # 呼び出し以外の命令は状態を変えずに打ち切られる
+            snap = Snapshot(snap[0], snap[1], machine, frame)
+        return False, None, snap
+
+
+def printCalls(main, outputs:list) -> list:
+    ''' 値 outputs を順に出力する printf 命令のリスト '''
+    return [LLVMCodeCallPrintf(Operand(OType.NUMBERED_REG, val=main.getNewRegNo()),
+                               Operand(OType.CONSTANT, val=v))
+            for v in outputs]
+
+
+def specializePrefix(machine:Machine, main, snap:Snapshot) -> bool:
+    '''
+    main の入口からスナップショットの命令の直前までを，実行結果（出力と記憶域への
+    ストア）に置き換える．置き換えたかどうかを返す
+    '''
+    cfg = machine.cfgOf(main)
+    b = snap.block
+    if b is cfg.entry() and snap.index == 0:
+        return False
+
+    # スナップショットのブロックから到達できるブロックだけが残る
+    # （ループに含まれないので，実行済みのブロックには戻らない）
+    rest = []
+    work = [b]
+    while work:
+        x = work.pop()
+        if x not in rest:
+            rest.append(x)
+            work.extend(x.succs)
+    body = b.codes[len(b.phis()):][snap.index:]
+    env = snap.regs
+
+    def known(u:Operand) -> bool:
+        return u.type == OType.NUMBERED_REG and u.val in env
+
+    for x in rest:
+        for l in (body if x is b else x.codes):
+            for u in l.getUses():
+                if known(u) and not isinstance(env[u.val], int):
+                    return False
+
+    stores = []
+    for (name, index), v in sorted(snap.memory.items()):
+        if v == 0:
+            continue
+        if name in machine.sizes:
+            p = Operand(OType.NUMBERED_REG, val=main.getNewRegNo())
+            stores.append(LLVMCodeGetelementptr(p, machine.sizes[name], name,
+                                                Operand(OType.CONSTANT, val=index)))
+        else:
+            p = Operand(OType.GLOBAL_VAR, name=name)
+        stores.append(LLVMCodeStore(Operand(OType.CONSTANT, val=v), p))
+    for name, v in snap.locals.items():
+        if v is not None:
+            stores.append(LLVMCodeStore(Operand(OType.CONSTANT, val=v), Operand(OType.NAMED_REG, name=name)))
+    if len(stores) > MAX_STORES or (b is cfg.entry() and not stores and not snap.nout):
+        return False
+
+    allocas = [l for l in main.codes if isinstance(l, LLVMCodeAlloca)]
+    if b.label is None:
+        b.label = Labels(main.getNewLab())
+    b.codes = [l for l in body if not isinstance(l, LLVMCodeAlloca)]
+    entry = BasicBlock(None)
+    entry.codes = allocas + printCalls(main, machine.outputs[:snap.nout]) + stores
+    entry.codes.append(LLVMCodeJ(b.label))
+
+    # 実行済みのレジスタを定数にし，消えた先行ブロックからの phi の入力を除く
+    labels = {x.label for x in rest}
+    for x in rest:
+        for l in x.codes:
+            l.mapUses(lambda u: Operand(OType.CONSTANT, val=env[u.val]) if known(u) else u)
+            if isinstance(l, LLVMCodePhi):
+                l.incoming = [(v, lab) for v, lab in l.incoming if lab in labels]
+    cfg.blocks = [entry] + [x for x in cfg.blocks if x in rest]
+    cfg.link()
+    cfg.flatten()
+    stats.count('partialeval', 'constant outputs', snap.nout)
+    stats.count('partialeval', 'state stores', len(stores))
+    return True
+
+
+def evaluateMain(machine:Machine) -> bool:
+    ''' main を部分評価し，main を書き換えたかどうかを返す '''
+    main = machine.table['main']
+    done, ret, snap = runMain(machine, main)
+    if done:
+        main.codes = [l for l in main.codes if isinstance(l, LLVMCodeAlloca)]
+        main.codes += printCalls(main, machine.outputs)
+        main.codes.append(LLVMCodeRet('i32', Operand(OType.CONSTANT, val=ret)))
+        stats.count('partialeval', 'input-free programs')
+        stats.count('partialeval', 'constant outputs', len(machine.outputs))
+        return True
+    if snap is not None and specializePrefix(machine, main, snap):
+        stats.count('partialeval', 'specialized prefixes')
+        return True
+    return False
+
+
+def foldCalls(fundefs, machine:Machine) -> int:
+    '''
+    副作用のない関数の定数引数での呼び出しを返り値で置き換え，置き換えた数を返す
+    （大域変数に触れない関数だけを実行するので，machine の記憶域の状態によらない）
+    '''
+    modref = analyzeModRef(fundefs)
+    results = {}    # (関数名, 引数の値) → 返り値（求まらなければ None）
+    n = 0
+    for f in fundefs:
+        consts = {}
+        keep = []
+        for l in f.codes:
+            if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                l.mapUses(lambda u: consts.get(u, u))
+            m = modref.get(l.name) if isinstance(l, LLVMCodeCall) else None
+            if (m is not None and not (m.reads or m.writes or m.io)
+                    and all(x.isConst() for x in l.arg) and machine.steps > 0):
+                key = (l.name, tuple(x.val for x in l.arg))
+                if key not in results:
+                    try:
+                        results[key] = machine.call(machine.table[l.name], list(key[1]))
+                    except Stop:
+                        results[key] = None
+                r = results[key]
+                if r is None:
+                    keep.append(l)
+                    continue
+                consts[l.retval] = Operand(OType.CONSTANT, val=r)
+                n += 1
+                continue
+            keep.append(l)
+        for l in keep:
+            l.mapUses(lambda u: consts.get(u, u))
+        f.codes = keep
+    stats.count('partialeval', 'folded calls', n)
+    return n
+
+
+def run(fundefs, budget:int) -> bool:
+    ''' プログラム fundefs を命令数 budget の範囲で部分評価する '''
+    if budget <= 0 or not any(f.name == 'main' for f in fundefs):
+        return False
+    machine = Machine(fundefs, budget)
+    changed = evaluateMain(machine)
+    changed = foldCalls(fundefs, machine) > 0 or changed
+    stats.count('partialeval', 'evaluated instructions', budget - max(machine.steps, 0))
+    return changed
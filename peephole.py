@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+from llvmcode import *
+from operand import OType, Operand
+import dce
+import stats
+
+##
+## 表駆動ののぞき穴最適化
+##   規則は「名前・パターン・条件・書き換え」からなり，@rule で RULES に登録する．
+##   パターンは根の命令を表すタプル (命令クラス, p1, p2, ...) で，pi は使用オペランドの i 番目に対応し
+##       'x'    : 任意のオペランド（同じ名前は同じオペランド）
+##       '#c'   : 定数（値を c に束縛）
+##       整数 n : 値 n の定数
+##       タプル : そのパターンに一致する命令が定義するレジスタ
+##   である．書き換え関数は束縛 m と Rewriter r を受け取り，
+##       Operand : 根の結果をこのオペランドに置き換える
+##       list    : 根の命令をこの命令列に置き換える（最後の命令が根の結果を定義する）
+##       True    : 根の命令をその場で書き換えた
+##       None    : 書き換えない
+##   のいずれかを返す．規則ごとの適用回数は統計情報（peephole）に出る．
+##   ループ認識などが使う形を崩さないよう，最適化パスの最後に1度だけ実行する．
+##   -O0 でも 2 のべきの乗除算のシフトへの置き換え（STRENGTH_RULES）だけは関数ごとに1度行う．
+##
+
+MAX_ROUNDS = 8      # 書き換えが止まるまで繰り返す回数の上限
+
+
+class Rule(object):
+    '''
+    のぞき穴最適化の規則
+        name    : 規則名（統計情報に使う）
+        pattern : 根の命令のパターン
+        where   : 束縛 m と Rewriter を受け取って適用するかを返す関数（None なら常に適用）
+        rewrite : 書き換え関数
+    '''
+
+    def __init__(self, name:str, pattern:tuple, where, rewrite):
+        self.name = name
+        self.pattern = pattern
+        self.where = where
+        self.rewrite = rewrite
+
+
+RULES = []
+
+
+def rule(name:str, pattern:tuple, where=None):
+    ''' 書き換え関数を規則として RULES に登録するデコレータ '''
+    def register(rewrite):
+        RULES.append(Rule(name, pattern, where, rewrite))
+        return rewrite
+    return register
+
+
+class Rewriter(object):
+    '''
+    規則を適用する文脈
+        fundef : 関数定義
+        defs   : レジスタ → それを定義する命令
+        uses   : レジスタ → 使用回数
+        root   : パターンの根の命令
+        next   : 根の次のラベル（なければ None）
+    '''
+
+    def __init__(self, fundef, defs:dict, uses:dict):
+        self.fundef = fundef
+        self.defs = defs
+        self.uses = uses
+        self.subst = {}
+        self.root = None
+        self.next = None
+
+    def resolve(self, x):
+        ''' 置き換え済みのオペランドをたどった先 '''
+        while isinstance(x, Operand) and x in self.subst:
+            x = self.subst[x]
+        return x
+
+    def reg(self) -> Operand:
+        return Operand(OType.NUMBERED_REG, val=self.fundef.getNewRegNo())
+
+    def match(self, pat, x, m:dict) -> bool:
+        ''' オペランド x がパターン pat に一致するか（束縛を m に加える） '''
+        x = self.resolve(x)
+        if isinstance(pat, int):
+            return x.isConst(pat)
+        if isinstance(pat, str):
+            if pat.startswith('#'):
+                if not x.isConst():
+                    return False
+                pat, x = pat[1:], x.val
+            if pat in m:
+                return m[pat] == x
+            m[pat] = x
+            return True
+        l = self.defs.get(x)
+        return l is not None and self.matchCode(pat, l, m)
+
+    def matchCode(self, pat:tuple, l:LLVMCode, m:dict) -> bool:
+        ''' 命令 l がパターン pat に一致するか '''
+        if type(l) is not pat[0]:
+            return False
+        uses = l.getUses()
+        return len(uses) == len(pat) - 1 and all(self.match(p, x, m) for p, x in zip(pat[1:], uses))
+
+
+def isPowerOf2(c:int) -> bool:
+    return c > 0 and c & (c - 1) == 0
+
+
+def log2(c:int) -> Operand:
+    return Operand(OType.CONSTANT, val=c.bit_length() - 1)
+
+
+def const(v:int) -> Operand:
+    return Operand(OType.CONSTANT, val=v)
+
+
+##
+## 規則
+##
+
+@rule('neg-neg', (LLVMCodeSub, 0, (LLVMCodeSub, 0, 'x')))
+def negNeg(m, r):
+    return m['x']
+
+@rule('add-zero', (LLVMCodeAdd, 'x', 0))
+@rule('add-zero', (LLVMCodeAdd, 0, 'x'))
+@rule('sub-zero', (LLVMCodeSub, 'x', 0))
+@rule('mul-one', (LLVMCodeMul, 'x', 1))
+@rule('mul-one', (LLVMCodeMul, 1, 'x'))
+@rule('div-one', (LLVMCodeDiv, 'x', 1))
+@rule('shift-zero', (LLVMCodeShl, 'x', 0))
+@rule('shift-zero', (LLVMCodeAshr, 'x', 0))
+def identity(m, r):
+    return m['x']
+
+@rule('sub-self', (LLVMCodeSub, 'x', 'x'))
+@rule('mul-zero', (LLVMCodeMul, 'x', 0))
+@rule('mul-zero', (LLVMCodeMul, 0, 'x'))
+@rule('and-zero', (LLVMCodeAnd, 'x', 0))
+def zero(m, r):
+    return const(0)
+
+@rule('add-neg', (LLVMCodeAdd, 'x', (LLVMCodeSub, 0, 'y')))
+def addNeg(m, r):
+    return [LLVMCodeSub(r.root.retval, m['x'], m['y'], nsw=False)]
+
+@rule('add-neg', (LLVMCodeAdd, (LLVMCodeSub, 0, 'y'), 'x'))
+def addNegSwapped(m, r):
+    return [LLVMCodeSub(r.root.retval, m['x'], m['y'], nsw=False)]
+
+@rule('sub-neg', (LLVMCodeSub, 'x', (LLVMCodeSub, 0, 'y')))
+def subNeg(m, r):
+    return [LLVMCodeAdd(r.root.retval, m['x'], m['y'], nsw=False)]
+
+@rule('mul-pow2', (LLVMCodeMul, 'x', '#c'), lambda m, r: isPowerOf2(m['c']))
+@rule('mul-pow2', (LLVMCodeMul, '#c', 'x'), lambda m, r: isPowerOf2(m['c']))
+def mulPow2(m, r):
+    return [LLVMCodeShl(r.root.retval, m['x'], log2(m['c']))]
+
+@rule('div-pow2', (LLVMCodeDiv, 'x', '#c'), lambda m, r: isPowerOf2(m['c']) and m['c'] > 1)
+def divPow2(m, r):
+    # sdiv は0方向へ切り捨てるので，負の数には 2^k-1 を足してから右シフトする
+    x, c = m['x'], m['c']
+    sign = r.reg()
+    bias = r.reg()
+    biased = r.reg()
+    return [LLVMCodeAshr(sign, x, const(31)),
+            LLVMCodeAnd(bias, sign, const(c - 1)),
+            LLVMCodeAdd(biased, x, bias, nsw=False),
+            LLVMCodeAshr(r.root.retval, biased, log2(c))]
+
+@rule('sext-const', (LLVMCodeSext, '#c'))
+def sextConst(m, r):
+    return const(m['c'])
+
+@rule('fold-const', (LLVMCodeAdd, '#a', '#b'))
+@rule('fold-const', (LLVMCodeSub, '#a', '#b'))
+@rule('fold-const', (LLVMCodeMul, '#a', '#b'))
+@rule('fold-const', (LLVMCodeDiv, '#a', '#b'))
+@rule('fold-const', (LLVMCodeShl, '#a', '#b'))
+@rule('fold-const', (LLVMCodeAshr, '#a', '#b'))
+@rule('fold-const', (LLVMCodeAnd, '#a', '#b'))
+def foldConst(m, r):
+    v = r.root.evaluate([m['a'], m['b']])
+    return None if v is None else const(v)
+
+@rule('invert-br', (LLVMCodeBr, (LLVMCodeIcmp, 'a', 'b')),
+      lambda m, r: r.root.arg1 == r.next != r.root.arg2 and r.uses.get(r.root.cond) == 1)
+def invertBr(m, r):
+    # 真の分岐先が直後のブロックなら，比較を反転して偽の分岐先を直後にする
+    br = r.root
+    icmp = r.defs[r.resolve(br.cond)]
+    icmp.cond = icmp.cond.inverse()
+    br.arg1, br.arg2 = br.arg2, br.arg1
+    if br.weights is not None:
+        br.weights = (br.weights[1], br.weights[0])
+    return True
+
+
+# -O0 でも行う規則（構文解析時に行っていた 2 のべきの乗除算のシフトへの置き換え）
+STRENGTH_RULES = [rl for rl in RULES if rl.name in ('mul-pow2', 'div-pow2')]
+
+
+##
+## 規則の適用
+##
+
+def apply(r:Rewriter, l:LLVMCode, rules:list):
+    ''' 命令 l に最初に一致した rules の規則を適用し，書き換えた結果を返す（適用しなければ None） '''
+    for rl in rules:
+        if type(l) is not rl.pattern[0]:
+            continue
+        m = {}
+        r.root = l
+        if not r.matchCode(rl.pattern, l, m):
+            continue
+        if rl.where is not None and not rl.where(m, r):
+            continue
+        result = rl.rewrite(m, r)
+        if result is None:
+            continue
+        stats.count('peephole', rl.name)
+        return result
+    return None
+
+
+def sweep(fundef, rules:list=RULES) -> int:
+    ''' 命令列を1度走査して規則 rules を適用し，適用した回数を返す '''
+    defs = {}
+    uses = {}
+    for l in fundef.codes:
+        if l.getDef() is not None:
+            defs[l.getDef()] = l
+        for x in l.getUses():
+            uses[x] = uses.get(x, 0) + 1
+    r = Rewriter(fundef, defs, uses)
+    codes = []
+    n = 0
+    for i, l in enumerate(fundef.codes):
+        r.next = None
+        if i + 1 < len(fundef.codes) and isinstance(fundef.codes[i + 1], LLVMCodeLabel):
+            r.next = fundef.codes[i + 1].arg1
+        result = apply(r, l, rules)
+        if result is None:
+            codes.append(l)
+            continue
+        n += 1
+        if isinstance(result, Operand):
+            r.subst[l.getDef()] = result
+            codes.append(l)
+        elif isinstance(result, list):
+            codes.extend(result)
+            for c in result:
+                if c.getDef() is not None:
+                    defs[c.getDef()] = c
+        else:
+            codes.append(l)
+    fundef.codes = codes
+    if r.subst:
+        for l in codes:
+            l.mapUses(r.resolve)
+    return n
+
+
+def run(fundef) -> int:
+    ''' 関数定義 fundef に規則を書き換えが止まるまで適用し，適用した回数を返す '''
+    total = 0
+    for _ in range(MAX_ROUNDS):
+        n = sweep(fundef)
+        if n == 0:
+            break
+        total += n
+        dce.run(fundef)
+    return total
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import zlib
+from cfg import CFG
+from llvmcode import *
+from operand import OType, Operand
+import stats
+
+##
+## プロファイルに基づく最適化（PGO）
+##   --instrument[=FILE] : 最適化前の命令列の各基本ブロックの先頭，各呼び出しの直前，
+##                         条件分岐の真の辺に実行回数カウンタを入れ，main が終わるときに
+##                         カウンタの値を FILE（省略時は pl.profdata）に書き出す
+##   --profile-use=FILE  : 同じソースの最適化前の命令列にカウンタの値を対応させ，
+##     - 条件分岐に分岐回数（LLVMCodeBr.weights）を付け，!prof メタデータとして出力する
+##     - 呼び出し回数（LLVMCodeCall.count）でインライン展開を，ラッチの分岐回数でループ展開を判断する
+##     - よく通る後続ブロックを続けて並べ，一度も実行されなかったブロックを後ろに回す
+##   プロファイルの先頭行にはカウンタの並びから求めた検査値を書き，一致しなければ使わない
+##
+
+DEFAULT_FILE = 'pl.profdata'
+HOT_COUNT = 1000            # これ以上実行された呼び出し・ループを「よく実行される」とみなす
+MAX_WEIGHT = 0x7fffffff     # 分岐の重み（i32）の上限
+
+
+def sites(cfg) -> list:
+    '''
+    関数 cfg.fundef のカウンタの並び
+        ('block', ブロック, ブロック)
+        ('call', 呼び出し命令, ブロック)
+        ('branch', 条件分岐命令, ブロック)（分岐先が異なるものだけ）
+    のリスト
+    '''
+    result = []
+    for b in cfg.blocks:
+        result.append(('block', b, b))
+        for l in b.codes:
+            if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+                result.append(('call', l, b))
+        t = b.terminator()
+        if isinstance(t, LLVMCodeBr) and t.arg1 != t.arg2:
+            result.append(('branch', t, b))
+    return result
+
+
+def checksum(fundefs) -> int:
+    ''' カウンタの並びの検査値 '''
+    desc = []
+    for f in fundefs:
+        for kind, _, b in sites(CFG(f)):
+            desc.append(f"{f.name}:{b.label}:{kind}")
+    return zlib.crc32("\n".join(desc).encode())
+
+
+def cstring(s:str) -> str:
+    ''' LLVM の文字列定数 c"..." の中身の表記（終端の \\00 は含めない） '''
+    r = ""
+    for c in s.encode():
+        r += chr(c) if 32 <= c < 127 and c not in (ord('"'), ord('\\')) else f"\\{c:02X}"
+    return r
+
+
+class Instrumentation(object):
+    '''
+    カウンタを入れたプログラムの実行時ライブラリ
+        size     : カウンタの数
+        checksum : カウンタの並びの検査値
+        path     : プロファイルを書き出すファイル名
+    '''
+
+    def __init__(self, size:int, checksum:int, path:str):
+        self.size = size
+        self.checksum = checksum
+        self.path = path
+
+    def printRuntime(self, fp):
+        path = cstring(self.path)
+        plen = len(self.path.encode()) + 1
+        head = f"# pl profile {self.checksum} {self.size}"
+        hlen = len(head) + 2
+        print(RUNTIME.replace('{N}', str(self.size))
+              .replace('{PATH}', path).replace('{PLEN}', str(plen))
+              .replace('{HEAD}', head).replace('{HLEN}', str(hlen)), end='', file=fp)
+
+
+RUNTIME = r'''
+@pl.prof.counts = internal global [{N} x i64] zeroinitializer, align 16
+@pl.prof.path = private unnamed_addr constant [{PLEN} x i8] c"{PATH}\00", align 1
+@pl.prof.mode = private unnamed_addr constant [2 x i8] c"w\00", align 1
+@pl.prof.head = private unnamed_addr constant [{HLEN} x i8] c"{HEAD}\0A\00", align 1
+@pl.prof.fmt = private unnamed_addr constant [6 x i8] c"%lld\0A\00", align 1
+
+declare i8* @fopen(i8*, i8*)
+declare i32 @fputs(i8*, i8*)
+declare i32 @fprintf(i8*, i8*, ...)
+declare i32 @fclose(i8*)
+
+define internal void @pl.prof.dump() nounwind {
+entry:
+    %fp = call i8* @fopen(i8* getelementptr inbounds ([{PLEN} x i8], [{PLEN} x i8]* @pl.prof.path, i64 0, i64 0), i8* getelementptr inbounds ([2 x i8], [2 x i8]* @pl.prof.mode, i64 0, i64 0))
+    %failed = icmp eq i8* %fp, null
+    br i1 %failed, label %exit, label %head
+head:
+    %h = call i32 @fputs(i8* getelementptr inbounds ([{HLEN} x i8], [{HLEN} x i8]* @pl.prof.head, i64 0, i64 0), i8* %fp)
+    br label %loop
+loop:
+    %k = phi i64 [ 0, %head ], [ %k1, %loop ]
+    %p = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.prof.counts, i64 0, i64 %k
+    %c = load i64, i64* %p, align 8
+    %r = call i32 (i8*, i8*, ...) @fprintf(i8* %fp, i8* getelementptr inbounds ([6 x i8], [6 x i8]* @pl.prof.fmt, i64 0, i64 0), i64 %c)
+    %k1 = add i64 %k, 1
+    %more = icmp slt i64 %k1, {N}
+    br i1 %more, label %loop, label %close
+close:
+    %e = call i32 @fclose(i8* %fp)
+    br label %exit
+exit:
+    ret void
+}
+'''
+
+
+def instrument(fundefs, path:str) -> Instrumentation:
+    ''' 最適化前の fundefs にカウンタを入れる '''
+    check = checksum(fundefs)
+    counters = []
+
+    def counter(f) -> LLVMCodeProfCount:
+        c = LLVMCodeProfCount(Operand(OType.NUMBERED_REG, val=f.getNewRegNo()), len(counters), 0)
+        counters.append(c)
+        return c
+
+    for f in fundefs:
+        cfg = CFG(f)
+        for kind, l, b in sites(cfg):
+            if kind == 'block':
+                b.codes.insert(len(b.phis()), counter(f))
+            elif kind == 'call':
+                b.codes.insert(b.codes.index(l), counter(f))
+            else:
+                # 真の辺にカウンタだけのブロックをはさむ
+                e = cfg.newBlock()
+                e.codes = [counter(f), LLVMCodeJ(l.arg1)]
+                for phi in cfg.blockOf(l.arg1).phis():
+                    phi.retargetIncoming(b.label, e.label)
+                l.arg1 = e.label
+        if f.name == 'main':
+            for b in cfg.blocks:
+                if isinstance(b.terminator(), LLVMCodeRet):
+                    b.insertBeforeTerminator(LLVMCodeCallVoid('pl.prof.dump'))
+        cfg.link()
+        cfg.flatten()
+    for c in counters:
+        c.size = len(counters)
+    stats.count('pgo', 'counters', len(counters))
+    return Instrumentation(len(counters), check, path)
+
+
+def apply(fundefs, path:str) -> bool:
+    ''' プロファイル path の値を最適化前の fundefs の分岐・呼び出しに付ける．付けたかどうかを返す '''
+    try:
+        tokens = open(path).read().split()
+    except OSError as e:
+        print(f"profile: cannot read {path}: {e.strerror}", file=sys.stderr)
+        return False
+    check = checksum(fundefs)
+    table = [(kind, l, b) for f in fundefs for kind, l, b in sites(CFG(f))]
+    if (tokens[:3] != ['#', 'pl', 'profile'] or tokens[3:5] != [str(check), str(len(table))]
+            or len(tokens) != 5 + len(table)):
+        print(f"profile: {path} does not match this program; ignored", file=sys.stderr)
+        return False
+    counts = [int(x) for x in tokens[5:]]
+    entered = 0
+    for (kind, l, b), n in zip(table, counts):
+        if kind == 'block':
+            entered = n
+        elif kind == 'call':
+            l.count = n
+            stats.count('pgo', 'counted call sites')
+        else:
+            l.weights = (n, max(entered - n, 0))
+            stats.count('pgo', 'weighted branches')
+    return True
+
+
+def likelySucc(cfg, b, placed:set):
+    ''' ブロック b の次に並べる後続ブロック（なければ None） '''
+    t = b.terminator()
+    succ = None
+    if isinstance(t, LLVMCodeJ):
+        succ = cfg.blockOf(t.arg1)
+    elif isinstance(t, LLVMCodeBr) and t.weights is not None:
+        if t.weights[0] + t.weights[1] > 0:
+            succ = cfg.blockOf(t.arg1 if t.weights[0] >= t.weights[1] else t.arg2)
+    elif isinstance(t, LLVMCodeBr):
+        # 重みがなければ元の並びで次のブロックに続ける
+        i = cfg.blocks.index(b)
+        if i + 1 < len(cfg.blocks) and cfg.blocks[i + 1] in b.succs:
+            succ = cfg.blocks[i + 1]
+    return succ if succ not in placed else None
+
+
+def coldBlocks(cfg) -> set:
+    ''' プロファイルで一度も実行されなかったブロックの集合 '''
+    cold = set()
+    changed = True
+    while changed:
+        changed = False
+        for b in cfg.blocks[1:]:
+            if b in cold or not b.preds:
+                continue
+            if all(p in cold or edgeWeight(p, b) == 0 for p in b.preds):
+                cold.add(b)
+                changed = True
+    return cold
+
+
+def edgeWeight(p, b):
+    ''' 辺 p → b の実行回数（分からなければ None） '''
+    t = p.terminator()
+    if not isinstance(t, LLVMCodeBr) or t.weights is None or t.arg1 == t.arg2:
+        return None
+    return t.weights[0] if t.arg1 == b.label else t.weights[1]
+
+
+def layout(fundef) -> bool:
+    ''' 分岐の重みに従って fundef のブロックを並べ替え，並べ替えたかどうかを返す '''
+    if not any(isinstance(l, LLVMCodeBr) and l.weights is not None for l in fundef.codes):
+        return False
+    cfg = CFG(fundef)
+    cold = coldBlocks(cfg)
+    placed = set()
+    order = []
+    for group in ([b for b in cfg.blocks if b not in cold], [b for b in cfg.blocks if b in cold]):
+        for b in group:
+            x = b
+            while x is not None and x not in placed and (x in cold) == (b in cold):
+                placed.add(x)
+                order.append(x)
+                x = likelySucc(cfg, x, placed)
+    stats.count('pgo', 'cold blocks moved', len(cold))
+    cfg.blocks = order
+    cfg.flatten()
+    return True
+
+
+class BranchWeights(object):
+    '''
+    分岐の重みのメタデータ
+        first : 最初のメタデータ番号（別名解析のメタデータの後に続ける）
+        lines : 出力するメタデータ定義の行
+    '''
+
+    def __init__(self, fundefs, first:int):
+        self.first = first
+        self.lines = []
+        nodes = {}
+        for f in fundefs:
+            for l in f.codes:
+                if not isinstance(l, LLVMCodeBr) or l.weights is None:
+                    continue
+                t, e = l.weights
+                if max(t, e) > MAX_WEIGHT:
+                    scale = max(t, e) / MAX_WEIGHT
+                    t, e = int(t / scale), int(e / scale)
+                if (t, e) not in nodes:
+                    nodes[(t, e)] = first + len(self.lines)
+                    self.lines.append(f'!{nodes[(t, e)]} = !{{!"branch_weights", i32 {t}, i32 {e}}}')
+                l.prof = nodes[(t, e)]
+
+    def print(self, fp):
+        if not self.lines:
+            return
+        print('', file=fp)
+        for line in self.lines:
+            print(line, file=fp)
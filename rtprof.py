@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from llvmcode import *
+from pgo import cstring
+import stats
+
+##
+## 実行時プロファイラ（--profile-runtime）
+##   最適化後のすべての関数定義の入口で @pl.rt.enter，各 ret の直前で @pl.rt.exit を呼び，
+##   llvm.readcyclecounter で測ったサイクル数を関数ごとに
+##       @pl.rt.calls : 呼び出し回数
+##       @pl.rt.incl  : 呼び出し先を含むサイクル数（再帰呼び出しは一番外側の呼び出しだけ数える）
+##       @pl.rt.excl  : 呼び出し先を除くサイクル数
+##   に足し込む．入口での時刻と呼び出し元の「呼び出し先で使ったサイクル数」は
+##   関数ごとの %pl.rt.frame（alloca [2 x i64]）に退避する．
+##   main の ret の直前（main の計測を終えた後）に呼ぶ @pl.rt.report が，呼び出し先を除く
+##   サイクル数の多い順に表を標準エラー出力に書く．
+##   並列化したループの本体は別スレッドで動くので，入れ子の状態はスレッドごとに持ち，
+##   カウンタは atomicrmw で足す．
+##
+
+RUNTIME = r'''
+@pl.rt.calls = internal global [{N} x i64] zeroinitializer, align 16
+@pl.rt.incl = internal global [{N} x i64] zeroinitializer, align 16
+@pl.rt.excl = internal global [{N} x i64] zeroinitializer, align 16
+@pl.rt.child = internal thread_local global i64 0, align 8
+@pl.rt.depth = internal thread_local global [{N} x i32] zeroinitializer, align 16
+{NAMES}@pl.rt.names = private unnamed_addr constant [{N} x i8*] [{TABLE}], align 16
+@pl.rt.head = private unnamed_addr constant [{HEADLEN} x i8] c"{HEAD}\00", align 1
+@pl.rt.row = private unnamed_addr constant [34 x i8] c"%12lld %16lld %16lld %6.2f%%  %s\0A\00", align 1
+
+declare i32 @dprintf(i32, i8*, ...)
+declare i64 @llvm.readcyclecounter()
+declare void @llvm.memset.p0i8.i64(i8*, i8, i64, i1)
+
+define internal void @pl.rt.enter(i32 %k, [2 x i64]* %frame) nounwind {
+entry:
+    %savep = getelementptr inbounds [2 x i64], [2 x i64]* %frame, i64 0, i64 1
+    %child = load i64, i64* @pl.rt.child, align 8
+    store i64 %child, i64* %savep, align 8
+    store i64 0, i64* @pl.rt.child, align 8
+    %dp = getelementptr inbounds [{N} x i32], [{N} x i32]* @pl.rt.depth, i64 0, i32 %k
+    %d = load i32, i32* %dp, align 4
+    %d1 = add i32 %d, 1
+    store i32 %d1, i32* %dp, align 4
+    %cp = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.calls, i64 0, i32 %k
+    %old = atomicrmw add i64* %cp, i64 1 monotonic
+    ; 時刻は最後に読み，カウンタの更新を呼び出された関数の時間に含めない
+    %t0p = getelementptr inbounds [2 x i64], [2 x i64]* %frame, i64 0, i64 0
+    %t0 = call i64 @llvm.readcyclecounter()
+    store i64 %t0, i64* %t0p, align 8
+    ret void
+}
+
+define internal void @pl.rt.exit(i32 %k, [2 x i64]* %frame) nounwind {
+entry:
+    %t1 = call i64 @llvm.readcyclecounter()
+    %t0p = getelementptr inbounds [2 x i64], [2 x i64]* %frame, i64 0, i64 0
+    %t0 = load i64, i64* %t0p, align 8
+    %t = sub i64 %t1, %t0
+    %child = load i64, i64* @pl.rt.child, align 8
+    %self = sub i64 %t, %child
+    %ep = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.excl, i64 0, i32 %k
+    %old1 = atomicrmw add i64* %ep, i64 %self monotonic
+    %dp = getelementptr inbounds [{N} x i32], [{N} x i32]* @pl.rt.depth, i64 0, i32 %k
+    %d = load i32, i32* %dp, align 4
+    %d1 = sub i32 %d, 1
+    store i32 %d1, i32* %dp, align 4
+    %outer = icmp eq i32 %d1, 0
+    %inc = select i1 %outer, i64 %t, i64 0
+    %ip = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.incl, i64 0, i32 %k
+    %old2 = atomicrmw add i64* %ip, i64 %inc monotonic
+    ; 呼び出し元から見ると，この呼び出しの時間はすべて呼び出し先の時間
+    %savep = getelementptr inbounds [2 x i64], [2 x i64]* %frame, i64 0, i64 1
+    %saved = load i64, i64* %savep, align 8
+    %child1 = add i64 %saved, %t
+    store i64 %child1, i64* @pl.rt.child, align 8
+    ret void
+}
+
+define internal void @pl.rt.report() nounwind {
+entry:
+    %done = alloca [{N} x i8], align 1
+    %done0 = getelementptr inbounds [{N} x i8], [{N} x i8]* %done, i64 0, i64 0
+    call void @llvm.memset.p0i8.i64(i8* %done0, i8 0, i64 {N}, i1 false)
+    %h = call i32 (i32, i8*, ...) @dprintf(i32 2, i8* getelementptr inbounds ([{HEADLEN} x i8], [{HEADLEN} x i8]* @pl.rt.head, i64 0, i64 0))
+    br label %sum
+sum:
+    %i = phi i64 [ 0, %entry ], [ %i1, %sum ]
+    %total = phi i64 [ 0, %entry ], [ %total1, %sum ]
+    %ep = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.excl, i64 0, i64 %i
+    %e = load i64, i64* %ep, align 8
+    %total1 = add i64 %total, %e
+    %i1 = add i64 %i, 1
+    %summing = icmp slt i64 %i1, {N}
+    br i1 %summing, label %sum, label %summed
+summed:
+    %tf = sitofp i64 %total1 to double
+    %nonpos = fcmp ole double %tf, 0.0
+    %totalf = select i1 %nonpos, double 1.0, double %tf
+    br label %row
+row:
+    ; まだ出力していない関数のうち，呼び出し先を除くサイクル数が最大のものを選ぶ
+    %r = phi i64 [ 0, %summed ], [ %r1, %next ]
+    br label %scan
+scan:
+    %j = phi i64 [ 0, %row ], [ %j1, %scan ]
+    %best = phi i64 [ 0, %row ], [ %best1, %scan ]
+    %bestv = phi i64 [ -9223372036854775808, %row ], [ %bestv1, %scan ]
+    %dj = getelementptr inbounds [{N} x i8], [{N} x i8]* %done, i64 0, i64 %j
+    %dv = load i8, i8* %dj, align 1
+    %free = icmp eq i8 %dv, 0
+    %ej = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.excl, i64 0, i64 %j
+    %ev = load i64, i64* %ej, align 8
+    %larger = icmp sgt i64 %ev, %bestv
+    %take = and i1 %free, %larger
+    %best1 = select i1 %take, i64 %j, i64 %best
+    %bestv1 = select i1 %take, i64 %ev, i64 %bestv
+    %j1 = add i64 %j, 1
+    %scanning = icmp slt i64 %j1, {N}
+    br i1 %scanning, label %scan, label %pick
+pick:
+    %bp = getelementptr inbounds [{N} x i8], [{N} x i8]* %done, i64 0, i64 %best1
+    store i8 1, i8* %bp, align 1
+    %cp = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.calls, i64 0, i64 %best1
+    %calls = load i64, i64* %cp, align 8
+    %called = icmp ne i64 %calls, 0
+    br i1 %called, label %print, label %next
+print:
+    %ip = getelementptr inbounds [{N} x i64], [{N} x i64]* @pl.rt.incl, i64 0, i64 %best1
+    %incl = load i64, i64* %ip, align 8
+    %sf = sitofp i64 %bestv1 to double
+    %sf100 = fmul double %sf, 100.0
+    %pct = fdiv double %sf100, %totalf
+    %np = getelementptr inbounds [{N} x i8*], [{N} x i8*]* @pl.rt.names, i64 0, i64 %best1
+    %name = load i8*, i8** %np, align 8
+    %w = call i32 (i32, i8*, ...) @dprintf(i32 2, i8* getelementptr inbounds ([34 x i8], [34 x i8]* @pl.rt.row, i64 0, i64 0), i64 %calls, i64 %incl, i64 %bestv1, double %pct, i8* %name)
+    br label %next
+next:
+    %r1 = add i64 %r, 1
+    %rows = icmp slt i64 %r1, {N}
+    br i1 %rows, label %row, label %exit
+exit:
+    ret void
+}
+'''
+
+
+class Profiler(object):
+    '''
+    実行時プロファイラの実行時ライブラリ
+        names : 関数名のリスト（添字が @pl.rt.enter・@pl.rt.exit に渡す番号）
+    '''
+
+    def __init__(self, names:list):
+        self.names = names
+
+    def printRuntime(self, fp):
+        ''' 実行時ライブラリを出力する '''
+        n = len(self.names)
+        defs = ""
+        table = []
+        for i, name in enumerate(self.names):
+            size = len(name.encode()) + 1
+            defs += f'@pl.rt.name{i} = private unnamed_addr constant [{size} x i8] c"{cstring(name)}\\00", align 1\n'
+            table.append(f"i8* getelementptr inbounds ([{size} x i8], [{size} x i8]* @pl.rt.name{i}, i64 0, i64 0)")
+        head = "\nruntime profile (cycles)\n" \
+               f"{'calls':>12} {'inclusive':>16} {'exclusive':>16} {'self':>7}  name\n"
+        ir = RUNTIME.replace('{NAMES}', defs).replace('{TABLE}', ", ".join(table))
+        ir = ir.replace('{HEADLEN}', str(len(head) + 1)).replace('{HEAD}', cstring(head))
+        print(ir.replace('{N}', str(n)), end='', file=fp)
+
+
+def instrument(fundefs) -> Profiler:
+    ''' すべての関数定義の入口と ret の直前に計測の呼び出しを入れ，実行時ライブラリを返す '''
+    for k, f in enumerate(fundefs):
+        cfg = CFG(f)
+        cfg.entry().codes[0:0] = [LLVMCodeRtHook('frame'), LLVMCodeRtHook('enter', k)]
+        for b in cfg.blocks:
+            t = b.terminator()
+            if isinstance(t, LLVMCodeRet):
+                b.insertBeforeTerminator(LLVMCodeRtHook('exit', k))
+                if f.name == 'main':
+                    b.insertBeforeTerminator(LLVMCodeRtHook('report'))
+        cfg.flatten()
+        stats.count('rtprof', 'profiled functions')
+    return Profiler([f.name for f in fundefs])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from callgraph import CallGraph
+import stats
+
+##
+## 出力の複数モジュールへの分割（--split-modules N）
+##   関数定義を命令数がなるべく均等になるように N 個のモジュールに振り分ける．
+##   バックエンドはモジュールごとに並行してコード生成し，最後にリンクする．
+##   - 大域変数は最初のモジュールで定義し，他のモジュールでは external で宣言する
+##   - 他のモジュールで定義した関数を呼び出すときは declare で宣言する
+##   - printf・scanf の宣言と書式の文字列（private）はすべてのモジュールに出力する
+##   - メタデータはモジュール全体で番号を振っているので，すべてのモジュールに同じものを出力する
+##   実行時ライブラリをテキストの IR で持つ命令（並列化・計測・--fast-io）には対応しない．
+##
+
+
+def partition(fundefs, n:int) -> list:
+    '''
+    関数定義のリスト fundefs を高々 n 個のモジュールに分け，モジュールごとの関数定義のリストを返す
+        命令数の多い関数から順に，その時点で命令数の合計が最も少ないモジュールに入れる
+        モジュールの中の関数は元の順に並べ，空のモジュールは作らない
+    '''
+    if n <= 1 or len(fundefs) <= 1:
+        return [list(fundefs)]
+    n = min(n, len(fundefs))
+    sizes = [0] * n
+    owner = {}
+    for f in sorted(fundefs, key=lambda f: -len(f.codes)):
+        k = min(range(n), key=lambda k: sizes[k])
+        owner[f.name] = k
+        sizes[k] += len(f.codes)
+    parts = [[f for f in fundefs if owner[f.name] == k] for k in range(n)]
+    stats.count('split', 'modules', n)
+    stats.count('split', 'instructions in largest module', max(sizes))
+    return parts
+
+
+def printExternals(graph:CallGraph, part:list, fp):
+    ''' モジュール part から呼び出す，他のモジュールで定義した関数の宣言を出力する '''
+    defined = {f.name for f in part}
+    called = set()
+    for f in part:
+        called |= graph.callees[f.name]
+    for f in graph.fundefs:
+        if f.name in called and f.name not in defined:
+            f.printDeclare(fp)
+            stats.count('split', 'cross-module declarations')
+    print('', file=fp)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+##
+## 最適化の統計情報（--stats 指定時に標準エラー出力へ表示）
+##
+counters = {}
+
+
+def count(group:str, name:str, n:int=1):
+    ''' 統計カウンタ group.name に n を加える '''
+    if n:
+        key = (group, name)
+        counters[key] = counters.get(key, 0) + n
+
+
+def report(fp=sys.stderr):
+    ''' 統計情報の出力 '''
+    print("=== statistics ===", file=fp)
+    for (group, name), n in sorted(counters.items()):
+        print(f"{n:8d} {group:>12} - {name}", file=fp)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from llvmcode import *
+from operand import OType, Operand
+import stats
+
+##
+## 末尾再帰の除去
+##   自分自身の呼び出しの後に
+##       （関数）返り値の変数への代入 → ret まで分岐とロードしかない
+##       （手続き）ret まで分岐しかない
+##   ものをループに変える．
+##   fact := fact(n - 1) * n のように，呼び出し結果に加算・乗算をしてから代入する場合は
+##   累積値を phi で持ち回り，ret の直前で掛け合わせる．
+##
+
+IDENTITY = {LLVMCodeAdd: 0, LLVMCodeMul: 1}
+
+
+class TailCall(object):
+    '''
+    末尾呼び出し
+        block : 呼び出しのあるブロック
+        call  : 呼び出し命令
+        op    : 累積演算の命令クラス（LLVMCodeAdd / LLVMCodeMul，なければ None）
+        other : 累積演算のもう一方の値
+        loads : 呼び出しと累積演算の間にある局所変数のロード
+    '''
+
+    def __init__(self, block, call, op=None, other=None, loads=None):
+        self.block = block
+        self.call = call
+        self.op = op
+        self.other = other
+        self.loads = [] if loads is None else loads
+
+
+def matchTailCall(cfg, fundef, b:BasicBlock, k:int):
+    ''' ブロック b の k 番目の自己呼び出しが末尾呼び出しなら TailCall を返す '''
+    call = b.codes[k]
+    slot = Operand(OType.NAMED_REG, name=fundef.name)
+    isfunc = fundef.rettype == 'i32'
+    cur = call.retval if isfunc else None
+    op = other = None
+    loads = []
+    stored = False
+    loaded = None
+    block = b
+    i = k + 1
+    seen = set()
+    while True:
+        if i >= len(block.codes):
+            return None
+        l = block.codes[i]
+        i += 1
+        if isfunc and not stored and block is b and isinstance(l, LLVMCodeLoad) and l.ptr.type == OType.NAMED_REG and l.ptr != slot:
+            loads.append(l)
+        elif isfunc and not stored and op is None and block is b and type(l) in IDENTITY and cur in (l.arg1, l.arg2) and l.arg1 != l.arg2:
+            op = type(l)
+            other = l.arg2 if l.arg1 == cur else l.arg1
+            cur = l.retval
+        elif isfunc and not stored and isinstance(l, LLVMCodeStore) and l.ptr == slot and l.argval == cur:
+            stored = True
+        elif isinstance(l, LLVMCodeJ):
+            block = cfg.blockOf(l.arg1)
+            if block in seen or block.phis():
+                return None
+            seen.add(block)
+            i = 0
+        elif isfunc and stored and isinstance(l, LLVMCodeLoad) and l.ptr == slot:
+            loaded = l.retval
+        elif isinstance(l, LLVMCodeRet):
+            if isfunc and (loaded is None or l.val != loaded):
+                return None
+            break
+        else:
+            return None
+    # 呼び出しの後ろには局所変数のロードと累積演算しかないので，
+    # 累積演算の相手は呼び出しの前に求まっているか，ロードした局所変数の値である
+    return TailCall(b, call, op, other, loads)
+
+
+def run(fundef) -> int:
+    ''' 関数定義 fundef の末尾再帰をループに変え，変換した呼び出しの数を返す '''
+    cfg = CFG(fundef)
+    sites = []
+    for b in cfg.blocks:
+        if b.label is None:
+            continue
+        for k, l in enumerate(b.codes):
+            if isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)) and l.name == fundef.name \
+                    and len(l.arg) == len(fundef.params):
+                t = matchTailCall(cfg, fundef, b, k)
+                if t is not None:
+                    sites.append(t)
+    ops = {t.op for t in sites} - {None}
+    if len(ops) > 1:
+        sites = [t for t in sites if t.op is None]
+    if not sites:
+        return 0
+    op = ops.pop() if len(ops) == 1 else None
+
+    # 入口ブロックを alloca だけにして，残りをループヘッダに移す
+    #   entry: alloca ... ; br P
+    #   P:     br H
+    #   H:     仮引数と累積値の phi ; 元の入口の命令
+    entry = cfg.entry()
+    n = 0
+    while n < len(entry.codes) and isinstance(entry.codes[n], LLVMCodeAlloca):
+        n += 1
+    pre = BasicBlock(Labels(fundef.getNewLab()))
+    header = BasicBlock(Labels(fundef.getNewLab()))
+    header.codes = entry.codes[n:]
+    entry.codes = entry.codes[:n] + [LLVMCodeJ(pre.label)]
+    pre.codes = [LLVMCodeJ(header.label)]
+    cfg.blocks[1:1] = [pre, header]
+
+    # 仮引数の使用を phi の値に置き換える
+    params = {}
+    for p in fundef.params:
+        params[p] = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+    for b in cfg.blocks:
+        for l in b.codes:
+            l.mapUses(lambda x: params.get(x, x))
+    phis = {p: LLVMCodePhi(r, [(p, pre.label)]) for p, r in params.items()}
+    header.codes[0:0] = list(phis.values())
+
+    acc = None
+    if op is not None:
+        acc = LLVMCodePhi(Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo()),
+                          [(Operand(OType.CONSTANT, val=IDENTITY[op]), pre.label)])
+        header.codes.insert(len(phis), acc)
+
+    # 末尾呼び出しをヘッダへの分岐に置き換える
+    for t in sites:
+        b = t.block
+        k = b.codes.index(t.call)
+        b.codes = b.codes[:k] + t.loads
+        for p, v in zip(fundef.params, t.call.arg):
+            phis[p].addIncoming(v, b.label)
+        if acc is not None:
+            if t.op is None:
+                v = acc.retval
+            else:
+                v = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+                b.codes.append(op(v, acc.retval, params.get(t.other, t.other), nsw=False))
+            acc.addIncoming(v, b.label)
+        b.codes.append(LLVMCodeJ(header.label))
+
+    # 累積値を返り値に掛け合わせる（オーバーフローしても結果が変わらないよう nsw を付けない）
+    if acc is not None:
+        for b in cfg.blocks:
+            l = b.terminator() if b.codes else None
+            if isinstance(l, LLVMCodeRet):
+                v = Operand(OType.NUMBERED_REG, val=fundef.getNewRegNo())
+                b.insertBeforeTerminator(op(v, acc.retval, l.val, nsw=False))
+                l.val = v
+
+    cfg.link()
+    cfg.flatten()
+    stats.count('tailrec', 'eliminated tail calls', len(sites))
+    return len(sites)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from llvmcode import *
+from modref import getDefs
+from indvar import findInductionVars
+from operand import OType, Operand
+import dce
+import stats
+
+##
+## for文のループ展開
+##   繰り返し回数が定数のループを対象とし，
+##     本体の命令数 × 回数 がしきい値以下なら完全に展開し，
+##     そうでなければ factor 回分を1回の繰り返しにまとめ，余りの回数分は後ろに並べる
+##   展開で増やす命令数はプログラム全体で budget までとする
+##   プロファイルがあれば，よく回るループから展開し，一度も回らなかったループは展開しない
+##
+
+
+class UnrollBudget(object):
+    ''' プログラム全体でループ展開により増やしてよい命令数 '''
+
+    def __init__(self, size:int):
+        self.remaining = size
+
+    def take(self, n:int) -> bool:
+        if n > self.remaining:
+            return False
+        self.remaining -= n
+        return True
+
+
+class CountedLoop(object):
+    '''
+    展開できるループの情報
+        iv    : 制御変数（InductionVar）
+        cond  : ラッチの条件（icmp slt iv, upper）
+        trip  : 繰り返し回数
+        exit  : 出口ブロック
+    '''
+
+    def __init__(self, loop, iv, cond, trip, exit):
+        self.loop = loop
+        self.iv = iv
+        self.cond = cond
+        self.trip = trip
+        self.exit = exit
+
+    @property
+    def latch(self):
+        return self.iv.latch
+
+
+def analyze(cfg, loop, defs):
+    ''' ループ loop が繰り返し回数の分かる最内ループなら CountedLoop を返す '''
+    if loop.children or len(loop.latches) != 1:
+        return None
+    latch = loop.latches[0]
+    header = loop.header
+    exits = loop.exits()
+    if len(exits) != 1 or len(header.preds) != 2:
+        return None
+    for b in loop.blocks:
+        if b is not latch and any(s not in loop.blocks for s in b.succs):
+            return None
+    br = latch.terminator()
+    if not isinstance(br, LLVMCodeBr) or br.arg1 != header.label or br.arg2 != exits[0].label:
+        return None
+
+    cond = defs.get(br.cond)
+    for iv in findInductionVars(loop, defs):
+        if iv.step != 1 or not iv.init.isConst():
+            continue
+        if (isinstance(cond, LLVMCodeIcmp) and cond.cond == CmpType.SLT
+                and cond.arg1 == iv.reg and cond.arg2.isConst() and cond in latch.codes):
+            trip = cond.arg2.val - iv.init.val + 1
+            if trip < 1:
+                return None
+            return CountedLoop(loop, iv, cond, trip, exits[0])
+    return None
+
+
+def usedOnlyInLoop(cfg, c:CountedLoop) -> bool:
+    ''' ループ内で定義した値がループ外では出口の phi（ラッチからの入力）でしか使われないか '''
+    inside = set()
+    for b in c.loop.blocks:
+        for l in b.codes:
+            if l.getDef() is not None:
+                inside.add(l.getDef())
+    for b in cfg.blocks:
+        if b in c.loop.blocks:
+            continue
+        for l in b.codes:
+            if isinstance(l, LLVMCodePhi) and b is c.exit:
+                if any(v in inside and lab != c.latch.label for v, lab in l.incoming):
+                    return False
+            elif any(x in inside for x in l.getUses()):
+                return False
+    return True
+
+
+class Unroller(object):
+    ''' 1つのループの展開 '''
+
+    def __init__(self, cfg, c:CountedLoop):
+        self.cfg = cfg
+        self.c = c
+        self.fundef = cfg.fundef
+        self.order = [b for b in cfg.blocks if b in c.loop.blocks]
+        self.phis = c.loop.header.phis()
+        # ヘッダの phi の後退辺からの入力
+        self.back = {}
+        for phi in self.phis:
+            self.back[phi.retval] = [v for v, l in phi.incoming if l == c.latch.label][0]
+
+    def latchValues(self, valmap:dict) -> dict:
+        ''' 1回分の本体を実行した後のヘッダの phi の値 '''
+        return {r: valmap.get(v, v) for r, v in self.back.items()}
+
+    def cloneIteration(self, vals:dict):
+        ''' ヘッダの phi の値を vals とした本体1回分の複製 '''
+        labmap = {b.label: Labels(self.fundef.getNewLab()) for b in self.order}
+        valmap = dict(vals)
+        for b in self.order:
+            for l in b.codes:
+                r = l.getDef()
+                if r is not None and r not in valmap:
+                    valmap[r] = Operand(OType.NUMBERED_REG, val=self.fundef.getNewRegNo())
+        blocks = []
+        for b in self.order:
+            nb = BasicBlock(labmap[b.label])
+            for l in b.codes:
+                if l in self.phis:
+                    continue
+                c = l.clone()
+                c.mapUses(lambda x: valmap.get(x, x))
+                if c.getDef() is not None:
+                    c.setDef(valmap[l.getDef()])
+                c.mapTargets(lambda t: labmap.get(t, t))
+                if isinstance(c, LLVMCodePhi):
+                    c.mapIncoming(lambda t: labmap.get(t, t))
+                nb.codes.append(c)
+            blocks.append(nb)
+        latch = blocks[self.order.index(self.c.latch)]
+        header = blocks[self.order.index(self.c.loop.header)]
+        return blocks, header, latch, valmap
+
+    def straightCopies(self, n:int, vals:dict, enter):
+        '''
+        本体 n 回分を直列に並べた複製を作る
+            enter(label) : 先頭の複製へ入る分岐を設定する関数
+        戻り値は (ブロック列, 最後のラッチ, 最後の値の対応表)
+        '''
+        blocks = []
+        latch = None
+        valmap = {}
+        for k in range(n):
+            bs, header, l, valmap = self.cloneIteration(vals)
+            if latch is None:
+                enter(header.label)
+            else:
+                latch.codes[-1] = LLVMCodeJ(header.label)
+            latch = l
+            vals = self.latchValues(valmap)
+            blocks.extend(bs)
+        return blocks, latch, valmap
+
+    def fixExit(self, latch:BasicBlock, valmap:dict):
+        ''' 出口ブロックの phi のラッチからの入力を，最後の複製からの入力に付け替える '''
+        old = self.c.latch.label
+        for phi in self.c.exit.phis():
+            phi.incoming = [(valmap.get(v, v), latch.label) if l == old else (v, l) for v, l in phi.incoming]
+
+    def place(self, blocks:list, remove:bool):
+        ''' 複製したブロックをループの後ろに置く（remove なら元のループを取り除く） '''
+        last = max(self.cfg.blocks.index(b) for b in self.order)
+        self.cfg.blocks[last + 1:last + 1] = blocks
+        if remove:
+            self.cfg.blocks = [b for b in self.cfg.blocks if b not in self.c.loop.blocks]
+        self.cfg.link()
+
+    def full(self, pre:BasicBlock):
+        ''' 完全展開 '''
+        header = self.c.loop.header
+        vals = {}
+        for phi in self.phis:
+            vals[phi.retval] = [v for v, l in phi.incoming if l == pre.label][0]
+        blocks, latch, valmap = self.straightCopies(
+            self.c.trip, vals, lambda lab: pre.terminator().retarget(header.label, lab))
+        latch.codes[-1] = LLVMCodeJ(self.c.exit.label)
+        self.fixExit(latch, valmap)
+        self.place(blocks, True)
+
+    def partial(self, factor:int):
+        ''' factor 回分をまとめた部分展開と，余りの回数分の直列の複製 '''
+        c = self.c
+        header = c.loop.header
+        main = c.trip // factor
+        rest = c.trip % factor
+
+        # 元の本体を1回目とし，2〜factor 回目の複製をつなげる
+        def enter(lab):
+            c.latch.codes[-1] = LLVMCodeJ(lab)
+        blocks, latch, valmap = self.straightCopies(factor - 1, self.latchValues({}), enter)
+        # 最後の複製のラッチで main 回目の終わりかどうかを判定
+        cond = [l for l in latch.codes if l.getDef() == valmap[c.cond.retval]][0]
+        cond.arg2 = Operand(OType.CONSTANT, val=c.iv.init.val + main * factor - 1)
+        latch.codes[-1] = LLVMCodeBr(cond.retval, header.label, c.exit.label)
+        final = self.latchValues(valmap)
+        for phi in self.phis:
+            phi.incoming = [(final[phi.retval], latch.label) if l == c.latch.label else (v, l) for v, l in phi.incoming]
+        exitvals = valmap
+        exitlatch = latch
+
+        if rest:
+            br = latch.codes[-1]
+            more, exitlatch, exitvals = self.straightCopies(
+                rest, final, lambda lab: br.retarget(c.exit.label, lab))
+            exitlatch.codes[-1] = LLVMCodeJ(c.exit.label)
+            blocks.extend(more)
+        self.fixExit(exitlatch, exitvals)
+        self.place(blocks, False)
+
+
+def iterations(loop):
+    ''' プロファイルから求めたループの繰り返し回数（ラッチの分岐回数．分からなければ None） '''
+    if len(loop.latches) != 1:
+        return None
+    br = loop.latches[0].terminator()
+    if not isinstance(br, LLVMCodeBr) or br.weights is None:
+        return None
+    return sum(br.weights)
+
+
+def run(fundef, threshold:int, factor:int, budget:UnrollBudget) -> int:
+    ''' 関数定義 fundef の最内ループを展開し，展開したループ数を返す '''
+    cfg = CFG(fundef)
+    # プロファイルがあれば，よく回るループから予算を使う
+    loops = sorted(cfg.findLoops(), key=lambda loop: -(iterations(loop) or 0))
+    n = 0
+    for loop in loops:
+        defs = getDefs(fundef)
+        c = analyze(cfg, loop, defs)
+        if c is None or not usedOnlyInLoop(cfg, c) or iterations(loop) == 0:
+            continue
+        size = sum(len(b.codes) for b in loop.blocks)
+        if size * c.trip <= threshold and budget.take(size * (c.trip - 1)):
+            pre = cfg.ensurePreheader(loop)
+            Unroller(cfg, c).full(pre)
+            stats.count('unroll', 'fully unrolled loops')
+            n += 1
+        elif factor > 1 and c.trip >= 2 * factor and budget.take(size * (factor - 1 + c.trip % factor)):
+            Unroller(cfg, c).partial(factor)
+            stats.count('unroll', 'partially unrolled loops')
+            n += 1
+    cfg.flatten()
+    if n:
+        dce.run(fundef)
+    return n
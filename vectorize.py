@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG, BasicBlock
+from llvmcode import *
+from modref import getDefs
+from indvar import findInductionVars, affine, liveOutOnlyNext
+from operand import OType, Operand
+import stats
+
+##
+## 配列ループのベクトル化
+##   本体が大域配列の要素ごとの演算だけの最内ループ
+##       for i := l to u do a[i + c1] := b[i + c2] + c[i + c3] * k
+##   を，width 要素ずつ <width x i32> のロード・演算・ストアで処理するループと，
+##   余りの回数分を処理する元のループに分ける．
+##
+##   変換前                         変換後
+##     P: br H                        P: 回数を計算 ; br (width 回以上) ? VP : SP
+##                                    VP: ループ不変値の複製 ; br V
+##                                    V:  ベクトル本体 ; br (残りあり) ? V : M
+##                                    M:  br (余りなし) ? E : SP
+##                                    SP: 開始値の phi ; br H
+##     H: 元の本体 ... br c, H, E     H: 元の本体（余りの回数分）
+##
+##   同じ配列への読み書きの添字の差が width 未満のときは，
+##   ベクトル化しても実行順の入れ替わりが結果に影響しない向きの場合だけ変換する．
+##
+
+VECTOR_OPS = {LLVMCodeAdd: 'add', LLVMCodeSub: 'sub', LLVMCodeMul: 'mul',
+              LLVMCodeDiv: 'sdiv', LLVMCodeShl: 'shl', LLVMCodeAshr: 'ashr'}
+
+
+class MemAccess(object):
+    '''
+    配列アクセス
+        code  : ロード・ストア命令
+        name  : 配列名
+        pos   : 添字 - 帰納変数（配列先頭からの要素位置の定数項）
+        order : 本体内での順番
+    '''
+
+    def __init__(self, code, name:str, pos:int, order:int):
+        self.code = code
+        self.name = name
+        self.pos = pos
+        self.order = order
+
+    @property
+    def isStore(self) -> bool:
+        return isinstance(self.code, LLVMCodeStore)
+
+
+class VectorLoop(object):
+    '''
+    ベクトル化できるループの情報
+        iv     : 帰納変数（InductionVar）
+        upper  : 繰り返しの上限（icmp slt iv, upper のループ不変値）
+        exit   : 出口ブロック
+        body   : ベクトル版に複製する命令のリスト
+        geps   : getelementptr 命令 → (配列名, 要素位置の定数項)
+    '''
+
+    def __init__(self, loop, iv, upper, exit, body, geps):
+        self.loop = loop
+        self.iv = iv
+        self.upper = upper
+        self.exit = exit
+        self.body = body
+        self.geps = geps
+
+
+def independent(mems:list, width:int) -> bool:
+    ''' width 回分の繰り返しをまとめて実行しても，配列アクセスの依存が壊れないか '''
+    for s in mems:
+        if not s.isStore:
+            continue
+        for m in mems:
+            if m is s or m.name != s.name:
+                continue
+            d = s.pos - m.pos
+            if d == 0 or abs(d) >= width:
+                continue
+            if not m.isStore:
+                # 前の繰り返しの書き込みを読む（d > 0）ならストアが先，
+                # 後の繰り返しが上書きする値を読む（d < 0）ならロードが先であればよい
+                if d > 0 and s.order < m.order:
+                    continue
+                if d < 0 and m.order < s.order:
+                    continue
+            return False
+    return True
+
+
+def analyze(cfg, loop, defs:dict, width:int):
+    ''' ループ loop がベクトル化できるなら VectorLoop を返す '''
+    if loop.children or len(loop.latches) != 1:
+        return None
+    header = loop.header
+    latch = loop.latches[0]
+    if loop.blocks != {header, latch}:
+        return None
+    if header is not latch and (not isinstance(header.terminator(), LLVMCodeJ) or latch.preds != [header]):
+        return None
+    exits = loop.exits()
+    br = latch.terminator()
+    if len(exits) != 1 or not isinstance(br, LLVMCodeBr) or br.arg1 != header.label or br.arg2 != exits[0].label:
+        return None
+    exit = exits[0]
+
+    ivs = [iv for iv in findInductionVars(loop, defs) if iv.step == 1]
+    if len(ivs) != 1 or len(header.phis()) != 1:
+        return None
+    iv = ivs[0]
+    inside = set()
+    for b in loop.blocks:
+        for l in b.codes:
+            if l.getDef() is not None:
+                inside.add(l.getDef())
+
+    def inloop(x) -> bool:
+        return x in inside
+
+    cond = defs.get(br.cond)
+    if not (isinstance(cond, LLVMCodeIcmp) and cond.cond == CmpType.SLT and cond.arg1 == iv.reg
+            and cond in latch.codes and not inloop(cond.arg2)):
+        return None
+
+    if not liveOutOnlyNext(cfg, loop, iv, exit):
+        return None
+
+    # 本体の命令（phi，終端命令，ループ制御の命令を除く）
+    control = {id(cond), id(defs[iv.next])}
+    codes = []
+    for b in ([header] if header is latch else [header, latch]):
+        for l in b.codes:
+            if isinstance(l, LLVMCodePhi) or l.isTerminator() or id(l) in control:
+                continue
+            codes.append(l)
+    for l in codes:
+        if cond.retval in l.getUses():
+            return None
+
+    # ストアから逆順にたどって，ベクトル版に必要な命令を求める
+    #   getelementptr の添字は帰納変数のアフィン式から作り直すので，その計算はたどらない
+    def root(l) -> bool:
+        return not (l.isPure() or isinstance(l, LLVMCodeLoad))
+
+    needed = set()
+    for l in reversed(codes):
+        if (root(l) or l.getDef() in needed) and not isinstance(l, LLVMCodeGetelementptr):
+            needed.update(x for x in l.getUses() if inloop(x))
+    body = [l for l in codes if root(l) or l.getDef() in needed]
+
+    geps = {}
+    mems = []
+    for k, l in enumerate(body):
+        if isinstance(l, LLVMCodeGetelementptr):
+            s = defs.get(l.ptr)
+            if isinstance(s, LLVMCodeSext):
+                a = affine(s.v, iv.reg, inloop, defs)
+            elif l.idxtype == 'i32':
+                a = affine(l.ptr, iv.reg, inloop, defs)
+            else:
+                return None
+            if a is None or a.coef != 1 or a.terms:
+                return None
+            geps[l.retval] = (l, a.const + l.offset)
+        elif isinstance(l, (LLVMCodeLoad, LLVMCodeStore)):
+            if l.ptr not in geps:
+                return None
+            if isinstance(l, LLVMCodeStore) and l.argval in geps:
+                return None
+            g, pos = geps[l.ptr]
+            mems.append(MemAccess(l, g.name, pos, k))
+        elif type(l) not in VECTOR_OPS:
+            return None
+        if any(x in geps for x in l.getUses()) and not isinstance(l, (LLVMCodeLoad, LLVMCodeStore)):
+            return None
+    if not any(m.isStore for m in mems) or not independent(mems, width):
+        return None
+    return VectorLoop(loop, iv, cond.arg2, exit, body, geps)
+
+
+class Vectorizer(object):
+    ''' 1つのループのベクトル化 '''
+
+    def __init__(self, cfg, v:VectorLoop, width:int):
+        self.cfg = cfg
+        self.fundef = cfg.fundef
+        self.v = v
+        self.width = width
+
+    def newReg(self) -> Operand:
+        return Operand(OType.NUMBERED_REG, val=self.fundef.getNewRegNo())
+
+    def emit(self, b:BasicBlock, cls, *args, **kwargs) -> Operand:
+        ''' ブロック b の終端命令の前にスカラー命令を追加する（定数に畳み込めればその定数） '''
+        l = cls(self.newReg(), *args, **kwargs)
+        v = l.constValue()
+        if v is not None:
+            return Operand(OType.CONSTANT, val=v)
+        b.insertBeforeTerminator(l)
+        return l.retval
+
+    def run(self, pre:BasicBlock) -> bool:
+        v = self.v
+        w = self.width
+        iv = v.iv
+        header = v.loop.header
+        shift = Operand(OType.CONSTANT, val=w.bit_length() - 1)
+
+        # 繰り返し回数とベクトル版で処理する回数
+        #   回数が定数なら width 回に満たないループは変換しない
+        init = iv.init
+        t = self.emit(pre, LLVMCodeSub, v.upper, init, nsw=False)
+        trip = self.emit(pre, LLVMCodeAdd, t, Operand(OType.CONSTANT, val=1), nsw=False)
+        q = self.emit(pre, LLVMCodeAshr, trip, shift)
+        count = self.emit(pre, LLVMCodeShl, q, shift)
+        if count.isConst() and count.val <= 0:
+            return False
+        end = self.emit(pre, LLVMCodeAdd, init, count, nsw=False)
+
+        vpre = BasicBlock(Labels(self.fundef.getNewLab()))
+        vbody = BasicBlock(Labels(self.fundef.getNewLab()))
+        mid = BasicBlock(Labels(self.fundef.getNewLab()))
+        spre = BasicBlock(Labels(self.fundef.getNewLab()))
+
+        if count.isConst():
+            pre.codes[-1] = LLVMCodeJ(vpre.label)
+        else:
+            has = self.emit(pre, LLVMCodeIcmp, CmpType.SGT, count, Operand(OType.CONSTANT, val=0))
+            pre.codes[-1] = LLVMCodeBr(has, vpre.label, spre.label)
+        vpre.codes.append(LLVMCodeJ(vbody.label))
+        vbody.codes.append(LLVMCodeBr(None, vbody.label, mid.label))
+
+        # ベクトル版の帰納変数
+        viv = self.newReg()
+        vnext = self.newReg()
+        vbody.codes.insert(0, LLVMCodePhi(viv, [(init, vpre.label), (vnext, vbody.label)]))
+
+        splats = {}
+
+        def splat(x, b:BasicBlock) -> Operand:
+            ''' スカラー値 x を全要素に複製したベクトル '''
+            if x not in splats:
+                e = self.newReg()
+                s = self.newReg()
+                b.insertBeforeTerminator(LLVMCodeInsertElement(e, x, w))
+                b.insertBeforeTerminator(LLVMCodeSplat(s, e, w))
+                splats[x] = s
+            return splats[x]
+
+        lanes = None
+        vals = {}
+
+        def vector(x):
+            ''' 本体のオペランド x のベクトル版 '''
+            nonlocal lanes
+            if x in vals:
+                return vals[x]
+            if x.isConst():
+                return x
+            if x == iv.reg:
+                if lanes is None:
+                    lanes = self.newReg()
+                    vbody.insertBeforeTerminator(
+                        LLVMCodeVecBinOp(lanes, 'add', splat(viv, vbody), tuple(range(w)), w))
+                return lanes
+            return splat(x, vpre)
+
+        for l in v.body:
+            if isinstance(l, LLVMCodeGetelementptr):
+                g, pos = v.geps[l.retval]
+                p = self.newReg()
+                vbody.insertBeforeTerminator(
+                    LLVMCodeGetelementptr(p, g.size, g.name, viv, pos, 'i32'))
+                vals[l.retval] = self.newReg()
+                vbody.insertBeforeTerminator(LLVMCodeBitcast(vals[l.retval], p, w))
+            elif isinstance(l, LLVMCodeLoad):
+                vals[l.retval] = self.newReg()
+                vbody.insertBeforeTerminator(LLVMCodeVecLoad(vals[l.retval], vals[l.ptr], w))
+            elif isinstance(l, LLVMCodeStore):
+                vbody.insertBeforeTerminator(LLVMCodeVecStore(vector(l.argval), vals[l.ptr], w))
+            else:
+                op = VECTOR_OPS[type(l)]
+                if getattr(l, 'nsw', False):
+                    op += ' nsw'
+                vals[l.retval] = self.newReg()
+                vbody.insertBeforeTerminator(
+                    LLVMCodeVecBinOp(vals[l.retval], op, vector(l.arg1), vector(l.arg2), w))
+
+        vbody.insertBeforeTerminator(LLVMCodeAdd(vnext, viv, Operand(OType.CONSTANT, val=w), nsw=False))
+        vcond = self.newReg()
+        vbody.insertBeforeTerminator(LLVMCodeIcmp(vcond, CmpType.SLT, vnext, end))
+        vbody.terminator().cond = vcond
+
+        # 余りの回数分は元のループで処理する
+        mid.codes.append(LLVMCodeBr(None, v.exit.label, spre.label))
+        done = self.emit(mid, LLVMCodeIcmp, CmpType.SGT, end, v.upper)
+        if done.isConst():
+            mid.codes[-1] = LLVMCodeJ(v.exit.label if done.val else spre.label)
+        else:
+            mid.terminator().cond = done
+        start = self.newReg()
+        incoming = [(end, mid.label)]
+        if not count.isConst():
+            incoming.insert(0, (init, pre.label))
+        spre.codes = [LLVMCodePhi(start, incoming), LLVMCodeJ(header.label)]
+        iv.phi.retargetIncoming(pre.label, spre.label)
+        iv.phi.incoming = [(start, l) if l == spre.label else (x, l) for x, l in iv.phi.incoming]
+        if not (done.isConst() and not done.val):
+            for phi in v.exit.phis():
+                phi.addIncoming(end, mid.label)
+
+        i = self.cfg.blocks.index(header)
+        self.cfg.blocks[i:i] = [vpre, vbody, mid, spre]
+        self.cfg.link()
+        if done.isConst() and done.val:
+            self.removeScalarLoop(spre)
+        return True
+
+    def removeScalarLoop(self, spre:BasicBlock):
+        ''' 余りがないと分かっているときは元のループを取り除く '''
+        v = self.v
+        latch = v.loop.latches[0]
+        for phi in v.exit.phis():
+            phi.incoming = [(x, l) for x, l in phi.incoming if l != latch.label]
+        dead = v.loop.blocks | {spre}
+        self.cfg.blocks = [b for b in self.cfg.blocks if b not in dead]
+        self.cfg.link()
+
+
+def run(fundef, width:int) -> int:
+    ''' 関数定義 fundef の配列ループを width（2のべき）要素ずつベクトル化し，変換したループ数を返す '''
+    if width < 2 or width & (width - 1):
+        return 0
+    cfg = CFG(fundef)
+    n = 0
+    for loop in cfg.findLoops():
+        defs = getDefs(fundef)
+        if analyze(cfg, loop, defs, width) is None:
+            continue
+        pre = cfg.ensurePreheader(loop)
+        cfg.flatten()
+        v = analyze(cfg, loop, getDefs(fundef), width)
+        if v is not None and Vectorizer(cfg, v, width).run(pre):
+            stats.count('vectorize', 'vectorized loops')
+            n += 1
+        cfg.flatten()
+    return n
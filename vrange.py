@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from llvmcode import *
+from modref import baseOf, getDefs
+from operand import OType, Operand
+import dce
+import stats
+
+##
+## 値の範囲解析（Value Range Analysis）
+##   SSA の各整数値がとりうる範囲 (lo, hi) を
+##     - 定数と演算（nsw の加減乗算は桁あふれしないとみなす）
+##     - phi（広がり続ける端は何度か繰り返した後で 32 ビットの端まで広げ，最後に狭め直す）
+##     - 条件分岐（分岐先のブロックとそれが支配するブロックでは比較の結果が分かっている）
+##     - 配列の大きさ（配列要素を読み書きしたブロックが狭義に支配するブロックでは添字が配列内にある）
+##     - 大域変数・大域配列に書き込まれる値（初期値 0 を含む．read で読み込むものは分からない）
+##   から求め，最適化の最後に
+##     - 非負の値の sext を取り除く（getelementptr の i32 添字にする）か zext にする
+##     - 桁あふれしない add・sub・mul・shl に nsw・nuw を付ける
+##     - 値の範囲が分かる大域変数・大域配列からの load に !range メタデータを付ける
+##
+
+MIN = -0x80000000
+MAX = 0x7fffffff
+FULL = (MIN, MAX)
+
+WIDEN_AFTER = 3     # phi の範囲がこの回数広がったら端まで広げる
+NARROW_ROUNDS = 3   # 広げた後に狭め直す回数
+MAX_ROUNDS = 100    # 反復の上限（超えたら解析をあきらめる）
+
+
+def union(a, b):
+    ''' 範囲の合併（None は到達しない値） '''
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+
+def intersect(a, b):
+    ''' 範囲の共通部分（空なら None） '''
+    if a is None or b is None:
+        return None
+    lo, hi = max(a[0], b[0]), min(a[1], b[1])
+    return (lo, hi) if lo <= hi else None
+
+
+def fits(r) -> bool:
+    ''' 範囲が 32 ビット符号付き整数に収まるか '''
+    return MIN <= r[0] and r[1] <= MAX
+
+
+def tdiv(a:int, b:int) -> int:
+    ''' 0 方向へ切り捨てる除算 '''
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+ARITH = {LLVMCodeAdd: 'add', LLVMCodeSub: 'sub', LLVMCodeMul: 'mul'}
+
+
+def arith(op:str, a, b):
+    ''' 加減乗算 op（'add'・'sub'・'mul'）の結果の（桁あふれを考えない）範囲 '''
+    if op == 'add':
+        return (a[0] + b[0], a[1] + b[1])
+    if op == 'sub':
+        return (a[0] - b[1], a[1] - b[0])
+    p = [x * y for x in a for y in b]
+    return (min(p), max(p))
+
+
+def compare(cond:CmpType, y):
+    ''' x cond y が成り立つとき x がとりうる範囲（y の範囲から） '''
+    if cond == CmpType.SLT:
+        return (MIN, y[1] - 1)
+    if cond == CmpType.SLE:
+        return (MIN, y[1])
+    if cond == CmpType.SGT:
+        return (y[0] + 1, MAX)
+    if cond == CmpType.SGE:
+        return (y[0], MAX)
+    if cond == CmpType.EQ:
+        return y
+    return FULL
+
+
+class RangeAnalysis(object):
+    '''
+    関数1つの値の範囲
+        cfg    : 制御フローグラフ
+        ranges : 番号付きレジスタ → 範囲（到達しなければ None）
+        facts  : レジスタ → (成り立つブロック, 狭義か, 範囲を求める関数) のリスト
+        stored : 大域変数・大域配列（baseOf の値）→ 書き込まれる値の範囲（None ならすべて分からない）
+    '''
+
+    def __init__(self, fundef, stored):
+        self.fundef = fundef
+        self.cfg = CFG(fundef)
+        self.defs = getDefs(fundef)
+        self.stored = stored
+        self.ranges = {}
+        self.facts = {}
+        self.collectFacts()
+        self.solved = self.solve()
+
+    def fact(self, x, scope, strict:bool, bound):
+        if isinstance(x, Operand) and x.type == OType.NUMBERED_REG:
+            self.facts.setdefault(x, []).append((scope, strict, bound))
+
+    def collectFacts(self):
+        ''' 条件分岐と配列要素の読み書きから分かる範囲を集める '''
+        for b in self.cfg.blocks:
+            t = b.terminator() if b.codes else None
+            if isinstance(t, LLVMCodeBr) and t.arg1 != t.arg2:
+                c = self.defs.get(t.cond)
+                if isinstance(c, LLVMCodeIcmp):
+                    for label, cond in ((t.arg1, c.cond), (t.arg2, c.cond.inverse())):
+                        s = self.cfg.blockOf(label)
+                        if s.preds != [b]:
+                            continue
+                        self.fact(c.arg1, s, False,
+                                  lambda cond=cond, y=c.arg2: self.boundFrom(cond, y))
+                        self.fact(c.arg2, s, False,
+                                  lambda cond=cond.swapped(), y=c.arg1: self.boundFrom(cond, y))
+            for l in b.codes:
+                access = self.accessBound(l)
+                if access is not None:
+                    x, bound = access
+                    self.fact(x, b, True, lambda bound=bound: bound)
+
+    def accessBound(self, l):
+        ''' 配列要素を読み書きする命令 l の後で成り立つ (添字の値, 範囲)（なければ None） '''
+        if not isinstance(l, (LLVMCodeLoad, LLVMCodeStore)):
+            return None
+        gep = self.defs.get(l.ptr)
+        if not isinstance(gep, LLVMCodeGetelementptr) or gep.ptr.isConst():
+            return None
+        x = gep.ptr
+        if gep.idxtype == 'i64':
+            s = self.defs.get(x)
+            if not isinstance(s, LLVMCodeSext):
+                return None
+            x = s.v
+        return x, (-gep.offset, int(gep.size) - 1 - gep.offset)
+
+    def boundFrom(self, cond:CmpType, y):
+        # 比較相手の範囲には分岐による絞り込みを使わない（再帰をしない）
+        if y.isConst():
+            r = (y.val, y.val)
+        elif y.type == OType.NUMBERED_REG:
+            r = self.ranges.get(y)
+        else:
+            r = FULL
+        return FULL if r is None else compare(cond, r)
+
+    def get(self, x, b):
+        ''' ブロック b で使うときのオペランド x の範囲（ベクトルは全要素の範囲） '''
+        if isinstance(x, tuple):
+            return (min(x), max(x))
+        if not isinstance(x, Operand):
+            return FULL
+        if x.isConst():
+            return (x.val, x.val)
+        if x.type != OType.NUMBERED_REG:
+            return FULL
+        r = self.ranges.get(x)
+        if r is None:
+            return None
+        for scope, strict, bound in self.facts.get(x, ()):
+            if strict and scope is b:
+                continue
+            if self.cfg.dominates(scope, b):
+                r = intersect(r, bound()) or r
+        return r
+
+    def loaded(self, l):
+        ''' load 命令 l で読む値の範囲 '''
+        if self.stored is None:
+            return FULL
+        ptr = l.ptr
+        c = self.defs.get(ptr)
+        if isinstance(c, LLVMCodeBitcast):
+            ptr = c.ptr
+        base = baseOf(ptr, self.defs)
+        if base is None or base[0] != 'global':
+            return FULL
+        return self.stored.get(base, (0, 0))
+
+    def transfer(self, l, b):
+        ''' 命令 l の結果の範囲 '''
+        if isinstance(l, LLVMCodePhi):
+            if l.type != 'i32':
+                return FULL
+            r = None
+            for v, label in l.incoming:
+                r = union(r, self.get(v, self.cfg.blockOf(label)))
+            return r
+        if isinstance(l, (LLVMCodeLoad, LLVMCodeVecLoad)):
+            return self.loaded(l)
+        if isinstance(l, LLVMCodeIcmp):
+            return (0, 1)
+        if isinstance(l, LLVMCodeSext):
+            return self.get(l.v, b)
+        # insertelement は未定義の要素を作るが，それを使う splat は先頭要素しか見ない
+        if isinstance(l, LLVMCodeInsertElement):
+            return self.get(l.val, b)
+        if isinstance(l, LLVMCodeSplat):
+            return self.get(l.vec, b)
+        if isinstance(l, LLVMCodeVecBinOp):
+            op = l.op.split()[0]
+            a = self.get(l.arg1, b)
+            c = self.get(l.arg2, b)
+            if a is None or c is None:
+                return None
+            if op not in ARITH.values():
+                return FULL
+            r = arith(op, a, c)
+            if fits(r):
+                return r
+            return (intersect(r, FULL) or FULL) if 'nsw' in l.op else FULL
+        if not isinstance(l, (LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul, LLVMCodeDiv,
+                              LLVMCodeShl, LLVMCodeAshr, LLVMCodeAnd)):
+            return FULL
+        a = self.get(l.arg1, b)
+        c = self.get(l.arg2, b)
+        if a is None or c is None:
+            return None
+        if isinstance(l, (LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul)):
+            r = arith(ARITH[type(l)], a, c)
+            if fits(r):
+                return r
+            return (intersect(r, FULL) or FULL) if l.nsw else FULL
+        if isinstance(l, LLVMCodeDiv):
+            if c[0] == c[1] and c[0] != 0:
+                q = (tdiv(a[0], c[0]), tdiv(a[1], c[0]))
+                return intersect((min(q), max(q)), FULL) or FULL
+            if c[0] > 0 or c[1] < 0:
+                m = max(abs(a[0]), abs(a[1]))
+                return (0, a[1]) if a[0] >= 0 and c[0] > 0 else (intersect((-m, m), FULL) or FULL)
+            return FULL
+        if isinstance(l, LLVMCodeShl):
+            if c[0] == c[1] and 0 <= c[0] < 32:
+                r = (a[0] << c[0], a[1] << c[0])
+                if fits(r):
+                    return r
+            return FULL
+        if isinstance(l, LLVMCodeAshr):
+            if c[0] == c[1] and 0 <= c[0] < 32:
+                return (a[0] >> c[0], a[1] >> c[0])
+            return (min(a[0], 0), max(a[1], 0))
+        # and
+        if a[0] >= 0 and c[0] >= 0:
+            return (0, min(a[1], c[1]))
+        if a[0] >= 0 or c[0] >= 0:
+            return (0, a[1] if a[0] >= 0 else c[1])
+        return FULL
+
+    def solve(self) -> bool:
+        ''' 範囲が変わらなくなるまで反復する（収束しなければ False） '''
+        order = self.cfg.rpo()
+        grown = {}
+        for _ in range(MAX_ROUNDS):
+            changed = False
+            for b in order:
+                for l in b.codes:
+                    r = l.getDef()
+                    if r is None or r.type != OType.NUMBERED_REG:
+                        continue
+                    old = self.ranges.get(r)
+                    new = union(old, self.transfer(l, b))
+                    if new == old:
+                        continue
+                    if isinstance(l, LLVMCodePhi) and old is not None:
+                        grown[r] = grown.get(r, 0) + 1
+                        if grown[r] >= WIDEN_AFTER:
+                            new = (MIN if new[0] < old[0] else new[0], MAX if new[1] > old[1] else new[1])
+                    self.ranges[r] = new
+                    changed = True
+            if not changed:
+                break
+        else:
+            return False
+        # 広げた範囲を狭め直す（結果は常に元の範囲に含まれる）
+        for _ in range(NARROW_ROUNDS):
+            for b in order:
+                for l in b.codes:
+                    r = l.getDef()
+                    if r is not None and r.type == OType.NUMBERED_REG and r in self.ranges:
+                        self.ranges[r] = intersect(self.ranges[r], self.transfer(l, b)) or self.ranges[r]
+        return True
+
+
+def storedRanges(analyses) -> dict:
+    '''
+    大域変数・大域配列（baseOf の値）→ 書き込まれる値と初期値 0 を合わせた範囲
+    番地の分からない書き込みがあれば None を返す
+    '''
+    stored = {}
+    for a in analyses:
+        for b in a.cfg.blocks:
+            for l in b.codes:
+                if isinstance(l, LLVMCodeStore):
+                    ptr, r = l.ptr, (a.get(l.argval, b) if a.solved else FULL)
+                elif isinstance(l, LLVMCodeCallScanf):
+                    ptr, r = l.arg, FULL
+                elif isinstance(l, LLVMCodeVecStore):
+                    c = a.defs.get(l.ptr)
+                    ptr = c.ptr if isinstance(c, LLVMCodeBitcast) else l.ptr
+                    r = a.get(l.argval, b) if a.solved else FULL
+                else:
+                    continue
+                base = baseOf(ptr, a.defs)
+                if base is None:
+                    return None
+                if base[0] == 'global' and r is not None:
+                    stored[base] = union(stored.get(base, (0, 0)), r)
+    return stored
+
+
+def annotate(a) -> None:
+    ''' 関数1つの命令に範囲から分かる性質を書き込む '''
+    users = {}
+    for l in a.fundef.codes:
+        for x in l.getUses():
+            users.setdefault(x, []).append(l)
+    removed = False
+    for b in a.cfg.blocks:
+        # 同じブロックの中でも，配列要素を読み書きした後は添字が配列内にある
+        local = {}
+
+        def get(x):
+            r = a.get(x, b)
+            return intersect(r, local.get(x, FULL)) or r
+
+        for l in b.codes:
+            access = a.accessBound(l)
+            if access is not None:
+                x, bound = access
+                local[x] = intersect(local.get(x, FULL), bound) or local.get(x, FULL)
+            if isinstance(l, LLVMCodeLoad):
+                r = a.loaded(l)
+                if r != FULL:
+                    l.range = r
+                    stats.count('vrange', 'loads with !range')
+                continue
+            if isinstance(l, LLVMCodeSext):
+                r = get(l.v)
+                if r is None or r[0] < 0:
+                    continue
+                uses = users.get(l.retval, [])
+                if all(isinstance(u, LLVMCodeGetelementptr) and u.idxtype == 'i64' for u in uses):
+                    for u in uses:
+                        u.ptr = l.v
+                        u.idxtype = 'i32'
+                    removed = True
+                    stats.count('vrange', 'removed sext')
+                else:
+                    l.zext = True
+                    stats.count('vrange', 'sext to zext')
+                continue
+            if not isinstance(l, (LLVMCodeAdd, LLVMCodeSub, LLVMCodeMul, LLVMCodeShl)):
+                continue
+            x = get(l.arg1)
+            y = get(l.arg2)
+            if x is None or y is None:
+                continue
+            if isinstance(l, LLVMCodeShl):
+                if y[0] != y[1] or not 0 <= y[0] < 32:
+                    continue
+                r = (x[0] << y[0], x[1] << y[0])
+                nuw = x[0] >= 0 and r[1] <= 0xffffffff
+            else:
+                r = arith(ARITH[type(l)], x, y)
+                nonneg = x[0] >= 0 and y[0] >= 0
+                if isinstance(l, LLVMCodeAdd):
+                    nuw = nonneg
+                elif isinstance(l, LLVMCodeSub):
+                    nuw = nonneg and x[0] >= y[1]
+                else:
+                    nuw = nonneg and r[1] <= 0xffffffff
+            if fits(r) and not l.nsw:
+                l.nsw = True
+                stats.count('vrange', 'nsw flags')
+            if nuw and not l.nuw:
+                l.nuw = True
+                stats.count('vrange', 'nuw flags')
+    if removed:
+        dce.run(a.fundef)
+
+
+def run(fundefs):
+    ''' プログラム全体の値の範囲を求め，命令に書き込む '''
+    # 1回目は大域変数から読む値を分からないものとして書き込まれる値の範囲を求める
+    stored = storedRanges([RangeAnalysis(f, None) for f in fundefs])
+    for f in fundefs:
+        a = RangeAnalysis(f, stored)
+        if a.solved:
+            annotate(a)
+
+
+class RangeMetadata(object):
+    '''
+    load の値の範囲のメタデータ
+        first : 最初のメタデータ番号（分岐の重みのメタデータの後に続ける）
+        lines : 出力するメタデータ定義の行
+    '''
+
+    def __init__(self, fundefs, first:int):
+        self.first = first
+        self.lines = []
+        nodes = {}
+        for f in fundefs:
+            for l in f.codes:
+                if not isinstance(l, LLVMCodeLoad) or l.range is None:
+                    continue
+                lo, hi = l.range
+                # 範囲は [lo, hi+1) で，上端は 32 ビットで回り込んでよい
+                key = (lo, wrap32(hi + 1))
+                if key not in nodes:
+                    nodes[key] = first + len(self.lines)
+                    self.lines.append(f'!{nodes[key]} = !{{i32 {key[0]}, i32 {key[1]}}}')
+                l.rangeMd = nodes[key]
+
+    def print(self, fp):
+        if not self.lines:
+            return
+        print('', file=fp)
+        for line in self.lines:
+            print(line, file=fp)
@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+
+from cfg import CFG
+from llvmcode import *
+from operand import OType, Operand
+import stats
+
+##
+## x86-64 アセンブリの出力（--backend=x86）
+##   LLVM を通さずに，関数定義の命令列から System V ABI の GNU アセンブリ（AT&T 記法）を直接作る．
+##   開発中の素早いビルド用で，命令ごとに素直に命令列へ置き換える．
+##   - レジスタ割付けは線形走査法（Poletto & Sarkar）で，値（レジスタ）ごとに
+##     命令列を並べた順での生存区間 [最初, 最後] を1つ求めて割り付ける．
+##     呼び出しをまたぐ値は callee-saved のレジスタにだけ割り付け，割り付けられなければスタックに置く．
+##   - rax・rcx・rdx・r11 は割り付けず，除算・シフト・メモリ間の転送などの作業用に使う．
+##   - phi は先行ブロックの終わりでの並列代入にする．条件分岐の辺で代入が要るときは辺に小さなブロックを作る．
+##   - 直後の br だけが使う icmp は cmp と条件ジャンプにまとめる．
+##   値はすべてスタック上では8バイトの領域に置き，i32 の値は下位4バイトだけを意味のあるものとする．
+##   ベクトル命令・並列化・実行回数の計測・実行時プロファイラ・--fast-io の命令には対応しない．
+##
+
+ARG_REGS = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
+CALLEE_SAVED = ['rbx', 'r12', 'r13', 'r14', 'r15']
+CALLER_SAVED = ['rsi', 'rdi', 'r8', 'r9', 'r10']
+REG32 = {'rax': 'eax', 'rbx': 'ebx', 'rcx': 'ecx', 'rdx': 'edx', 'rsi': 'esi', 'rdi': 'edi',
+         'r8': 'r8d', 'r9': 'r9d', 'r10': 'r10d', 'r11': 'r11d',
+         'r12': 'r12d', 'r13': 'r13d', 'r14': 'r14d', 'r15': 'r15d'}
+CC = {CmpType.EQ: 'e', CmpType.NE: 'ne', CmpType.SGT: 'g',
+      CmpType.SGE: 'ge', CmpType.SLT: 'l', CmpType.SLE: 'le'}
+ARITH = {LLVMCodeAdd: 'addl', LLVMCodeSub: 'subl', LLVMCodeMul: 'imull', LLVMCodeAnd: 'andl'}
+SHIFT = {LLVMCodeShl: 'sall', LLVMCodeAshr: 'sarl'}
+
+##
+## 値の置き場所は次のタプルで表す
+##   ('reg', 'rbx')        : レジスタ
+##   ('mem', 3)            : 関数のスタック上の3番目の8バイトの領域
+##   ('mem', 'x(%rip)')    : それ以外のメモリ（大域変数やスタックで渡された引数）
+##   ('imm', 5)            : 定数
+##
+SCRATCH = ('reg', 'r11')
+
+
+def isCall(l:LLVMCode) -> bool:
+    return isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid, LLVMCodeCallPrintf, LLVMCodeCallScanf))
+
+
+class X86Function(object):
+    '''
+    1つの関数定義のアセンブリへの変換
+        fundef : 関数定義
+        lines  : 出力するアセンブリの行
+    '''
+
+    def __init__(self, fundef):
+        self.fundef = fundef
+        self.cfg = CFG(fundef)
+        self.lines = []
+        self.slots = {}         # alloca の名前 → スタック上の領域
+        self.nslots = 0
+        self.assign = {}        # 値 → 置き場所
+        self.fused = {}         # cmp と条件ジャンプにまとめる icmp の値 → icmp
+        self.edges = 0
+        self.collect()
+        self.allocate()
+
+    def label(self, lab:Labels) -> str:
+        return f".L{self.fundef.name}.{lab.lab}"
+
+    def newSlot(self) -> tuple:
+        self.nslots += 1
+        return ('mem', self.nslots)
+
+    def operand(self, loc:tuple, wide:bool=False) -> str:
+        ''' 置き場所 loc のアセンブリでの表記（wide なら64ビット） '''
+        kind, v = loc
+        if kind == 'reg':
+            return '%' + (v if wide else REG32[v])
+        if kind == 'imm':
+            return f'${v}'
+        if isinstance(v, int):
+            # 領域は退避した callee-saved のレジスタの下に置く
+            return f"-{8 * (len(self.saved) + v)}(%rbp)"
+        return v
+
+    ##
+    ## 生存区間とレジスタ割付け
+    ##
+
+    def collect(self):
+        ''' alloca の領域を決め，値の集合と icmp のまとめ方を求める '''
+        self.values = set(self.fundef.params)
+        self.uses = uses = {}
+        for b in self.cfg.blocks:
+            for l in b.codes:
+                if isinstance(l, LLVMCodeAlloca):
+                    self.slots[l.name] = self.newSlot()
+                elif isinstance(l, (LLVMCodeProfCount, LLVMCodeRtHook, LLVMCodeCallParallel,
+                                    LLVMCodeCallWriteInt, LLVMCodeCallReadInt, LLVMCodeBitcast,
+                                    LLVMCodeVecLoad, LLVMCodeVecStore, LLVMCodeVecBinOp,
+                                    LLVMCodeInsertElement, LLVMCodeSplat)):
+                    raise NotImplementedError(f"x86 backend: unsupported instruction: {l}")
+                if l.getDef() is not None:
+                    self.values.add(l.getDef())
+                for x in l.getUses():
+                    uses[x] = uses.get(x, 0) + 1
+        for b in self.cfg.blocks:
+            for l, n in zip(b.codes, b.codes[1:]):
+                if isinstance(l, LLVMCodeIcmp) and isinstance(n, LLVMCodeBr) \
+                        and n.cond == l.retval and uses.get(l.retval) == 1:
+                    self.fused[l.retval] = l
+
+    def liveness(self):
+        ''' ブロックの入口・出口で生きている値の集合を求める '''
+        use = {}
+        defs = {}
+        for b in self.cfg.blocks:
+            use[b] = set()
+            defs[b] = set()
+            for l in b.codes:
+                if not isinstance(l, LLVMCodePhi):
+                    use[b] |= {x for x in l.getUses() if x in self.values and x not in defs[b]}
+                if l.getDef() is not None:
+                    defs[b].add(l.getDef())
+        self.liveIn = {b: set() for b in self.cfg.blocks}
+        self.liveOut = {b: set() for b in self.cfg.blocks}
+        changed = True
+        while changed:
+            changed = False
+            for b in reversed(self.cfg.blocks):
+                out = set()
+                for s in b.succs:
+                    out |= self.liveIn[s] - {phi.retval for phi in s.phis()}
+                    out |= {v for v, _ in self.edgeMoves(b, s, values=True)}
+                live = use[b] | (out - defs[b])
+                if out != self.liveOut[b] or live != self.liveIn[b]:
+                    self.liveOut[b] = out
+                    self.liveIn[b] = live
+                    changed = True
+
+    def edgeMoves(self, p, s, values:bool=False) -> list:
+        '''
+        先行ブロック p から s へ移るときの phi の (定義する値, 入力) のリスト
+            values なら入力が値のものだけを返す
+        '''
+        r = []
+        for phi in s.phis():
+            for v, lab in phi.incoming:
+                if lab == p.label and (not values or v in self.values):
+                    r.append((phi.retval, v) if not values else (v, phi.retval))
+        return r
+
+    def intervals(self):
+        ''' 値ごとの生存区間 [lo, hi] と呼び出し命令の位置を求める '''
+        self.liveness()
+        self.lo = {}
+        self.hi = {}
+        self.calls = []
+
+        def touch(v, p):
+            self.lo[v] = min(self.lo.get(v, p), p)
+            self.hi[v] = max(self.hi.get(v, p), p)
+
+        start = {}
+        end = {}
+        pos = 0
+        for b in self.cfg.blocks:
+            start[b] = pos
+            pos += max(len(b.codes), 1)
+            end[b] = pos - 1
+        for v in self.fundef.params:
+            touch(v, -1)
+        for b in self.cfg.blocks:
+            for v in self.liveIn[b]:
+                touch(v, start[b])
+            for v in self.liveOut[b]:
+                touch(v, end[b])
+            for i, l in enumerate(b.codes):
+                p = start[b] + i
+                if isCall(l):
+                    self.calls.append(p)
+                if l.getDef() is not None:
+                    touch(l.getDef(), p)
+                if not isinstance(l, LLVMCodePhi):
+                    for x in l.getUses():
+                        if x in self.values:
+                            touch(x, p)
+            # phi への代入は先行ブロックの終わりで行う
+            for p in b.preds:
+                for d, v in self.edgeMoves(p, b):
+                    touch(d, end[p])
+                    if v in self.values:
+                        touch(v, end[p])
+
+    def crossesCall(self, v) -> bool:
+        return any(self.lo[v] < p < self.hi[v] for p in self.calls)
+
+    def allocate(self):
+        ''' 線形走査法で値をレジスタかスタックに割り付ける '''
+        self.intervals()
+        # 使われない結果と cmp にまとめた icmp の結果は置き場所を持たない
+        order = sorted((v for v in self.lo if v not in self.fused and (v in self.uses or v in self.fundef.params)),
+                       key=lambda v: (self.lo[v], self.hi[v]))
+        active = []
+        free = CALLER_SAVED + CALLEE_SAVED
+        for v in order:
+            for a in [a for a in active if self.hi[a] < self.lo[v]]:
+                active.remove(a)
+                free.append(self.assign[a][1])
+            pool = CALLEE_SAVED if self.crossesCall(v) else CALLER_SAVED + CALLEE_SAVED
+            reg = next((r for r in pool if r in free), None)
+            if reg is not None:
+                free.remove(reg)
+                self.assign[v] = ('reg', reg)
+                active.append(v)
+                continue
+            # 空きがなければ，同じレジスタを使える値のうち最も遅くまで生きるものをスタックに移す
+            cands = [a for a in active if self.assign[a][1] in pool]
+            victim = max(cands, key=lambda a: self.hi[a], default=None)
+            if victim is not None and self.hi[victim] > self.hi[v]:
+                self.assign[v] = self.assign[victim]
+                self.assign[victim] = self.newSlot()
+                active.remove(victim)
+                active.append(v)
+                stats.count('x86', 'values spilled to the stack')
+            else:
+                self.assign[v] = self.newSlot()
+                stats.count('x86', 'values spilled to the stack')
+        stats.count('x86', 'values in registers', sum(1 for x in self.assign.values() if x[0] == 'reg'))
+        self.saved = [r for r in CALLEE_SAVED if ('reg', r) in self.assign.values()]
+
+    ##
+    ## 命令の出力
+    ##
+
+    def emit(self, s:str):
+        self.lines.append(f"\t{s}")
+
+    def loc(self, x:Operand) -> tuple:
+        ''' オペランド x の置き場所 '''
+        if x.type == OType.CONSTANT:
+            return ('imm', x.val)
+        return self.assign[x]
+
+    def src(self, x:Operand, wide:bool=False) -> str:
+        return self.operand(self.loc(x), wide)
+
+    def addr(self, ptr:Operand) -> str:
+        ''' ポインタ ptr が指すメモリの表記 '''
+        if ptr.type == OType.GLOBAL_VAR:
+            return f"{ptr.name}(%rip)"
+        if ptr.type == OType.NAMED_REG and ptr.name in self.slots:
+            return self.operand(self.slots[ptr.name])
+        loc = self.loc(ptr)
+        if loc[0] == 'reg':
+            return f"(%{loc[1]})"
+        self.emit(f"movq {self.operand(loc)}, %r11")
+        return "(%r11)"
+
+    def addrOf(self, ptr:Operand, reg:str):
+        ''' ポインタ ptr の値をレジスタ reg に入れる '''
+        if ptr.type == OType.GLOBAL_VAR or (ptr.type == OType.NAMED_REG and ptr.name in self.slots):
+            self.emit(f"leaq {self.addr(ptr)}, %{reg}")
+        else:
+            self.mov(('reg', reg), self.loc(ptr))
+
+    def mov(self, d:tuple, s:tuple):
+        ''' 置き場所 s の値を d に写す（64ビット） '''
+        if d == s:
+            return
+        if d[0] == 'mem' and s[0] == 'mem':
+            self.emit(f"movq {self.operand(s)}, %rax")
+            s = ('reg', 'rax')
+        self.emit(f"movq {self.operand(s, True)}, {self.operand(d, True)}")
+
+    def parallelMove(self, moves:list):
+        ''' (d, s) のリストの代入を同時に行う（循環は r11 を使って断ち切る） '''
+        moves = [(d, s) for d, s in moves if d != s]
+        while moves:
+            for i, (d, s) in enumerate(moves):
+                if all(s2 != d for _, s2 in moves):
+                    self.mov(d, s)
+                    del moves[i]
+                    break
+            else:
+                d, s = moves[0]
+                self.mov(SCRATCH, d)
+                moves = [(d2, SCRATCH if s2 == d else s2) for d2, s2 in moves]
+
+    def result(self, l:LLVMCode) -> str:
+        ''' 結果を計算するレジスタ（結果の置き場所がメモリなら rax） '''
+        d = self.assign.get(l.getDef(), ('mem', None))
+        return d[1] if d[0] == 'reg' else 'rax'
+
+    def writeBack(self, l:LLVMCode, reg:str):
+        if l.getDef() in self.assign:
+            self.mov(self.assign[l.getDef()], ('reg', reg))
+
+    def compare(self, l:LLVMCodeIcmp):
+        a = self.loc(l.arg1)
+        if a[0] != 'reg':
+            self.emit(f"movl {self.operand(a)}, %eax")
+            a = ('reg', 'rax')
+        self.emit(f"cmpl {self.src(l.arg2)}, {self.operand(a)}")
+
+    def edgeCopies(self, b, target:Labels) -> list:
+        s = self.cfg.blockOf(target)
+        return [(self.assign[d], self.loc(v)) for d, v in self.edgeMoves(b, s) if d in self.assign]
+
+    def jump(self, b, target:Labels, next:Labels):
+        ''' target への無条件ジャンプ（phi への代入を含む） '''
+        self.parallelMove(self.edgeCopies(b, target))
+        if target != next:
+            self.emit(f"jmp {self.label(target)}")
+
+    def branch(self, b, cond:CmpType, l:LLVMCodeBr, next:Labels):
+        ''' 比較の結果が cond なら l.arg1，そうでなければ l.arg2 へ分岐する '''
+        tcopies = self.edgeCopies(b, l.arg1)
+        fcopies = self.edgeCopies(b, l.arg2)
+        if not tcopies and not fcopies and l.arg1 == next:
+            self.emit(f"j{CC[cond.inverse()]} {self.label(l.arg2)}")
+            return
+        if not tcopies:
+            self.emit(f"j{CC[cond]} {self.label(l.arg1)}")
+            self.jump(b, l.arg2, next)
+            return
+        stub = f".L{self.fundef.name}.e{self.edges}"
+        self.edges += 1
+        self.emit(f"j{CC[cond]} {stub}")
+        self.jump(b, l.arg2, None)
+        self.lines.append(f"{stub}:")
+        self.jump(b, l.arg1, None)
+
+    def call(self, name:str, args:list):
+        ''' 関数 name の呼び出し（7つ目以降の引数はスタックに積む） '''
+        stack = args[6:]
+        pad = 8 if len(stack) % 2 else 0
+        if pad:
+            self.emit("subq $8, %rsp")
+        for x in reversed(stack):
+            self.emit(f"pushq {self.src(x, True)}")
+        self.parallelMove([(('reg', r), self.loc(x)) for r, x in zip(ARG_REGS, args)])
+        self.emit(f"call {name}")
+        if stack:
+            self.emit(f"addq ${8 * len(stack) + pad}, %rsp")
+
+    def epilogue(self):
+        if self.saved:
+            self.emit(f"leaq -{8 * len(self.saved)}(%rbp), %rsp")
+        else:
+            self.emit("movq %rbp, %rsp")
+        for r in reversed(self.saved):
+            self.emit(f"popq %{r}")
+        self.emit("popq %rbp")
+        self.emit("ret")
+
+    def lower(self, b, l:LLVMCode, next:Labels):
+        ''' 命令 l をアセンブリにする '''
+        if isinstance(l, (LLVMCodeAlloca, LLVMCodePhi)) or self.fused.get(l.getDef()) is l:
+            return
+        if type(l) in ARITH:
+            r = self.result(l)
+            self.emit(f"movl {self.src(l.arg1)}, %{REG32[r]}")
+            self.emit(f"{ARITH[type(l)]} {self.src(l.arg2)}, %{REG32[r]}")
+            self.writeBack(l, r)
+        elif type(l) in SHIFT:
+            r = self.result(l)
+            self.emit(f"movl {self.src(l.arg1)}, %{REG32[r]}")
+            if l.arg2.isConst():
+                self.emit(f"{SHIFT[type(l)]} ${l.arg2.val & 31}, %{REG32[r]}")
+            else:
+                self.emit(f"movl {self.src(l.arg2)}, %ecx")
+                self.emit(f"{SHIFT[type(l)]} %cl, %{REG32[r]}")
+            self.writeBack(l, r)
+        elif isinstance(l, LLVMCodeDiv):
+            self.emit(f"movl {self.src(l.arg1)}, %eax")
+            self.emit("cltd")
+            if l.arg2.isConst():
+                self.emit(f"movl ${l.arg2.val}, %ecx")
+                self.emit("idivl %ecx")
+            else:
+                self.emit(f"idivl {self.src(l.arg2)}")
+            self.writeBack(l, 'rax')
+        elif isinstance(l, LLVMCodeIcmp):
+            r = self.result(l)
+            self.compare(l)
+            self.emit(f"set{CC[l.cond]} %al")
+            self.emit(f"movzbl %al, %{REG32[r]}")
+            self.writeBack(l, r)
+        elif isinstance(l, LLVMCodeLoad):
+            r = self.result(l)
+            self.emit(f"movl {self.addr(l.ptr)}, %{REG32[r]}")
+            self.writeBack(l, r)
+        elif isinstance(l, LLVMCodeStore):
+            v = self.loc(l.argval)
+            if v[0] == 'mem':
+                self.emit(f"movl {self.operand(v)}, %eax")
+                v = ('reg', 'rax')
+            self.emit(f"movl {self.operand(v)}, {self.addr(l.ptr)}")
+        elif isinstance(l, LLVMCodeSext):
+            r = self.result(l)
+            if l.v.isConst():
+                self.emit(f"movq ${l.v.val}, %{r}")
+            elif l.zext:
+                self.emit(f"movl {self.src(l.v)}, %{REG32[r]}")
+            else:
+                self.emit(f"movslq {self.src(l.v)}, %{r}")
+            self.writeBack(l, r)
+        elif isinstance(l, LLVMCodeGetelementptr):
+            r = self.result(l)
+            if l.ptr.isConst():
+                self.emit(f"leaq {l.name}{4 * (l.offset + l.ptr.val):+d}(%rip), %{r}")
+            else:
+                self.emit(f"leaq {l.name}{4 * l.offset:+d}(%rip), %r11")
+                if l.idxtype == 'i32':
+                    self.emit(f"movl {self.src(l.ptr)}, %eax")
+                else:
+                    self.emit(f"movq {self.src(l.ptr, True)}, %rax")
+                self.emit(f"leaq (%r11,%rax,4), %{r}")
+            self.writeBack(l, r)
+        elif isinstance(l, LLVMCodePtrAdd):
+            r = self.result(l)
+            self.mov(SCRATCH, self.loc(l.base))
+            if l.offset.isConst():
+                self.emit(f"leaq {4 * l.offset.val}(%r11), %{r}")
+            else:
+                self.emit(f"movq {self.src(l.offset, True)}, %rax")
+                self.emit(f"leaq (%r11,%rax,4), %{r}")
+            self.writeBack(l, r)
+        elif isinstance(l, (LLVMCodeCall, LLVMCodeCallVoid)):
+            self.call(l.name, l.arg)
+            if l.getDef() is not None:
+                self.writeBack(l, 'rax')
+        elif isinstance(l, LLVMCodeCallPrintf):
+            self.emit(f"movl {self.src(l.arg)}, %esi")
+            self.emit("leaq .Lstr.w(%rip), %rdi")
+            self.emit("xorl %eax, %eax")
+            self.emit("call printf@PLT")
+            self.writeBack(l, 'rax')
+        elif isinstance(l, LLVMCodeCallScanf):
+            self.addrOf(l.arg, 'rsi')
+            self.emit("leaq .Lstr.r(%rip), %rdi")
+            self.emit("xorl %eax, %eax")
+            self.emit("call __isoc99_scanf@PLT")
+            self.writeBack(l, 'rax')
+        elif isinstance(l, LLVMCodeRet):
+            if l.val is not None:
+                self.emit(f"movl {self.src(l.val)}, %eax")
+            self.epilogue()
+        elif isinstance(l, LLVMCodeJ):
+            self.jump(b, l.arg1, next)
+        elif isinstance(l, LLVMCodeBr):
+            icmp = self.fused.get(l.cond)
+            c = None if icmp is not None else self.loc(l.cond)
+            if icmp is not None:
+                self.compare(icmp)
+                self.branch(b, icmp.cond, l, next)
+            elif c[0] == 'imm':
+                self.jump(b, l.arg1 if c[1] else l.arg2, next)
+            else:
+                self.emit(f"cmpl $0, {self.operand(c)}")
+                self.branch(b, CmpType.NE, l, next)
+        else:
+            raise NotImplementedError(f"x86 backend: unsupported instruction: {l}")
+
+    def print(self, fp):
+        ''' 関数定義のアセンブリを出力する '''
+        name = self.fundef.name
+        print(f"\t.globl {name}", file=fp)
+        print(f"\t.type {name}, @function", file=fp)
+        print(f"{name}:", file=fp)
+        self.emit("pushq %rbp")
+        self.emit("movq %rsp, %rbp")
+        for r in self.saved:
+            self.emit(f"pushq %{r}")
+        # 呼び出し時に rsp が16バイト境界になるようにする
+        base = 8 * len(self.saved)
+        frame = -(-(base + 8 * self.nslots) // 16) * 16 - base
+        if frame:
+            self.emit(f"subq ${frame}, %rsp")
+        params = []
+        for i, x in enumerate(self.fundef.params):
+            src = ('reg', ARG_REGS[i]) if i < 6 else ('mem', f"{16 + 8 * (i - 6)}(%rbp)")
+            params.append((self.assign[x], src))
+        self.parallelMove(params)
+        blocks = self.cfg.blocks
+        for i, b in enumerate(blocks):
+            if b.label is not None:
+                self.lines.append(f"{self.label(b.label)}:")
+            next = blocks[i + 1].label if i + 1 < len(blocks) else None
+            for l in b.codes:
+                self.lower(b, l, next)
+        for s in self.lines:
+            print(s, file=fp)
+        print(f"\t.size {name}, .-{name}\n", file=fp)
+
+
+def printModule(decls:list, fundefs, useWrite:bool, useRead:bool, fp):
+    '''
+    アセンブリのモジュールを出力する
+        decls : 大域変数の定義（LLVMCodeGlobal・LLVMCodeGlobalArray のリスト）
+    '''
+    for g in decls:
+        if isinstance(g, LLVMCodeGlobalArray):
+            print(f"\t.comm {g.name},{4 * int(g.size)},16", file=fp)
+        else:
+            print(f"\t.comm {g.name},4,4", file=fp)
+    if useWrite or useRead:
+        print("\t.section .rodata", file=fp)
+        if useWrite:
+            print('.Lstr.w:\n\t.string "%d\\n"', file=fp)
+        if useRead:
+            print('.Lstr.r:\n\t.string "%d"', file=fp)
+    print("\t.text", file=fp)
+    for f in fundefs:
+        X86Function(f).print(fp)
+    print('\t.section .note.GNU-stack,"",@progbits', file=fp)